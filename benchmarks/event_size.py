@@ -0,0 +1,109 @@
+import argparse
+import copy
+import datetime
+import gc
+import json
+import pickle
+import platform
+import random
+import tracemalloc
+from pathlib import Path
+
+from benchmarks.synthetic import (
+    prepare_environment,
+    register_tables,
+    synthetic_event,
+    synthetic_change_event,
+    NARROW_TABLE,
+    WIDE_TABLE,
+)
+
+prepare_environment()
+register_tables()
+
+from change_event import QueueSerializer, event_payload  # noqa: E402
+from utils import mapping_data  # noqa: E402
+
+
+def retained_bytes(build, count: int) -> float:
+    """
+    Memory held per object while ``count`` objects built by ``build`` are alive, e.g. events waiting in a batch
+    :param build: callable returning a new object
+    :param count:
+    :return: bytes per object
+    """
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objects = [build() for _ in range(count)]
+    held = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del objects
+    return held / count
+
+
+def event_sizes(table: str, action: str, count: int, seed: int) -> dict:
+    """
+    In-memory, queue record and cdc_log payload sizes of the mapped event dict and the ChangeEvent of one event
+    :param table:
+    :param action:
+    :param count: events kept alive for the memory measurement
+    :param seed:
+    :return:
+    """
+    raw = synthetic_event(random.Random(seed), table, action)
+    mapped = mapping_data(table, action, copy.deepcopy(raw))
+    change = synthetic_change_event(raw)
+    change.stage_ts = mapped["stage_ts"] = {"commit": None, "captured": 0.0}
+
+    return {
+        "dict": {
+            "memory_bytes": round(retained_bytes(lambda: mapping_data(table, action, copy.deepcopy(raw)), count)),
+            "queue_bytes": len(pickle.dumps(mapped, protocol=pickle.HIGHEST_PROTOCOL)),
+            "cdc_log_bytes": len(pickle.dumps(event_payload(mapped))),
+        },
+        "change_event": {
+            "memory_bytes": round(retained_bytes(lambda: synthetic_change_event(raw), count)),
+            "queue_bytes": len(QueueSerializer.dumps(change)),
+            "cdc_log_bytes": len(pickle.dumps(event_payload(change))),
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Memory and encoded size of queued events, event dict vs ChangeEvent")
+    parser.add_argument("--count", "-n", type=int, default=2000, help="Events kept alive per memory measurement")
+    parser.add_argument("--seed", type=int, default=42, help="Seed of the synthetic data")
+    parser.add_argument("--output", "-o", type=str, default=None, help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = {
+        "meta": {
+            "dt": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "count": args.count,
+        },
+        "results": {},
+    }
+    print(f"{'case':<24} {'format':<14} {'memory B':>10} {'queue B':>10} {'cdc_log B':>10}")
+    for label, table in (("narrow", NARROW_TABLE), ("wide", WIDE_TABLE)):
+        for action in ("insert", "update"):
+            name = f"{label},{action}"
+            sizes = event_sizes(table, action, args.count, args.seed)
+            results["results"][name] = sizes
+            for fmt, size in sizes.items():
+                print(
+                    f"{name:<24} {fmt:<14} {size['memory_bytes']:>10} {size['queue_bytes']:>10} "
+                    f"{size['cdc_log_bytes']:>10}"
+                )
+
+    if args.output:
+        Path(args.output).parent.mkdir(exist_ok=True, parents=True)
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+        print(f"\nResults written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
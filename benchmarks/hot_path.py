@@ -0,0 +1,189 @@
+import argparse
+import copy
+import datetime
+import json
+import pickle
+import platform
+import random
+import statistics
+import sys
+import time
+from pathlib import Path
+
+from benchmarks.synthetic import (
+    prepare_environment,
+    register_tables,
+    synthetic_event,
+    synthetic_change_event,
+    NARROW_TABLE,
+    WIDE_TABLE,
+)
+
+prepare_environment()
+register_tables()
+
+from change_event import QueueSerializer  # noqa: E402
+from utils import (  # noqa: E402
+    convert_values,
+    mapping_data,
+    find_values_differences,
+    generate_insert_statement,
+    generate_update_statement,
+    dict_to_hash,
+)
+
+# Results slower than the baseline by more than this ratio are reported as regressions
+DEFAULT_REGRESSION_THRESHOLD = 0.10
+
+
+def measure(func, make_inputs, number: int, repeat: int) -> dict:
+    """
+    Times ``func`` over ``number`` prepared argument tuples, ``repeat`` times.
+    Inputs are built outside the timed loop, so functions that mutate their input get a fresh copy per call.
+    :param func:
+    :param make_inputs: callable returning a list of ``number`` argument tuples
+    :param number:
+    :param repeat:
+    :return: per-operation timings in nanoseconds
+    """
+    samples = []
+    for _ in range(repeat):
+        inputs = make_inputs(number)
+        start = time.perf_counter_ns()
+        for args in inputs:
+            func(*args)
+        samples.append((time.perf_counter_ns() - start) / number)
+
+    median = statistics.median(samples)
+    return {
+        "ns_per_op_min": round(min(samples), 1),
+        "ns_per_op_median": round(median, 1),
+        "ops_per_sec": round(1e9 / median, 1),
+        "number": number,
+        "repeat": repeat,
+    }
+
+
+def benchmark_cases(seed: int) -> dict:
+    """
+    Builds the benchmark cases of the narrow and wide synthetic tables
+    :param seed:
+    :return: dictionary of case name -> (function, input factory)
+    """
+    cases = {}
+    for label, table in (("narrow", NARROW_TABLE), ("wide", WIDE_TABLE)):
+        rng = random.Random(seed)
+        func_name = f"_process_{table}"
+        raw_insert = synthetic_event(rng, table, "insert")
+        raw_update = synthetic_event(rng, table, "update")
+        mapped_insert = mapping_data(table, "insert", copy.deepcopy(raw_insert))
+        mapped_update = mapping_data(table, "update", copy.deepcopy(raw_update))
+        change_insert = synthetic_change_event(raw_insert)
+        change_update = synthetic_change_event(raw_update)
+        queued_insert = QueueSerializer.dumps(change_insert)
+        queued_dict = pickle.dumps(mapped_insert, protocol=pickle.HIGHEST_PROTOCOL)
+
+        def fresh(event, *args):
+            # Mutating functions get a deep copy per call
+            return lambda number: [(*args, copy.deepcopy(event)) for _ in range(number)]
+
+        def same(*args):
+            return lambda number: [args] * number
+
+        cases.update({
+            f"convert_values[{label}]": (convert_values, fresh(raw_insert)),
+            f"mapping_data[{label},insert]": (mapping_data, fresh(raw_insert, table, "insert")),
+            f"mapping_data[{label},update]": (mapping_data, fresh(raw_update, table, "update")),
+            f"find_values_differences[{label}]": (find_values_differences, same(mapped_update["data"])),
+            f"generate_insert_statement[{label}]": (generate_insert_statement, same(func_name, mapped_insert["data"])),
+            f"generate_update_statement[{label}]": (
+                generate_update_statement, same(func_name, mapped_update["data"], "id = 1")
+            ),
+            f"pickle_dumps[{label},raw_event]": (pickle.dumps, same(raw_insert)),
+            f"pickle_dumps[{label},mapped_data]": (pickle.dumps, same(mapped_insert["data"])),
+            f"dict_to_hash[{label}]": (dict_to_hash, same(mapped_insert["data"])),
+            # Compact ChangeEvent against the mapped event dict it replaced
+            f"change_event_build[{label},insert]": (synthetic_change_event, same(raw_insert)),
+            f"change_event_build[{label},update]": (synthetic_change_event, same(raw_update)),
+            f"queue_dumps[{label},dict]": (pickle.dumps, same(mapped_insert, pickle.HIGHEST_PROTOCOL)),
+            f"queue_dumps[{label},change_event]": (QueueSerializer.dumps, same(change_insert)),
+            f"queue_loads[{label},dict]": (pickle.loads, same(queued_dict)),
+            f"queue_loads[{label},change_event]": (QueueSerializer.loads, same(queued_insert)),
+            f"change_event_data[{label},update]": (
+                lambda event: synthetic_change_event(event).data, same(raw_update)
+            ),
+            f"change_event_payload[{label},update]": (lambda event: event.payload(), same(change_update)),
+        })
+    return cases
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """
+    Compares the median timings with a baseline result file
+    :param results:
+    :param baseline:
+    :param threshold: relative slowdown reported as a regression
+    :return: list of regressed case names
+    """
+    regressions = []
+    print(f"\n{'case':<48} {'baseline ns':>12} {'current ns':>12} {'change':>8}")
+    for name, result in results["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            print(f"{name:<48} {'-':>12} {result['ns_per_op_median']:>12} {'new':>8}")
+            continue
+        change = result["ns_per_op_median"] / base["ns_per_op_median"] - 1
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = " REGRESSION"
+        print(
+            f"{name:<48} {base['ns_per_op_median']:>12} {result['ns_per_op_median']:>12} {change:>+8.1%}{flag}"
+        )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of the per-row hot path functions")
+    parser.add_argument("--number", "-n", type=int, default=2000, help="Calls per repetition")
+    parser.add_argument("--repeat", "-r", type=int, default=5, help="Repetitions per case")
+    parser.add_argument("--seed", type=int, default=42, help="Seed of the synthetic data")
+    parser.add_argument("--filter", "-k", type=str, default=None, help="Only run cases containing this text")
+    parser.add_argument("--output", "-o", type=str, default=None, help="Write the results to this JSON file")
+    parser.add_argument("--compare", "-c", type=str, default=None, help="Compare with a previous results file")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_REGRESSION_THRESHOLD,
+                        help="Relative slowdown reported as a regression (exit code 1)")
+    args = parser.parse_args()
+
+    results = {
+        "meta": {
+            "dt": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "machine": platform.machine(),
+            "seed": args.seed,
+        },
+        "results": {},
+    }
+    for name, (func, make_inputs) in benchmark_cases(args.seed).items():
+        if args.filter and args.filter not in name:
+            continue
+        result = measure(func, make_inputs, args.number, args.repeat)
+        results["results"][name] = result
+        print(f"{name:<48} {result['ns_per_op_median']:>12} ns/op {result['ops_per_sec']:>12} ops/s", flush=True)
+
+    if args.output:
+        Path(args.output).parent.mkdir(exist_ok=True, parents=True)
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+        print(f"\nResults written to {args.output}")
+
+    if args.compare:
+        with open(args.compare, "r") as baseline_file:
+            baseline = json.load(baseline_file)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
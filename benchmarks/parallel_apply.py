@@ -0,0 +1,150 @@
+import argparse
+import collections
+import contextlib
+import datetime
+import hashlib
+import json
+import os
+import platform
+import sys
+import time
+from pathlib import Path
+
+from benchmarks.replay import synthetic_stream, register_synthetic_processors
+from benchmarks.standins import SQLiteLogDB, SQLiteTargetDB, MemoryQueue
+from benchmarks.synthetic import NARROW_TABLE
+from cdc.binlog_processor import CDC
+from dpu.queue_processor import DPU
+from dpu.write_set import WriteSetScheduler, PARALLEL_APPLY_DEFAULT_WINDOW
+
+
+def target_digest(target_db: SQLiteTargetDB, table: str) -> str:
+    """
+    Digest of the rows of a target table without the id column, the target IDs depend on the apply order
+    :param target_db:
+    :param table:
+    :return:
+    """
+    with target_db.lock:
+        cursor = target_db.connection.execute(f"select * from `{table}`;")
+        columns = [description[0] for description in cursor.description]
+        rows = sorted(
+            repr(tuple(value for column, value in zip(columns, row) if column != "id")) for row in cursor.fetchall()
+        )
+    return hashlib.sha256("\n".join(rows).encode()).hexdigest()
+
+
+def recording(processor, applied: dict):
+    """
+    Table processor recording the cdc_id of every applied event by row
+    :param processor:
+    :param applied: row key -> cdc_id in apply order
+    :return:
+    """
+
+    def process(raw):
+        data = raw["data"]
+        row = data["before_values"] if raw["action"] == "update" else data
+        processor(raw)
+        applied[row["id"]].append(raw["cdc_id"])
+
+    return process
+
+
+def run(stream: list, table: str, workers: int, window: int, latency: float) -> dict:
+    """
+    Applies the stream with a WriteSetScheduler of ``workers`` DPUs
+    :param stream: replay events
+    :param table: table of the stream
+    :param workers:
+    :param window:
+    :param latency: seconds added to every target statement
+    :return:
+    """
+    log_db = SQLiteLogDB()
+    target_db = SQLiteTargetDB(latency=latency)
+    queue = MemoryQueue()
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        CDC(log_db=log_db, queue=queue).binlog_processor(iter(stream))
+        events = queue.qsize()
+        dpus = []
+        # cdc_id of the applied events per row, list.append is atomic across the worker threads
+        applied = collections.defaultdict(list)
+        for _ in range(workers):
+            dpu = DPU(log_db=log_db, target_db=target_db, queue=queue)
+            register_synthetic_processors(dpu)
+            dpu.table_processors[table] = recording(dpu.table_processors[table], applied)
+            dpus.append(dpu)
+        scheduler = WriteSetScheduler(dpus, queue, {"window": window}, dead_letter_log_db=log_db)
+        scheduler.start(threads_only=True)
+
+        start = time.perf_counter()
+        for _ in range(events):
+            scheduler.dispatch(queue.get())
+        scheduler.join()
+        seconds = time.perf_counter() - start
+
+    return {
+        "workers": workers,
+        "events": events,
+        "seconds": round(seconds, 3),
+        "events_per_sec": round(events / seconds, 1),
+        "conflicts": scheduler.conflicts,
+        # Every row saw its events in queue order
+        "ordered": all(cdc_ids == sorted(cdc_ids) for cdc_ids in applied.values()),
+        "dead_letters": len(log_db.dpu_dead_letter_query(limit=events)),
+        "target_errors": target_db.errors,
+        "digest": target_digest(target_db, table),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Throughput of the write-set parallel apply by worker count on a single hot table"
+    )
+    parser.add_argument("--events", type=int, default=5000, help="Number of synthetic rows events")
+    parser.add_argument("--table", type=str, default=NARROW_TABLE, help="Table of the synthetic stream")
+    parser.add_argument("--workers", type=str, default="1,2,4,8", help="Comma separated worker counts")
+    parser.add_argument("--window", type=int, default=PARALLEL_APPLY_DEFAULT_WINDOW,
+                        help="Events taken ahead of the oldest unapplied event")
+    parser.add_argument("--latency-ms", type=float, default=1.0,
+                        help="Milliseconds added to every statement of the SQLite target stand-in, "
+                             "the round trip and commit of a remote MySQL target")
+    parser.add_argument("--seed", type=int, default=42, help="Seed of the synthetic stream")
+    parser.add_argument("--output", "-o", type=str, default=None, help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    stream = synthetic_stream(args.events, [args.table], 1, args.seed)
+    runs = [
+        run(stream, args.table, int(workers), args.window, args.latency_ms / 1000)
+        for workers in args.workers.split(",")
+    ]
+    baseline = runs[0]
+    for result in runs:
+        result["speedup"] = round(result["events_per_sec"] / baseline["events_per_sec"], 2)
+        # The target holds the same rows whatever the number of workers
+        result["consistent"] = result["digest"] == baseline["digest"]
+
+    results = {
+        "meta": {
+            "dt": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "source": f"synthetic:{args.events}:{args.table}",
+            "latency_ms": args.latency_ms,
+            "window": args.window,
+        },
+        "runs": runs,
+    }
+
+    json.dump(results, sys.stdout, indent=2)
+    print()
+    if args.output:
+        Path(args.output).parent.mkdir(exist_ok=True, parents=True)
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
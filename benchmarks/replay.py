@@ -0,0 +1,285 @@
+import argparse
+import contextlib
+import copy
+import datetime
+import json
+import os
+import platform
+import random
+import sys
+import threading
+import time
+from pathlib import Path
+
+from benchmarks.synthetic import (
+    prepare_environment,
+    register_tables,
+    random_row,
+    random_value,
+    column_type,
+    NARROW_TABLE,
+    WIDE_TABLE,
+    UPDATE_CHANGED_RATIO,
+)
+
+prepare_environment()
+register_tables()
+
+from benchmarks.standins import SQLiteLogDB, SQLiteTargetDB, MemoryQueue  # noqa: E402
+from cdc.binlog_processor import CDC  # noqa: E402
+from cdc.capture import (  # noqa: E402
+    CaptureWriter,
+    read_capture,
+    replay_event,
+    ReplayRotateEvent,
+    REPLAY_EVENT_CLASSES,
+)
+from dpu.lag_tracker import percentile, CAPTURED, ENQUEUED, DEQUEUED, APPLIED  # noqa: E402
+from dpu.queue_processor import DPU  # noqa: E402
+from field_mappings import field_mappings_raw  # noqa: E402
+from pipeline import Pipeline  # noqa: E402
+from utils import generate_insert_statement, generate_update_statement  # noqa: E402
+
+# Per-stage timings of the replay, the queue wait is left out since the CDC and DPU run one after the other
+REPLAY_STAGES = {
+    "cdc": (CAPTURED, ENQUEUED),
+    "dpu": (DEQUEUED, APPLIED),
+}
+# The pipeline mode runs the CDC and DPU concurrently, its events are timed from capture to apply
+PIPELINE_STAGES = dict(REPLAY_STAGES, end_to_end=(CAPTURED, APPLIED))
+# Share of inserts, updates and deletes of the synthetic stream
+SYNTHETIC_MIX = (("insert", 0.7), ("update", 0.2), ("delete", 0.1))
+
+
+def synthetic_stream(events: int, tables: list, rows_per_event: int, seed: int) -> list:
+    """
+    Builds a synthetic binlog stream of inserts, updates and deletes on existing rows
+    :param events: number of rows events
+    :param tables: tables of field_mappings_raw
+    :param rows_per_event:
+    :param seed:
+    :return: list of replay events
+    """
+    rng = random.Random(seed)
+    existing = {table: [] for table in tables}
+    next_id = {table: 1 for table in tables}
+    stream = [ReplayRotateEvent("mysql-bin.000001", 4)]
+    log_pos = 4
+
+    for _ in range(events):
+        table = rng.choice(tables)
+        columns = len(field_mappings_raw[table])
+        action = rng.choices([action for action, _ in SYNTHETIC_MIX], [share for _, share in SYNTHETIC_MIX])[0]
+        if len(existing[table]) < rows_per_event:
+            action = "insert"
+
+        rows = []
+        for _ in range(rows_per_event):
+            if action == "insert":
+                row = random_row(rng, columns)
+                row["UNKNOWN_COL0"] = next_id[table]
+                next_id[table] += 1
+                existing[table].append(row)
+                rows.append({"values": copy.deepcopy(row)})
+            elif action == "update":
+                index = rng.randrange(len(existing[table]))
+                before = existing[table][index]
+                after = dict(before)
+                for i in rng.sample(range(1, columns), max(1, int((columns - 1) * UPDATE_CHANGED_RATIO))):
+                    after[f"UNKNOWN_COL{i}"] = random_value(rng, column_type(i))
+                existing[table][index] = after
+                rows.append({"before_values": copy.deepcopy(before), "after_values": copy.deepcopy(after)})
+            else:
+                row = existing[table].pop(rng.randrange(len(existing[table])))
+                rows.append({"values": copy.deepcopy(row)})
+
+        log_pos += 100 * rows_per_event
+        stream.append(REPLAY_EVENT_CLASSES[action]("bench", table, time.time(), log_pos, rows))
+    return stream
+
+
+def process_synthetic_table(dpu: DPU, table: str, raw: dict):
+    """
+    Table processor of the synthetic tables, follows _process_example_table without foreign keys
+    """
+    func_name = f"_process_{table}"
+    field_define = f"{table}_id"
+    cdc_data = raw["data"]
+    action = raw["action"]
+
+    if action == "insert":
+        dml = generate_insert_statement(func_name, cdc_data)
+        dpu_id = dpu.log_db.dpu_processed_log_insert(raw, dml)
+        row_id = dpu.target_db.insert_and_update(dml)
+        dpu.log_db.dpu_after_dml_execute_update(dpu_id, executed=bool(row_id))
+        if row_id:
+            dpu.log_db.dpu_relationship_create(field_define, cdc_data["id"], row_id)
+    elif action == "update":
+        new_id = dpu.log_db.dpu_relationship_query(field_define, cdc_data["after_values"]["id"])
+        dml = generate_update_statement(func_name, cdc_data, f"id = {new_id}")
+        dpu_id = dpu.log_db.dpu_processed_log_insert(raw, dml)
+        rowcount = dpu.target_db.insert_and_update(dml)
+        dpu.log_db.dpu_after_dml_execute_update(dpu_id, executed=bool(rowcount))
+    else:
+        new_id = dpu.log_db.dpu_relationship_query(field_define, cdc_data["id"])
+        dml = f"DELETE FROM {table} WHERE id = {new_id};"
+        dpu_id = dpu.log_db.dpu_processed_log_insert(raw, dml)
+        rowcount = dpu.target_db.insert_and_update(dml)
+        dpu.log_db.dpu_after_dml_execute_update(dpu_id, executed=bool(rowcount))
+
+
+def register_synthetic_processors(dpu: DPU):
+    for table in field_mappings_raw:
+        if table not in dpu.table_processors:
+            dpu.table_processors[table] = lambda raw, table=table: process_synthetic_table(dpu, table, raw)
+
+
+def stage_summary(stage_ts_list: list, stages: dict = REPLAY_STAGES) -> dict:
+    """
+    Per-stage latency percentiles in milliseconds
+    :param stage_ts_list: stage timestamps of the applied events
+    :param stages: stage name: (start, end) timestamps
+    :return:
+    """
+    summary = {}
+    for stage, (start, end) in stages.items():
+        latencies = sorted(
+            (stage_ts[end] - stage_ts[start]) * 1000
+            for stage_ts in stage_ts_list
+            if stage_ts.get(start) is not None and stage_ts.get(end) is not None
+        )
+        if latencies:
+            summary[stage] = {
+                "p50_ms": round(percentile(latencies, 0.5), 3),
+                "p95_ms": round(percentile(latencies, 0.95), 3),
+                "p99_ms": round(percentile(latencies, 0.99), 3),
+                "mean_ms": round(sum(latencies) / len(latencies), 3),
+            }
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replays a recorded or synthetic binlog stream through the CDC and DPU")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--capture", type=str, help="Capture file recorded by the CDC (capture_file in config.yml)")
+    source.add_argument("--synthetic", type=int, help="Number of synthetic rows events")
+    parser.add_argument("--tables", type=str, default=f"example_table,{NARROW_TABLE},{WIDE_TABLE}",
+                        help="Comma separated tables of the synthetic stream")
+    parser.add_argument("--rows-per-event", type=int, default=1, help="Rows per synthetic rows event")
+    parser.add_argument("--seed", type=int, default=42, help="Seed of the synthetic stream")
+    parser.add_argument("--queue", choices=["sqlite", "memory", "ring"], default="sqlite",
+                        help="Persistence queue in a temporary directory, an in-memory queue, "
+                             "or the ring buffer of the pipeline mode (CDC and DPU run concurrently)")
+    parser.add_argument("--sink", choices=["sqlite", "jsonl", "csv"], default=None,
+                        help="Apply to a sink target instead of the SQLite stand-in of the MySQL target "
+                             "(table processors are replaced by the sink)")
+    parser.add_argument("--record", type=str, default=None, help="Save the synthetic stream as a capture file")
+    parser.add_argument("--output", "-o", type=str, default=None, help="Write the results to this JSON file")
+    args = parser.parse_args()
+    if args.sink and args.queue == "ring":
+        parser.error("--sink is not supported with --queue ring")
+
+    if args.capture:
+        stream = [replay_event(record) for record in read_capture(Path(args.capture))]
+    else:
+        stream = synthetic_stream(args.synthetic, args.tables.split(","), args.rows_per_event, args.seed)
+        if args.record:
+            capture = CaptureWriter(Path(args.record))
+            for binlog_event in stream:
+                capture.write(binlog_event)
+            capture.close()
+    rows = sum(len(binlog_event.rows) for binlog_event in stream if not isinstance(binlog_event, ReplayRotateEvent))
+
+    log_db = SQLiteLogDB()
+    target_db = SQLiteTargetDB()
+    devnull = open(os.devnull, "w")
+    applied = []
+
+    if args.queue == "ring":
+        with contextlib.redirect_stdout(devnull):
+            pipeline = Pipeline(cdc_log_db=log_db, dpu_log_db=log_db, target_db=target_db)
+            register_synthetic_processors(pipeline.dpu)
+            cdc_done = threading.Event()
+
+            def apply_ring():
+                while not cdc_done.is_set() or pipeline.ring.qsize():
+                    if pipeline.ring.wait(0.05):
+                        queue_item = pipeline._apply()
+                        if "applied" in queue_item["stage_ts"]:
+                            applied.append(queue_item["stage_ts"])
+
+            applier = threading.Thread(target=apply_ring, name="pipeline-dpu")
+            start = time.perf_counter()
+            applier.start()
+            pipeline.cdc.binlog_processor(iter(stream))
+            cdc_seconds = time.perf_counter() - start
+            cdc_done.set()
+            applier.join()
+            pipeline.drain()
+            # Both units run concurrently, the DPU time is the total time
+            dpu_seconds = time.perf_counter() - start
+            queued = pipeline.applied_events
+        stages = stage_summary(applied, PIPELINE_STAGES)
+        end_to_end_seconds = dpu_seconds
+    else:
+        if args.queue == "sqlite":
+            from persist_queue import AckQueue, PersistQueue
+            queue = AckQueue(PersistQueue)
+        else:
+            queue = MemoryQueue()
+
+        with contextlib.redirect_stdout(devnull):
+            cdc = CDC(log_db=log_db, queue=queue)
+            cdc_start = time.perf_counter()
+            cdc.binlog_processor(iter(stream))
+            cdc_seconds = time.perf_counter() - cdc_start
+
+            if args.sink:
+                dpu = DPU(log_db=log_db, queue=queue, target={"name": None, "type": args.sink})
+            else:
+                dpu = DPU(log_db=log_db, target_db=target_db, queue=queue)
+                register_synthetic_processors(dpu)
+
+            dpu_start = time.perf_counter()
+            # Updates of unchanged (projected) columns are not queued, the queue may hold fewer events than rows
+            queued = queue.qsize()
+            for _ in range(queued):
+                queue_item = dpu._get_queue_item()
+                dpu._handle_process_data(queue_item)
+                if "applied" in queue_item["stage_ts"]:
+                    applied.append(queue_item["stage_ts"])
+            dpu.idle()
+            dpu_seconds = time.perf_counter() - dpu_start
+        stages = stage_summary(applied)
+        end_to_end_seconds = cdc_seconds + dpu_seconds
+
+    results = {
+        "meta": {
+            "dt": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "source": args.capture or f"synthetic:{args.synthetic}x{args.rows_per_event}:{args.tables}",
+            "queue": args.queue,
+            "sink": args.sink,
+        },
+        "rows": rows,
+        "queued": queued,
+        "dead_letters": len(log_db.dpu_dead_letter_query(limit=rows)),
+        "target_statements": dict(target_db.statements),
+        "target_errors": target_db.errors,
+        "cdc": {"seconds": round(cdc_seconds, 3), "events_per_sec": round(rows / cdc_seconds, 1)},
+        "dpu": {"seconds": round(dpu_seconds, 3), "events_per_sec": round(queued / dpu_seconds, 1)},
+        "end_to_end_events_per_sec": round(rows / end_to_end_seconds, 1),
+        "stages": stages,
+    }
+
+    json.dump(results, sys.stdout, indent=2)
+    print()
+    if args.output:
+        Path(args.output).parent.mkdir(exist_ok=True, parents=True)
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,387 @@
+import collections
+import copy
+import datetime
+import pickle
+import re
+import sqlite3
+import threading
+import time
+
+from change_event import QueueSerializer, event_payload
+from field_mappings import field_mappings
+from spill import SpilledDML
+
+
+class SQLiteLogDB:
+    """
+    Stand-in for LogDBConnection backed by SQLite, implements the methods the CDC and DPU call.
+    Rows are serialised like the log MariaDB does, so the pickling cost stays in the measurement.
+    """
+
+    def __init__(self, path: str = ":memory:"):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.target = None
+        self.relationship_cache = {}
+        self.connection.executescript(
+            """create table cdc_log
+            (
+                cdc_id             integer primary key autoincrement,
+                cdc_dt             text    not null,
+                source             text,
+                log_file           text,
+                log_pos            integer not null,
+                row_index          integer,
+                log_dt             text    not null,
+                `table`            text    not null,
+                action             text    not null,
+                dpu_process_status integer default 0,
+                data               blob    not null
+            );
+            create table dpu_log
+            (
+                dpu_id             integer primary key autoincrement,
+                cdc_id             integer not null,
+                dt                 text    not null,
+                target             text,
+                `table`            text    not null,
+                action             text    not null,
+                dml_execute_status integer default 0,
+                dml                blob    not null
+            );
+            create table db_rel
+            (
+                field_define text    not null,
+                old_id       integer not null,
+                new_id       integer not null,
+                primary key (field_define, old_id)
+            ) without rowid;
+            create table cdc_row_key
+            (
+                source    text    not null default '',
+                log_file  text    not null,
+                log_pos   integer not null,
+                row_index integer not null,
+                cdc_id    integer not null,
+                queued    integer not null default 0,
+                primary key (source, log_file, log_pos, row_index)
+            );
+            create table dpu_dead_letter
+            (
+                dlq_id      integer primary key autoincrement,
+                cdc_id      integer not null,
+                dt          text    not null,
+                target      text,
+                `table`     text    not null,
+                action      text    not null,
+                event_key   text    not null,
+                status      text    not null,
+                reason      text    not null,
+                error       text,
+                attempts    integer default 0,
+                resolved_dt text,
+                payload     blob    not null
+            );"""
+        )
+
+    def for_target(self, target: str) -> "SQLiteLogDB":
+        """
+        Connection of a fan-out target sharing the same database, like a LogDBConnection with its target set
+        """
+        log_db = copy.copy(self)
+        log_db.target = target
+        log_db.relationship_cache = {}
+        return log_db
+
+    def relationship_field(self, field_define, source=None) -> str:
+        if source is not None:
+            field_define = f"{source}/{field_define}"
+        return field_define if self.target is None else f"{self.target}:{field_define}"
+
+    def cdc_max_log_pos_query(self, source: str = None) -> tuple:
+        with self.lock:
+            if source is None:
+                result = self.connection.execute(
+                    "select log_file, log_pos from cdc_log order by cdc_id desc limit 1;"
+                ).fetchone()
+            else:
+                result = self.connection.execute(
+                    "select log_file, log_pos from cdc_log where source = ? order by cdc_id desc limit 1;", (source,)
+                ).fetchone()
+        return result if result is not None else (None, None)
+
+    def _cdc_insert(self, event_data: dict) -> int:
+        cursor = self.connection.execute(
+            "insert into cdc_log (cdc_dt, source, log_file, log_pos, row_index, log_dt, `table`, action, data) "
+            "values (?, ?, ?, ?, ?, ?, ?, ?, ?);",
+            (
+                str(event_data["cdc_dt"]),
+                event_data.get("source"),
+                event_data["log_file"],
+                event_data["log_pos"],
+                event_data.get("row_index"),
+                event_data["log_dt"],
+                event_data["table"],
+                event_data["action"],
+                pickle.dumps(event_payload(event_data)),
+            ),
+        )
+        return cursor.lastrowid
+
+    def cdc_processed_execute_insert(self, event_data: dict, retry=0) -> int:
+        key = (event_data.get("source") or "", event_data["log_file"], event_data["log_pos"],
+               event_data.get("row_index"))
+        with self.lock:
+            cdc_id = self._cdc_insert(event_data)
+            if key[3] is not None and not self.connection.execute(
+                    "insert or ignore into cdc_row_key (source, log_file, log_pos, row_index, cdc_id) "
+                    "values (?, ?, ?, ?, ?);", (*key, cdc_id)
+            ).rowcount:
+                # Like the cdc_row_key table of the log MariaDB, the first cdc_log row of a key is kept
+                self.connection.rollback()
+                return self.connection.execute(
+                    "select cdc_id from cdc_row_key where source = ? and log_file = ? and log_pos = ? "
+                    "and row_index = ?;", key
+                ).fetchone()[0]
+            self.connection.commit()
+            return cdc_id
+
+    def cdc_row_keys_query(self, source: str = None, after_cdc_id: int = 0) -> list:
+        with self.lock:
+            return self.connection.execute(
+                "select log_file, log_pos, row_index from cdc_row_key "
+                "where source = ? and cdc_id > ? and queued = 1 order by cdc_id;", (source or "", after_cdc_id or 0)
+            ).fetchall()
+
+    def cdc_row_key_queued(self, event_data: dict, retry=0):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "update cdc_row_key set queued = 1 where source = ? and log_file = ? and log_pos = ? and row_index = ?;",
+                (event_data.get("source") or "", event_data["log_file"], event_data["log_pos"], event_data["row_index"]),
+            )
+
+    def cdc_row_keys_prune(self, source: str = None, log_file: str = None, log_pos: int = None, retry=0):
+        with self.lock, self.connection:
+            return self.connection.execute(
+                "delete from cdc_row_key where source = ? and (log_file < ? or (log_file = ? and log_pos <= ?));",
+                (source or "", log_file, log_file, log_pos),
+            ).rowcount
+
+    def cdc_processed_execute_insert_many(self, events: list, retry=0) -> list:
+        with self.lock, self.connection:
+            return [self._cdc_insert(event_data) for event_data in events]
+
+    def dpu_processed_log_insert(self, raw, dml, retry=0):
+        if dml is None:
+            return None
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                "insert into dpu_log (cdc_id, dt, target, `table`, action, dml) values (?, ?, ?, ?, ?, ?);",
+                (raw["cdc_id"], str(datetime.datetime.now()), self.target, raw["table"], raw["action"],
+                 pickle.dumps(dml)),
+            )
+            self.connection.execute("update cdc_log set dpu_process_status = 1 where cdc_id = ?;", (raw["cdc_id"],))
+            return cursor.lastrowid
+
+    def dpu_after_dml_execute_update(self, dpu_id, executed=True):
+        if executed:
+            with self.lock, self.connection:
+                self.connection.execute("update dpu_log set dml_execute_status = 1 where dpu_id = ?;", (dpu_id,))
+        return True
+
+    def dpu_relationship_query(self, field_define, old_id, source=None):
+        field_define = self.relationship_field(field_define, source)
+        new_id = self.relationship_cache.get((field_define, old_id))
+        if new_id is not None:
+            return new_id
+        with self.lock:
+            result = self.connection.execute(
+                "select new_id from db_rel where field_define = ? and old_id = ?;", (field_define, old_id)
+            ).fetchone()
+        if result is None:
+            return old_id
+        self.relationship_cache[(field_define, old_id)] = result[0]
+        return result[0]
+
+    def dpu_relationship_query_many(self, field_define, old_ids, source=None) -> dict:
+        field_define = self.relationship_field(field_define, source)
+        result = {}
+        with self.lock:
+            for old_id in old_ids:
+                row = self.connection.execute(
+                    "select new_id from db_rel where field_define = ? and old_id = ?;", (field_define, old_id)
+                ).fetchone()
+                if row is not None:
+                    result[old_id] = row[0]
+        return result
+
+    def dpu_relationship_exists(self, field_define, old_id, source=None) -> bool:
+        field_define = self.relationship_field(field_define, source)
+        if (field_define, old_id) in self.relationship_cache:
+            return True
+        with self.lock:
+            return self.connection.execute(
+                "select 1 from db_rel where field_define = ? and old_id = ? limit 1;", (field_define, old_id)
+            ).fetchone() is not None
+
+    def dpu_relationship_create(self, field_define, old_id, new_id, source=None, identical=False, retry=0):
+        if old_id == new_id and not identical and not self.dpu_relationship_exists(field_define, old_id, source):
+            return None
+        if source is not None:
+            field_define = f"{source}/{field_define}"
+        return self.dpu_relationship_create_many([(field_define, old_id, new_id)])
+
+    def dpu_relationship_create_many(self, relationships: list, retry=0) -> int:
+        rows = [(self.relationship_field(field_define), old_id, new_id) for field_define, old_id, new_id in relationships]
+        with self.lock, self.connection:
+            # Affected rows like MariaDB: 1 per created, 2 per replaced and 0 per unchanged relationship
+            existing = dict(
+                ((rel_field, old_id), self.connection.execute(
+                    "select new_id from db_rel where field_define = ? and old_id = ?;", (rel_field, old_id)
+                ).fetchone())
+                for rel_field, old_id, _ in rows
+            )
+            self.connection.executemany(
+                "insert into db_rel (field_define, old_id, new_id) values (?, ?, ?) "
+                "on conflict (field_define, old_id) do update set new_id = excluded.new_id;",
+                rows,
+            )
+        rowcount = 0
+        for rel_field, old_id, new_id in rows:
+            previous = existing[(rel_field, old_id)]
+            rowcount += 1 if previous is None else 2 * (previous[0] != new_id)
+            self.relationship_cache[(rel_field, old_id)] = new_id
+        return rowcount
+
+    def dpu_relationship_export(self, field_define=None, after: tuple = None, limit: int = 10000) -> list:
+        prefix = self.relationship_field("")
+        conditions, params = ["substr(field_define, 1, ?) = ?"], [len(prefix), prefix]
+        if self.target is None:
+            conditions.append("instr(field_define, ':') = 0")
+        if field_define is not None:
+            conditions.append("field_define = ?")
+            params.append(self.relationship_field(field_define))
+        if after is not None:
+            conditions.append("(field_define, old_id) > (?, ?)")
+            params.extend((self.relationship_field(after[0]), after[1]))
+        with self.lock:
+            rows = self.connection.execute(
+                f"select field_define, old_id, new_id from db_rel where {' and '.join(conditions)} "
+                f"order by field_define, old_id limit ?;",
+                (*params, limit),
+            ).fetchall()
+        return [(rel_field[len(prefix):], old_id, new_id) for rel_field, old_id, new_id in rows]
+
+    def dpu_dead_letter_insert(self, raw, event_key, status, reason, error, retry=0):
+        with self.lock, self.connection:
+            return self.connection.execute(
+                "insert into dpu_dead_letter "
+                "(cdc_id, dt, target, `table`, action, event_key, status, reason, error, payload) "
+                "values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);",
+                (raw["cdc_id"], str(datetime.datetime.now()), self.target, raw["table"], raw["action"], event_key,
+                 status, reason, error, QueueSerializer.dumps(raw)),
+            ).lastrowid
+
+    def dpu_dead_letter_open_keys(self) -> set:
+        with self.lock:
+            return set(self.connection.execute(
+                "select distinct `table`, event_key from dpu_dead_letter "
+                "where status in ('dead', 'parked') and target is ?;", (self.target,)
+            ).fetchall())
+
+    def dpu_dead_letter_query(self, table=None, status=None, after_id=None, limit=100) -> list:
+        status = status or ("dead", "parked")
+        sql = (f"select * from dpu_dead_letter where status in ({', '.join('?' * len(status))}) "
+               f"and target is ? and dlq_id > ?")
+        args = [*status, self.target, after_id or 0]
+        if table is not None:
+            sql += " and `table` = ?"
+            args.append(table)
+        with self.lock:
+            cursor = self.connection.execute(f"{sql} order by dlq_id limit ?;", (*args, limit))
+            columns = [column[0] for column in cursor.description]
+            rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        for row in rows:
+            row["payload"] = QueueSerializer.loads(row["payload"])
+        return rows
+
+    def dpu_dead_letter_update(self, dlq_id, status, error=None):
+        resolved_dt = str(datetime.datetime.now()) if status in ("retried", "discarded") else None
+        with self.lock, self.connection:
+            self.connection.execute(
+                "update dpu_dead_letter set status = ?, resolved_dt = ?, attempts = attempts + ?, "
+                "error = coalesce(?, error) where dlq_id = ?;",
+                (status, resolved_dt, int(status != "discarded"), error, dlq_id),
+            )
+
+
+class MemoryQueue:
+    """
+    Stand-in for the persistence queue, keeps the events in memory without serialising them.
+    """
+
+    def __init__(self):
+        self.items = collections.deque()
+
+    def put(self, item):
+        self.items.append(item)
+
+    def get(self):
+        return self.items.popleft()
+
+    def qsize(self) -> int:
+        return len(self.items)
+
+    def ack(self, item):
+        pass
+
+    def oldest_captured(self):
+        if not self.items:
+            return None
+        return (self.items[0].get("stage_ts") or {}).get("captured")
+
+
+class SQLiteTargetDB:
+    """
+    Stand-in for TargetDBConnection backed by SQLite. One table per entry of field_mappings is created,
+    the DML generated by the DPU runs unchanged (SQLite accepts the MySQL backtick quoting it uses).
+    ``latency`` seconds are added to every statement outside the lock, the round trip and commit of a remote target.
+    """
+
+    def __init__(self, path: str = ":memory:", latency: float = 0):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.latency = latency
+        self.statements = collections.Counter()
+        self.errors = 0
+        for table, columns in field_mappings.items():
+            column_defs = ", ".join(f"`{column}`" for column in columns.values() if column != "id")
+            self.connection.execute(f"create table `{table}` (id integer primary key autoincrement, {column_defs});")
+        self.connection.commit()
+
+    def insert_and_update(self, sql, retry=0):
+        if sql is None:
+            return None
+        params = sql.params() if isinstance(sql, SpilledDML) else ()
+        sql = sql.replace("None", "null")
+        if params:
+            # Driver placeholders of the spilled values (%s) and escaped literals (%%) in SQLite syntax
+            sql = re.sub(r"%([%s])", lambda match: "?" if match.group(1) == "s" else "%", sql)
+        statement = sql.split(" ", 1)[0].upper()
+        self.statements[statement] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        try:
+            with self.lock, self.connection:
+                cursor = self.connection.execute(sql, params)
+        except sqlite3.Error:
+            # Like TargetDBConnection after its retries
+            self.errors += 1
+            return None
+        if statement in ("UPDATE", "DELETE"):
+            return cursor.rowcount
+        return cursor.lastrowid
+
+
+if __name__ == "__main__":
+    pass
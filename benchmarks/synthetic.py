@@ -0,0 +1,162 @@
+import atexit
+import datetime
+import decimal
+import os
+import random
+import shutil
+import tempfile
+from pathlib import Path
+
+import yaml
+
+from field_mappings import field_mappings, field_mappings_raw
+
+# Column types of the synthetic tables, the wide table repeats them
+COLUMN_TYPES = ("int", "varchar", "datetime", "decimal", "date", "nullable", "tinyint", "text")
+
+NARROW_TABLE = "bench_narrow"
+NARROW_COLUMNS = 8
+WIDE_TABLE = "bench_wide"
+WIDE_COLUMNS = 200
+
+# Share of the columns that change in a synthetic update
+UPDATE_CHANGED_RATIO = 0.1
+
+
+def prepare_environment() -> Path:
+    """
+    Points utils at a temporary data directory with a minimal config.yml, so no database and no
+    /mysql-dataflowsync_data are needed. Must be called before utils is imported.
+    :return: data directory
+    """
+    if os.getenv("DFS_DATA_PATH"):
+        return Path(os.environ["DFS_DATA_PATH"])
+
+    data_path = Path(tempfile.mkdtemp(prefix="dfs_bench_"))
+    atexit.register(shutil.rmtree, data_path, ignore_errors=True)
+    config = {
+        "project_name": "benchmark",
+        "dml_serialization": True,
+        # The per-event stderr output would dominate the timings, the log files are kept
+        "logging": {"stderr": False},
+        "source_database": {"host": "source", "port": 3306, "user": "root", "passwd": "", "schemas": "bench"},
+        "target_database": {"host": "target", "port": 3306, "user": "root", "passwd": "", "schemas": "bench"},
+    }
+    with open(Path(data_path, "config.yml"), "w") as config_file:
+        yaml.safe_dump(config, config_file)
+    os.environ["DFS_DATA_PATH"] = str(data_path)
+    return data_path
+
+
+def column_type(index: int) -> str:
+    return "id" if index == 0 else COLUMN_TYPES[(index - 1) % len(COLUMN_TYPES)]
+
+
+def register_tables():
+    """
+    Adds the synthetic tables to field_mappings and field_mappings_raw, source and target column names differ
+    like a real mapping.
+    """
+    for table, columns in ((NARROW_TABLE, NARROW_COLUMNS), (WIDE_TABLE, WIDE_COLUMNS)):
+        field_mappings_raw[table] = {i: "id" if i == 0 else f"{column_type(i)}_{i}" for i in range(columns)}
+        field_mappings[table] = {i: "id" if i == 0 else f"target_{column_type(i)}_{i}" for i in range(columns)}
+
+
+def random_value(rng: random.Random, kind: str):
+    """
+    A realistic value of a column type, nullable columns are NULL half of the time
+    """
+    if kind == "id":
+        return rng.randint(1, 10_000_000)
+    if kind == "int":
+        return rng.randint(-2 ** 31, 2 ** 31 - 1)
+    if kind == "tinyint":
+        return rng.randint(0, 1)
+    if kind == "varchar":
+        return "".join(rng.choices("abcdefghijklmnopqrstuvwxyz0123456789 ", k=rng.randint(8, 64)))
+    if kind == "text":
+        return "".join(rng.choices("abcdefghijklmnopqrstuvwxyz ", k=rng.randint(200, 2000)))
+    if kind == "datetime":
+        return datetime.datetime(2024, 1, 1) + datetime.timedelta(seconds=rng.randint(0, 365 * 86400),
+                                                                  microseconds=rng.randint(0, 999999))
+    if kind == "date":
+        return datetime.date(2024, 1, 1) + datetime.timedelta(days=rng.randint(0, 365))
+    if kind == "decimal":
+        return decimal.Decimal(rng.randint(0, 10 ** 8)) / 100
+    if kind == "nullable":
+        return None if rng.random() < 0.5 else rng.randint(0, 1000)
+    raise ValueError(kind)
+
+
+def random_row(rng: random.Random, columns: int) -> dict:
+    """
+    A binlog row as decoded by the CDC, keyed by UNKNOWN_COL{i}
+    """
+    return {f"UNKNOWN_COL{i}": random_value(rng, column_type(i)) for i in range(columns)}
+
+
+def synthetic_event(rng: random.Random, table: str, action: str, cdc_id: int = 1) -> dict:
+    """
+    A raw CDC event of a synthetic table before mapping_data
+    :param rng:
+    :param table: NARROW_TABLE or WIDE_TABLE
+    :param action: insert, update or delete
+    :param cdc_id:
+    :return:
+    """
+    columns = len(field_mappings_raw[table])
+    if action == "update":
+        before_values = random_row(rng, columns)
+        after_values = dict(before_values)
+        for i in rng.sample(range(1, columns), max(1, int(columns * UPDATE_CHANGED_RATIO))):
+            after_values[f"UNKNOWN_COL{i}"] = random_value(rng, column_type(i))
+        data = {"before_values": before_values, "after_values": after_values}
+    else:
+        data = random_row(rng, columns)
+
+    return {
+        "cdc_id": cdc_id,
+        "cdc_dt": datetime.datetime.now(),
+        "log_file": "mysql-bin.000001",
+        "log_pos": 4 + cdc_id * 100,
+        "log_dt": "2024-01-01 00:00:00",
+        "schema": "bench",
+        "table": table,
+        "action": action,
+        "data": data,
+    }
+
+
+def synthetic_change_event(raw_event: dict):
+    """
+    The ChangeEvent the CDC builds from a raw event of synthetic_event
+    :param raw_event:
+    :return:
+    """
+    from change_event import ChangeEvent, convert_value, schema_registry
+
+    table_schema = schema_registry.table_schema(raw_event["table"])
+    data = raw_event["data"]
+    if raw_event["action"] == "update":
+        values = table_schema.binlog_values(data["after_values"])
+        before = table_schema.binlog_values(data["before_values"])
+    else:
+        values = table_schema.binlog_values(data)
+        before = None
+    return ChangeEvent(
+        table_schema,
+        raw_event["action"],
+        values,
+        before=before,
+        cdc_id=raw_event["cdc_id"],
+        cdc_dt=convert_value(raw_event["cdc_dt"]),
+        log_file=raw_event["log_file"],
+        log_pos=raw_event["log_pos"],
+        log_dt=raw_event["log_dt"],
+        schema=raw_event["schema"],
+        stage_ts={"commit": None, "captured": 0.0},
+    )
+
+
+if __name__ == "__main__":
+    pass
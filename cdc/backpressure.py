@@ -0,0 +1,155 @@
+import datetime
+import time
+
+from persist_queue import disk_free, open_queue_reader, queue_paths, queue_usage
+from stats import stats_inc, stats_set
+from utils import QUEUE_PATH
+
+BACKPRESSURE_DEFAULT_CHECK_SECONDS = 1
+# Low watermark as a fraction of the high watermark when only the high watermark is configured
+BACKPRESSURE_DEFAULT_LOW_RATIO = 0.8
+# The CDC reads again once the free space is this multiple of min_free_mb
+BACKPRESSURE_FREE_RESUME_RATIO = 2
+MB = 1024 * 1024
+
+
+def _watermarks(config: dict, name: str, scale: int = 1) -> tuple:
+    """
+    High and low watermark of a measure, (None, None) when it is not configured
+    :param config: backpressure section
+    :param name: "events" or "mb"
+    :param scale: unit of the configured values
+    :return: (high, low)
+    """
+    high = config.get(f"high_watermark_{name}")
+    if high is None:
+        return None, None
+    low = config.get(f"low_watermark_{name}", high * BACKPRESSURE_DEFAULT_LOW_RATIO)
+    return high * scale, low * scale
+
+
+class Backpressure:
+    """
+    Flow control between the CDC and the DPU through the persistence queue. The depth and the size of the queue
+    databases (the shared queue and the fan-out target queues) and the free space of the data volume are sampled,
+    above a high watermark the CDC stops reading the binlog until the queue falls below the low watermark.
+    The binlog connection stays open while the reader is paused, the source keeps it for net_write_timeout.
+
+    Attributes:
+        high_events (int): Queue depth (events of the deepest queue) above which the CDC pauses.
+        low_events (int): Queue depth below which a paused CDC reads again.
+        high_bytes (int): Bytes in use by the queue databases above which the CDC pauses.
+        low_bytes (int): Bytes in use below which a paused CDC reads again.
+        min_free_bytes (int): Free space of the volume (counting the free pages of the queue databases) below which
+            the CDC pauses.
+        check_seconds (float): Interval of sampling the queue.
+        paused (bool): Whether the CDC is paused.
+        throttled_seconds (float): Seconds spent paused since the start.
+        labels (dict): Labels added to the published stats, the source of a named reader.
+
+    Methods:
+        sample(): Reads the queue depth, size and free space and publishes them.
+        check(): Updates the paused state from the latest sample, sampling at most every check_seconds.
+        wait(): Blocks while the CDC is paused.
+    """
+
+    def __init__(self, backpressure_config: dict, queue_path=QUEUE_PATH, labels: dict = None):
+        self.high_events, self.low_events = _watermarks(backpressure_config, "events")
+        self.high_bytes, self.low_bytes = _watermarks(backpressure_config, "mb", MB)
+        min_free_mb = backpressure_config.get("min_free_mb")
+        self.min_free_bytes = None if min_free_mb is None else min_free_mb * MB
+        self.check_seconds = backpressure_config.get("check_seconds", BACKPRESSURE_DEFAULT_CHECK_SECONDS)
+        self.queue_path = queue_path
+        self.labels = labels or {}
+        # queue path -> read-only connection
+        self.connections = {}
+        self.paused = False
+        self.throttled_seconds = 0
+        self.sampled = None
+        self.usage = None
+        stats_set("dfs_cdc_paused", 0, **self.labels)
+
+    def sample(self) -> tuple:
+        """
+        Reads the depth of the deepest queue, the bytes in use by all queue databases and the free space.
+
+        Returns:
+            tuple: (depth, used bytes, free bytes)
+        """
+
+        depth, used, reusable = 0, 0, 0
+        for path in queue_paths(self.queue_path):
+            connection = self.connections.get(path)
+            if connection is None:
+                connection = self.connections[path] = open_queue_reader(path)
+            queue_depth, queue_used, queue_free = queue_usage(connection)
+            depth = max(depth, queue_depth)
+            used += queue_used
+            reusable += queue_free
+        free = disk_free(self.queue_path) + reusable
+
+        self.usage = (depth, used, free)
+        self.sampled = time.monotonic()
+        stats_set("dfs_cdc_queue_depth_events", depth, **self.labels)
+        stats_set("dfs_cdc_queue_size_bytes", used, **self.labels)
+        stats_set("dfs_cdc_queue_free_bytes", free, **self.labels)
+        return self.usage
+
+    def _above_high(self) -> str:
+        depth, used, free = self.usage
+        if self.high_events is not None and depth >= self.high_events:
+            return f"queue depth {depth} events"
+        if self.high_bytes is not None and used >= self.high_bytes:
+            return f"queue size {used // MB} MB"
+        if self.min_free_bytes is not None and free < self.min_free_bytes:
+            return f"free space {free // MB} MB"
+        return None
+
+    def _below_low(self) -> bool:
+        depth, used, free = self.usage
+        return (self.high_events is None or depth <= self.low_events) and \
+            (self.high_bytes is None or used <= self.low_bytes) and \
+            (self.min_free_bytes is None or free >= self.min_free_bytes * BACKPRESSURE_FREE_RESUME_RATIO)
+
+    def check(self) -> bool:
+        """
+        Samples the queue if check_seconds have passed and pauses above a high watermark.
+
+        Returns:
+            bool: Whether the CDC has to pause.
+        """
+
+        if self.sampled is None or time.monotonic() - self.sampled >= self.check_seconds:
+            self.sample()
+        reason = self._above_high()
+        if reason is not None and not self.paused:
+            self.paused = True
+            stats_inc("dfs_cdc_pauses_total", **self.labels)
+            stats_set("dfs_cdc_paused", 1, **self.labels)
+            print(f"{datetime.datetime.now()} | Backpressure: {reason} above the high watermark, binlog reading paused", flush=True)
+        return self.paused
+
+    def wait(self):
+        """
+        Blocks until the queue is below the low watermarks, the time spent is counted as dfs_cdc_throttled_seconds_total.
+        """
+
+        if not self.paused:
+            return
+        started = time.monotonic()
+        previous = started
+        while self.paused:
+            time.sleep(self.check_seconds)
+            now = time.monotonic()
+            self.throttled_seconds += now - previous
+            stats_inc("dfs_cdc_throttled_seconds_total", now - previous, **self.labels)
+            previous = now
+            self.sample()
+            if self._below_low():
+                self.paused = False
+                stats_set("dfs_cdc_paused", 0, **self.labels)
+        print(f"{datetime.datetime.now()} | Backpressure: queue below the low watermark after {time.monotonic() - started:.0f} s, binlog reading resumed", flush=True)
+
+
+if __name__ == "__main__":
+    pass
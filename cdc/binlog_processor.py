@@ -1,25 +1,64 @@
 import datetime
+import os
+import signal
+import sys
+import threading
+import time
+from pathlib import Path
 from time import strftime, localtime
 
 from pymysqlreplication import BinLogStreamReader
 from pymysqlreplication.event import RotateEvent
 from pymysqlreplication.row_event import (
     DeleteRowsEvent,
+    TableMapEvent,
     UpdateRowsEvent,
     WriteRowsEvent,
 )
 
-from persist_queue import PersistQueue
+from cdc.backpressure import Backpressure
+from cdc.capture import CaptureWriter
+from cdc.row_filter import RowFilterError, TableFilter
+from checkpoint import CheckpointFile
+from change_event import ChangeEvent, convert_value, schema_registry
+from persist_queue import EventQueue
+from profiling import profiling_init, span
+from spill import spill_store
+from stats import stats_init, stats_inc, stats_set
 from utils import (
     LogDBConnection,
     config_data,
     log_init,
+    log_event,
     PROJECT_NAME,
-    mapping_data,
     generate_random_server_id,
     LOG_DB_PASSWORD,
+    STATS_PATH,
+    PROJECT_DATA_BASE_PATH,
+    LOG_PATH,
 )
 
+# Interval of saving the binlog position to checkpoints/cdc.json (checkpoints/cdc_<name>.json for a named source)
+CDC_CHECKPOINT_SECONDS = 1
+# Interval of removing the cdc_row_key rows before the checkpointed position, they are not read again
+CDC_ROW_KEY_PRUNE_SECONDS = 60
+# Seconds the source waits for a paused reader before dropping its binlog connection
+CDC_DEFAULT_NET_WRITE_TIMEOUT = 3600
+
+
+def source_configs() -> list:
+    """
+    Source servers read by the CDC, the entries of source_databases or the single source_database (without a name)
+    :return: list of source settings
+    """
+    sources = config_data.get("source_databases")
+    if not sources:
+        return [dict(config_data["source_database"], name=None)]
+    names = [source.get("name") for source in sources]
+    if None in names or len(set(names)) != len(names):
+        raise ValueError("source_databases: every source needs a unique name")
+    return sources
+
 
 class CDC:
     """
@@ -32,21 +71,43 @@ class CDC:
         SOURCE_MYSQL_SETTINGS (dict): Configuration settings for connecting to the source MySQL database.
         SOURCE_MYSQL_SERVER_ID (int): Unique server ID used for the binlog connection.
         SOURCE_MYSQL_ONLY_SCHEMAS (list): List of schemas to monitor in the source database.
+        source (dict): Settings of the source server, an entry of source_databases or the source_database section.
+        source_name (str): Name of the source in source_databases, stored with the events. None for source_database.
+        checkpoint (CheckpointFile): Resume position and the keys of the rows emitted since, None in the pipeline mode.
         LOG_MARIADB_SETTINGS (dict): Configuration settings for connecting to the log MariaDB database.
         log_db (LogDBConnection): Connection object for the log database.
+        queue: Queue the mapped events are put into, the persistence queue (or its priority lanes) by default.
+        capture (CaptureWriter): Records the decoded binlog events when ``capture_file`` is configured.
+        backpressure (Backpressure): Pauses reading while the persistence queue is above its high watermarks,
+            None without a backpressure section or with another queue.
+        table_filter (TableFilter): Tables read from the binlog and row predicates, rows not matching are dropped
+            before they are converted.
         bin_log_file (str): Current binlog file being processed.
+        bin_log_pos (int): Position after the last rows event whose rows are all queued.
+        resume_file (str): Binlog file of resume_pos.
+        resume_pos (int): Position of the first table map event before the latest rows event, reading again from it
+            decodes the rows events that follow.
+        emitted (set): Keys (log_file, log_pos, row_index) of the rows queued since resume_pos, rows read again after
+            a restart or reconnect are dropped before the queue.
+        last_cdc_id (int): cdc_id of the last logged row.
 
     Methods:
-        __init__(): Initializes the CDC instance, sets up logging, establishes database connections, and configures binlog monitoring.
-        start(): Initiates the binlog capture process by determining the starting position and processing events.
+        __init__(log_db=None, queue=None, source=None): Initializes the CDC instance, sets up logging, establishes database connections, and configures binlog monitoring.
+        start(log_file=None, log_pos=None): Initiates the binlog capture process by determining the starting position and processing events.
         binlog_connection(log_file=None, log_pos=None): Establishes a connection to the source database's binlog stream.
         binlog_processor(stream): Processes events from the binlog stream, logs them, and queues them for further processing.
+        close(): Writes the buffered events of the capture file and closes it, saves the checkpoint, on SIGTERM as well.
     """
 
-    def __init__(self):
+    def __init__(self, log_db=None, queue=None, source=None):
         """
         Initializes the CDC instance. Sets up logging, establishes connections to the source and log databases,
         and configures binlog monitoring using the provided configuration settings.
+
+        Args:
+            log_db (optional): Log database connection to use instead of connecting to the log MariaDB.
+            queue (optional): Queue to use instead of the persistence queue.
+            source (dict, optional): Source server to read, the first of source_configs() by default.
         """
 
         print(f"\n\n{datetime.datetime.now()} | ==========DMP SERVER CDC-Unit START==========")
@@ -54,20 +115,26 @@ class CDC:
 
         # Log Initialisation
         self.cdc_logger, _, self.error_logger = log_init()
+        stats_init(Path(STATS_PATH, "cdc.stats"))
+        profiling_init("cdc", LOG_PATH, config_data.get("profiling") or {})
+
+        self.source = source_configs()[0] if source is None else source
+        self.source_name = self.source.get("name")
+        # Stats of the named sources carry a source label
+        self.source_labels = {} if self.source_name is None else {"source": self.source_name}
 
         # Source database connection
         self.SOURCE_MYSQL_SETTINGS = {
-            "host": config_data["source_database"]["host"],
-            "port": config_data["source_database"]["port"],
-            "user": config_data["source_database"]["user"],
-            "passwd": config_data["source_database"]["passwd"],
+            "host": self.source["host"],
+            "port": self.source["port"],
+            "user": self.source["user"],
+            "passwd": self.source["passwd"],
         }
 
-        # If you need to specify a SERVER ID, you can read it from the configuration
-        # self.SOURCE_MYSQL_SERVER_ID = config_data["source_database"]["server_id"]
-
-        self.SOURCE_MYSQL_SERVER_ID = generate_random_server_id()
-        self.SOURCE_MYSQL_ONLY_SCHEMAS = config_data["source_database"]["schemas"]
+        # A fixed SERVER ID can be configured per source (server_id), each binlog connection needs its own
+        self.SOURCE_MYSQL_SERVER_ID = self.source.get("server_id") or generate_random_server_id()
+        schemas = self.source["schemas"]
+        self.SOURCE_MYSQL_ONLY_SCHEMAS = [schemas] if isinstance(schemas, str) else list(schemas)
 
         # Logging database connection
         # If the DPU is running inside a docker container, there is no need to change the following log database connections.
@@ -78,32 +145,98 @@ class CDC:
             "passwd": LOG_DB_PASSWORD,
         }
         # Connect to the log database
-        self.log_db = LogDBConnection(
-            host=self.LOG_MARIADB_SETTINGS["host"],
-            port=self.LOG_MARIADB_SETTINGS["port"],
-            user=self.LOG_MARIADB_SETTINGS["user"],
-            password=self.LOG_MARIADB_SETTINGS["passwd"],
-        )
+        if log_db is None:
+            log_db = LogDBConnection(
+                host=self.LOG_MARIADB_SETTINGS["host"],
+                port=self.LOG_MARIADB_SETTINGS["port"],
+                user=self.LOG_MARIADB_SETTINGS["user"],
+                password=self.LOG_MARIADB_SETTINGS["passwd"],
+            )
+        self.log_db = log_db
 
         print(f"{datetime.datetime.now()} | CDC log database connection successful")
 
+        self.queue = EventQueue if queue is None else queue
+
+        # Flow control on the persistence queue, the binlog connection outlives a pause
+        self.backpressure = None
+        backpressure_config = config_data.get("backpressure")
+        if backpressure_config and queue is None:
+            self.backpressure = Backpressure(backpressure_config, labels=self.source_labels)
+            net_write_timeout = int(backpressure_config.get("net_write_timeout", CDC_DEFAULT_NET_WRITE_TIMEOUT))
+            self.SOURCE_MYSQL_SETTINGS["init_command"] = f"SET SESSION net_write_timeout = {net_write_timeout}"
+
+        # Tables and rows read, the other rows are dropped before any conversion
+        self.table_filter = TableFilter(config_data.get("cdc_filter") or {})
+
+        # Record the decoded binlog events for replaying (benchmarks/replay.py)
+        self.capture = None
+        if config_data.get("capture_file"):
+            capture_path = Path(PROJECT_DATA_BASE_PATH, config_data["capture_file"])
+            if self.source_name is not None:
+                capture_path = capture_path.with_name(f"{capture_path.stem}_{self.source_name}{capture_path.suffix}")
+            self.capture = CaptureWriter(capture_path)
+            print(f"{datetime.datetime.now()} | Binlog events are captured to {self.capture.path}")
+        # SIGTERM closes the CDC, unless the process runs it in a pipeline or a CDCGroup that handles it
+        self.handle_sigterm = True
+
+        # Resume position and duplicate filter, the log database position is used without a checkpoint
+        checkpoint_name = "cdc.json" if self.source_name is None else f"cdc_{self.source_name}.json"
+        self.checkpoint = CheckpointFile(Path(PROJECT_DATA_BASE_PATH, "checkpoints", checkpoint_name))
+        # The first completely queued rows event is checkpointed right away
+        self.checkpoint_saved = 0
+        self.row_keys_pruned = time.monotonic()
+
         # Initialise binlog filename
         self.bin_log_file = None
+        self.bin_log_pos = None
+        self.resume_file = None
+        self.resume_pos = None
+        self.emitted = set()
+        self.last_cdc_id = None
 
-    def start(self):
-        """
-        Initiates the binlog capture process. Determines the starting binlog file and position either from the configuration file or the log database.
-        Begins processing binlog events from the determined position.
+    def start(self, log_file: str = None, log_pos: int = None, emitted: list = None):
         """
+        Initiates the binlog capture process. Determines the starting binlog file and position either from the configuration file,
+        the checkpoint or the log database. Begins processing binlog events from the determined position.
+        Resuming from the checkpoint rebuilds the keys of the rows emitted after its position (from the checkpoint
+        and the rows logged after it), so the rows read again are dropped before the queue.
 
-        # Query the binlog file and its location
-        config_binlog_file = config_data.get("binlog_file")
-        config_binlog_pos = config_data.get("binlog_pos")
+        Args:
+            log_file (str, optional): Binlog file to resume from, e.g. the applied checkpoint of the pipeline mode.
+            log_pos (int, optional): Binlog position to resume from.
+            emitted (list, optional): Keys of the rows already emitted after log_pos (the applied checkpoint of the
+                pipeline mode), log_pos is then a resume position: the rows read again are dropped before the queue.
+        """
 
-        if config_binlog_file is None or config_binlog_pos is None:
+        if self.handle_sigterm and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self._terminate)
+
+        # Query the binlog file and its location, named sources configure it in their source_databases entry
+        location_config = config_data if self.source_name is None else self.source
+        config_binlog_file = location_config.get("binlog_file")
+        config_binlog_pos = location_config.get("binlog_pos")
+        checkpoint = self.checkpoint.load() if self.checkpoint is not None else None
+
+        if log_file is not None and log_pos is not None:
+            _log_file, _log_pos = log_file, log_pos
+            if emitted is not None:
+                self.resume_file, self.resume_pos = log_file, log_pos
+                self.emitted = {tuple(key) for key in emitted}
+            print(f"{datetime.datetime.now()} | Checkpoint location [{_log_file}:{_log_pos}], will resume processing")
+        elif (config_binlog_file is None or config_binlog_pos is None) and checkpoint:
+            _log_file, _log_pos = checkpoint["log_file"], checkpoint["log_pos"]
+            self.resume_file, self.resume_pos = _log_file, _log_pos
+            self.last_cdc_id = checkpoint.get("cdc_id")
+            self.emitted = {tuple(key) for key in checkpoint.get("emitted", [])}
+            # A row is logged, queued, marked as queued in cdc_row_key, then checkpointed. The rows marked after the
+            # checkpoint are not queued again, a row logged but not queued (a crash between the two) is.
+            self.emitted.update(self.log_db.cdc_row_keys_query(self.source_name, self.last_cdc_id))
+            print(f"{datetime.datetime.now()} | Source {self.source_name} checkpoint location [{_log_file}:{_log_pos}], will resume processing, {len(self.emitted)} rows already emitted")
+        elif config_binlog_file is None or config_binlog_pos is None:
 
             # If the binlog file and location are not specified, it is retrieved from the log database
-            query_result = self.log_db.cdc_max_log_pos_query()
+            query_result = self.log_db.cdc_max_log_pos_query(self.source_name)
 
             if query_result is None:
                 _log_file, _log_pos = None, None
@@ -122,10 +255,38 @@ class CDC:
             # Try a binlog connection
             binlog_stream = self.binlog_connection(_log_file, _log_pos)
             self.binlog_processor(binlog_stream)
+        except RowFilterError as e:
+            # Reading the row again fails again: the CDC stops at it, the rows queued before it are checkpointed
+            self.error_logger.critical(e)
+            stats_inc("dfs_cdc_failures_total", reason="row_filter", **self.source_labels)
+            self.close()
+            raise
         except Exception as e:
             self.error_logger.critical(e)
-            # Reconnect
-            self.start()
+            # Reconnect from the table maps of the last rows event (its queued rows are dropped as emitted),
+            # from the last completely queued rows event without table maps
+            if self.resume_pos is not None:
+                self.start(self.resume_file, self.resume_pos)
+            elif self.bin_log_pos is None:
+                self.start()
+            else:
+                self.start(self.bin_log_file, self.bin_log_pos)
+
+    def close(self):
+        """
+        Writes the buffered events of the capture file and closes it, saves the checkpoint with every queued row.
+        """
+
+        if self.capture is not None:
+            self.capture.close()
+            print(f"{datetime.datetime.now()} | Capture closed, {self.capture.events} events recorded", flush=True)
+            self.capture = None
+        if self.checkpoint is not None and (self.resume_pos is not None or self.bin_log_pos is not None):
+            self.save_checkpoint()
+
+    def _terminate(self, *_):
+        self.close()
+        sys.exit(0)
 
     def binlog_connection(self, log_file: str = None, log_pos: int = None):
         """
@@ -144,8 +305,10 @@ class CDC:
             connection_settings=self.SOURCE_MYSQL_SETTINGS,
             server_id=self.SOURCE_MYSQL_SERVER_ID,  # Setting the server_id
             blocking=True,
-            only_events=[DeleteRowsEvent, UpdateRowsEvent, WriteRowsEvent, RotateEvent],
-            only_schemas=[self.SOURCE_MYSQL_ONLY_SCHEMAS],
+            only_events=[DeleteRowsEvent, UpdateRowsEvent, WriteRowsEvent, RotateEvent, TableMapEvent],
+            only_schemas=self.SOURCE_MYSQL_ONLY_SCHEMAS,
+            only_tables=self.table_filter.only_tables,
+            ignored_tables=self.table_filter.ignored_tables,
             resume_stream=True,
             enable_logging=False,
             slave_heartbeat=10,
@@ -167,7 +330,18 @@ class CDC:
 
         print(f"{datetime.datetime.now()} | Source database Binlog stream read in progress...")
 
+        # Start of the table map events read since the last rows event
+        table_maps = None
         for binlog_event in stream:
+            # The table maps of a statement precede its rows events, resuming at the first one decodes them again
+            if isinstance(binlog_event, TableMapEvent):
+                if table_maps is None:
+                    table_maps = (self.bin_log_file, binlog_event.packet.log_pos - binlog_event.packet.event_size)
+                continue
+
+            if self.capture is not None:
+                self.capture.write(binlog_event)
+
             # Binlog rotation event detection
             if isinstance(binlog_event, RotateEvent):
                 # Update binlog filename
@@ -176,56 +350,216 @@ class CDC:
 
             # Get binlog location
             bin_log_pos = binlog_event.packet.log_pos
+            stats_set("dfs_cdc_binlog_position", bin_log_pos, **self.source_labels)
             print(f"{datetime.datetime.now()} | Receiving {self.bin_log_file}:{bin_log_pos}", flush=True)
-            for row in binlog_event.rows:
-                # Constructing an initial dictionary of events
-                event = {
-                    "cdc_id": None,
-                    "cdc_dt": datetime.datetime.now(),
-                    "log_file": self.bin_log_file,
-                    "log_pos": bin_log_pos,
-                    "log_dt": strftime(
-                        "%Y-%m-%d %H:%M:%S", localtime(binlog_event.timestamp)
-                    ),
-                    "schema": binlog_event.schema,
-                    "table": binlog_event.table,
-                }
-
-                # Action judgement
-
-                # DELETE action
-                if isinstance(binlog_event, DeleteRowsEvent):
-                    event["action"] = "delete"
-                    event["data"] = row["values"]
-
-                # UPDATE action
-                elif isinstance(binlog_event, UpdateRowsEvent):
-                    event["action"] = "update"
-                    data = {
-                        "before_values": row["before_values"],
-                        "after_values": row["after_values"],
-                    }
-                    event["data"] = data
-
-                # INSERT action
-                elif isinstance(binlog_event, WriteRowsEvent):
-                    event["action"] = "insert"
-                    event["data"] = row["values"]
-
-                # Field Name Mapping
-                event_mapping = mapping_data(binlog_event.table, event["action"], event)
+            # Action judgement
+            if isinstance(binlog_event, DeleteRowsEvent):
+                action = "delete"
+            elif isinstance(binlog_event, UpdateRowsEvent):
+                action = "update"
+            elif isinstance(binlog_event, WriteRowsEvent):
+                action = "insert"
+            else:
+                continue
+
+            if table_maps is not None:
+                self._resume_at(*table_maps)
+                table_maps = None
+
+            # Rows events of tables the reader does not filter (a replayed stream) are skipped before their rows are decoded
+            if self.table_filter.table_allowed(binlog_event.table):
+                # Column layout of the table, values are kept as tuples in this order (field name mapping)
+                table_schema = schema_registry.table_schema(binlog_event.table, binlog_event.schema)
+                row_predicate = self.table_filter.binlog_predicate(binlog_event.table, binlog_event.schema)
+                rows = binlog_event.rows
+            else:
+                stats_inc("dfs_cdc_events_skipped_total", table=binlog_event.table, reason="table_filter",
+                          **self.source_labels)
+                rows = ()
+            log_dt = strftime("%Y-%m-%d %H:%M:%S", localtime(binlog_event.timestamp))
+
+            for row_index, row in enumerate(rows):
+                # Rows queued before a restart or reconnect are read again from the table maps of their event
+                row_key = (self.bin_log_file, bin_log_pos, row_index)
+                if row_key in self.emitted:
+                    stats_inc(
+                        "dfs_cdc_rows_skipped_total", table=binlog_event.table, reason="duplicate", **self.source_labels
+                    )
+                    continue
+
+                # Row predicates on the decoded values, before the conversion and the spill
+                row_action = action
+                if row_predicate is not None:
+                    row_action = row_predicate(row, action)
+                    if row_action is None:
+                        stats_inc(
+                            "dfs_cdc_rows_skipped_total", table=binlog_event.table, reason="row_filter",
+                            **self.source_labels
+                        )
+                        continue
+
+                # Large values go to side files, the event carries references
+                if row_action == "update":
+                    values = spill_store.spill_values(table_schema.binlog_values(row["after_values"]))
+                    before = spill_store.spill_values(table_schema.binlog_values(row["before_values"]))
+                elif action == "update":
+                    # The row enters the row filter, the target does not have it yet
+                    values = spill_store.spill_values(table_schema.binlog_values(row["after_values"]))
+                    before = None
+                else:
+                    values = spill_store.spill_values(table_schema.binlog_values(row["values"]))
+                    before = None
+
+                event_mapping = ChangeEvent(
+                    table_schema,
+                    row_action,
+                    values,
+                    before=before,
+                    cdc_dt=convert_value(datetime.datetime.now()),
+                    log_file=self.bin_log_file,
+                    log_pos=bin_log_pos,
+                    log_dt=log_dt,
+                    schema=binlog_event.schema,
+                    source=self.source_name,
+                    row_index=row_index,
+                    # Stage timestamps (epoch seconds) used for end-to-end lag tracking
+                    stage_ts={
+                        "commit": binlog_event.timestamp,
+                        "captured": time.time(),
+                    },
+                )
+
+                stats_inc("dfs_cdc_rows_total", table=binlog_event.table, action=row_action, **self.source_labels)
+
+                # Updates of columns dropped by the projection only are neither logged nor queued
+                if event_mapping.unchanged():
+                    stats_inc(
+                        "dfs_cdc_rows_skipped_total", table=binlog_event.table, reason="unchanged", **self.source_labels
+                    )
+                    continue
 
                 # Logging to cdc log database
-                cdc_id = self.log_db.cdc_processed_execute_insert(event_mapping)
+                with span("cdc.log_write"):
+                    cdc_id = self.log_db.cdc_processed_execute_insert(event_mapping)
                 event_mapping["cdc_id"] = cdc_id
 
-                self.cdc_logger.info(event_mapping)
+                with span("cdc.log_file"):
+                    log_event(self.cdc_logger, event_mapping)
 
                 # Add to queue
-                PersistQueue.put(event_mapping)
-
+                event_mapping["stage_ts"]["enqueued"] = time.time()
+                with span("cdc.enqueue"):
+                    self.queue.put(event_mapping)
+                # The duplicate filter of a restart from the checkpoint is rebuilt from the rows marked as queued
+                if self.checkpoint is not None:
+                    with span("cdc.log_write"):
+                        self.log_db.cdc_row_key_queued(event_mapping)
+                self.emitted.add(row_key)
+                self.last_cdc_id = cdc_id
+
+            self.bin_log_pos = bin_log_pos
+            if self.checkpoint is not None and time.monotonic() - self.checkpoint_saved >= CDC_CHECKPOINT_SECONDS:
+                self.save_checkpoint()
             print(f"{datetime.datetime.now()} | Receiving Completion {self.bin_log_file}:{bin_log_pos}", flush=True)
 
+            # Pause between binlog events while the queue is above its high watermarks
+            if self.backpressure is not None and self.backpressure.check():
+                if self.checkpoint is not None:
+                    self.save_checkpoint()
+                self.backpressure.wait()
+
+    def _resume_at(self, log_file: str, log_pos: int):
+        """
+        Moves the resume position to the table maps of the next rows event, keys of rows before it are dropped.
+        """
+
+        self.resume_file, self.resume_pos = log_file, log_pos
+        # Binlog file names sort in order, a key holds the position after its rows event
+        self.emitted = {key for key in self.emitted if (key[0], key[1]) > (log_file, log_pos)}
+
+    def save_checkpoint(self):
+        """
+        Saves the resume position, the keys of the rows emitted since and the last logged cdc_id.
+        Without table maps (a replayed stream) the position after the last completely queued rows event is saved.
+        The row keys before the saved position are removed from cdc_row_key every CDC_ROW_KEY_PRUNE_SECONDS.
+        """
+
+        if self.resume_pos is not None:
+            log_file, log_pos = self.resume_file, self.resume_pos
+        else:
+            log_file, log_pos = self.bin_log_file, self.bin_log_pos
+            # The rows events up to the saved position are not read again
+            self.emitted = {key for key in self.emitted if (key[0], key[1]) > (log_file, log_pos)}
+        self.checkpoint.save({
+            "source": self.source_name,
+            "log_file": log_file,
+            "log_pos": log_pos,
+            "cdc_id": self.last_cdc_id,
+            "emitted": sorted(self.emitted),
+        })
+        self.checkpoint_saved = time.monotonic()
+        if time.monotonic() - self.row_keys_pruned >= CDC_ROW_KEY_PRUNE_SECONDS:
+            self.log_db.cdc_row_keys_prune(self.source_name, log_file, log_pos)
+            self.row_keys_pruned = time.monotonic()
+
+
+class CDCGroup:
+    """
+    The CDCGroup class reads the servers of source_databases in one process, one CDC reader thread per source.
+    Every reader has its own binlog connection, log database connection and checkpoint, all of them put their
+    events into the shared persistence queue.
+
+    Attributes:
+        readers (list): CDC instance of each source.
+        failed (Exception): Error that stopped a reader, None while they run.
+
+    Methods:
+        start(): Starts a reader thread per source and waits for them.
+    """
+
+    def __init__(self, queue=None):
+        """
+        Args:
+            queue (optional): Queue to use instead of the persistence queue.
+        """
+
+        self.readers = [CDC(queue=queue, source=source) for source in source_configs()]
+        for reader in self.readers:
+            reader.handle_sigterm = False
+        # Error that stopped a reader, the process exits with it
+        self.failed = None
+
+    def start(self):
+        """
+        Starts the reader threads, a reader reconnects on its own after an error of its source.
+        """
+
+        signal.signal(signal.SIGTERM, self._terminate)
+        threads = [
+            threading.Thread(target=self._read, args=(reader,), name=f"cdc-{reader.source_name}", daemon=True)
+            for reader in self.readers
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def _read(self, reader):
+        """
+        Reader thread, an error the reader does not reconnect on (a row the row filter fails on) stops every reader
+        """
+
+        try:
+            reader.start()
+        except Exception as e:
+            self.failed = e
+            os.kill(os.getpid(), signal.SIGTERM)
+
+    def _terminate(self, *_):
+        for reader in self.readers:
+            reader.close()
+        sys.exit(1 if self.failed is not None else 0)
+
 
 if __name__ == "__main__":
     pass
@@ -0,0 +1,177 @@
+import gzip
+import pickle
+import types
+from pathlib import Path
+
+from pymysqlreplication.event import RotateEvent
+from pymysqlreplication.row_event import (
+    DeleteRowsEvent,
+    UpdateRowsEvent,
+    WriteRowsEvent,
+)
+
+# Capture file: gzip stream of pickled records, one per binlog event
+#   ("rotate", next_binlog, position)
+#   (action, schema, table, timestamp, log_pos, columns, rows)
+# Rows are tuples in ``columns`` order, update rows are (before tuple, after tuple).
+CAPTURE_ROTATE = "rotate"
+CAPTURE_ACTIONS = {
+    WriteRowsEvent: "insert",
+    UpdateRowsEvent: "update",
+    DeleteRowsEvent: "delete",
+}
+# The gzip stream is flushed every N events, so a running capture can be read
+CAPTURE_FLUSH_EVENTS = 1000
+
+
+class CaptureWriter:
+    """
+    Records the decoded binlog events read by the CDC to a compact local file, which can be replayed
+    without a source database (see benchmarks/replay.py).
+
+    Attributes:
+        path (Path): Capture file path.
+        events (int): Number of events recorded.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        self._file = gzip.open(self.path, "ab")
+        self.events = 0
+
+    def write(self, binlog_event):
+        """
+        Records one binlog event as decoded, before the projection and type conversion of its rows.
+
+        Args:
+            binlog_event: RotateEvent or rows event read from the binlog stream.
+        """
+
+        if isinstance(binlog_event, RotateEvent):
+            record = (CAPTURE_ROTATE, binlog_event.next_binlog, binlog_event.position)
+        else:
+            action = next(
+                action for event_class, action in CAPTURE_ACTIONS.items() if isinstance(binlog_event, event_class)
+            )
+            rows = binlog_event.rows
+            if action == "update":
+                columns = tuple(rows[0]["after_values"]) if rows else ()
+                packed = [
+                    (tuple(row["before_values"].values()), tuple(row["after_values"].values())) for row in rows
+                ]
+            else:
+                columns = tuple(rows[0]["values"]) if rows else ()
+                packed = [tuple(row["values"].values()) for row in rows]
+            record = (
+                action,
+                binlog_event.schema,
+                binlog_event.table,
+                binlog_event.timestamp,
+                binlog_event.packet.log_pos,
+                columns,
+                packed,
+            )
+
+        pickle.dump(record, self._file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.events += 1
+        if self.events % CAPTURE_FLUSH_EVENTS == 0:
+            self.flush()
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class _ReplayRowsEvent:
+    """
+    Rows event rebuilt from a capture record, carries the attributes the CDC reads from a decoded binlog event.
+    """
+
+    def __init__(self, schema, table, timestamp, log_pos, rows):
+        self.schema = schema
+        self.table = table
+        self.timestamp = timestamp
+        self.packet = types.SimpleNamespace(log_pos=log_pos)
+        self._rows = rows
+
+    @property
+    def rows(self):
+        return self._rows
+
+
+class ReplayWriteRowsEvent(_ReplayRowsEvent, WriteRowsEvent):
+    pass
+
+
+class ReplayUpdateRowsEvent(_ReplayRowsEvent, UpdateRowsEvent):
+    pass
+
+
+class ReplayDeleteRowsEvent(_ReplayRowsEvent, DeleteRowsEvent):
+    pass
+
+
+class ReplayRotateEvent(RotateEvent):
+    def __init__(self, next_binlog, position):
+        self.next_binlog = next_binlog
+        self.position = position
+
+
+REPLAY_EVENT_CLASSES = {
+    "insert": ReplayWriteRowsEvent,
+    "update": ReplayUpdateRowsEvent,
+    "delete": ReplayDeleteRowsEvent,
+}
+
+
+def replay_event(record: tuple):
+    """
+    Rebuilds a binlog event from a capture record.
+
+    Args:
+        record (tuple): Capture record as written by ``CaptureWriter``.
+
+    Returns:
+        Event that passes the ``isinstance`` checks of ``CDC.binlog_processor``.
+    """
+
+    if record[0] == CAPTURE_ROTATE:
+        return ReplayRotateEvent(record[1], record[2])
+
+    action, schema, table, timestamp, log_pos, columns, packed = record
+    if action == "update":
+        rows = [
+            {"before_values": dict(zip(columns, before)), "after_values": dict(zip(columns, after))}
+            for before, after in packed
+        ]
+    else:
+        rows = [{"values": dict(zip(columns, values))} for values in packed]
+    return REPLAY_EVENT_CLASSES[action](schema, table, timestamp, log_pos, rows)
+
+
+def read_capture(path: Path):
+    """
+    Reads the records of a capture file.
+
+    Args:
+        path (Path): Capture file path.
+
+    Yields:
+        tuple: Capture records in recorded order.
+    """
+
+    with gzip.open(path, "rb") as capture_file:
+        while True:
+            try:
+                record = pickle.load(capture_file)
+            except (EOFError, pickle.UnpicklingError):
+                # End of file, or the unflushed tail of a capture that is still running
+                return
+            yield record
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,238 @@
+import datetime
+import decimal
+import operator
+
+from change_event import mapping_key
+from field_mappings import field_mappings_raw
+from utils import processed_tables
+
+# Types of the configured values: the decoded binlog values of integer, decimal, string and temporal columns
+ROW_FILTER_VALUE_TYPES = (int, float, decimal.Decimal, str, bytes, datetime.datetime)
+# Kinds of the values compared with each other, a row value of another kind than the configured values is an error
+ROW_FILTER_KINDS = {
+    int: "number",
+    float: "number",
+    decimal.Decimal: "number",
+    str: "string",
+    bytes: "bytes",
+    datetime.datetime: "datetime",
+    datetime.date: "datetime",
+}
+
+
+class RowFilterError(ValueError):
+    """
+    A row value the predicates of its column cannot be evaluated on, it stops the CDC instead of a reconnect
+    """
+
+
+def _value(value):
+    """
+    DATE columns decode as date, YAML dates load as date: both compare as midnight with the datetimes
+    """
+    if type(value) is datetime.date:
+        return datetime.datetime.combine(value, datetime.time())
+    return value
+
+
+def _compare(compare):
+    def test(value, argument):
+        # NULL matches no comparison, like in SQL
+        if value is None:
+            return False
+        return compare(value, argument)
+
+    return test
+
+
+def _typed(name: str, test, kinds: set, column: str):
+    """
+    Operator test checking the kind of the row value first, every operator raises RowFilterError
+    for a value of another kind than its configured values (a string compared with integers)
+    """
+
+    def typed(value, argument):
+        if value is not None and ROW_FILTER_KINDS.get(type(value)) not in kinds:
+            raise RowFilterError(
+                f"cdc_filter.row_filters: {name} of {column} compares {'/'.join(sorted(kinds))} values, "
+                f"not the value {value!r} of the row"
+            )
+        return test(_value(value), argument)
+
+    return typed
+
+
+# Operators of the row predicates, applied to the decoded binlog value (before convert_value) and the configured value
+ROW_FILTER_OPERATORS = {
+    "in": lambda value, argument: value in argument,
+    "not_in": lambda value, argument: value not in argument,
+    "eq": _compare(operator.eq),
+    "ne": _compare(operator.ne),
+    "lt": _compare(operator.lt),
+    "lte": _compare(operator.le),
+    "gt": _compare(operator.gt),
+    "gte": _compare(operator.ge),
+    "is_null": lambda value, argument: (value is None) == bool(argument),
+}
+
+
+class TableFilter:
+    """
+    Tables and rows read by the CDC (cdc_filter in config.yml). The table lists are passed to the binlog reader,
+    rows events of other tables are skipped without decoding their rows. Row predicates are evaluated on the decoded
+    binlog values before they are converted, mapped, logged and queued, rows not matching are dropped.
+    The snapshot copies the same tables and rows.
+
+    Attributes:
+        only_tables (list): Tables read, None for all tables of the schemas.
+        ignored_tables (list): Tables not read, None if not configured.
+        predicates (dict): Per table (or "schema.table"), source column: {operator: value}, all conditions must match.
+
+    Methods:
+        table_allowed(table): Whether the rows of a table are read.
+        binlog_predicate(table, schema): Action of a decoded binlog row, None for a table without predicates.
+        source_predicate(table, schema): Test of a source row in column ordinal order, None without predicates.
+    """
+
+    def __init__(self, filter_config: dict):
+        only_tables = filter_config.get("only_tables")
+        if filter_config.get("processed_tables_only"):
+            processed = processed_tables()
+            only_tables = sorted(processed if only_tables is None else processed & set(only_tables))
+        self.only_tables = list(only_tables) if only_tables is not None else None
+        ignored_tables = filter_config.get("ignored_tables")
+        self.ignored_tables = list(ignored_tables) if ignored_tables else None
+        self._only = None if self.only_tables is None else set(self.only_tables)
+        self._ignored = set(self.ignored_tables or ())
+
+        self.predicates = filter_config.get("row_filters") or {}
+        # (table, schema) -> compiled conditions, binlog row test
+        self._compiled = {}
+        self._binlog_predicates = {}
+        # Predicates are checked when the CDC starts
+        for key in self.predicates:
+            schema, _, table = key.rpartition(".")
+            self._conditions(table, schema or None)
+
+    def table_allowed(self, table: str) -> bool:
+        return (self._only is None or table in self._only) and table not in self._ignored
+
+    def _conditions(self, table: str, schema: str = None):
+        """
+        (ordinal, test, value) of the predicates of a table, ordinals of the layout of the schema
+        """
+        cache_key = (table, schema)
+        if cache_key in self._compiled:
+            return self._compiled[cache_key]
+
+        predicates = self.predicates.get(f"{schema}.{table}") or self.predicates.get(table)
+        conditions = None
+        if predicates:
+            layout_key = mapping_key(table, schema)
+            if layout_key not in field_mappings_raw:
+                raise ValueError(f"cdc_filter.row_filters: {layout_key} is not in field_mappings_raw")
+            ordinals = {column: i for i, column in field_mappings_raw[layout_key].items()}
+            conditions = []
+            for column, tests in predicates.items():
+                if column not in ordinals:
+                    raise ValueError(f"cdc_filter.row_filters: unknown column {column} of {layout_key}")
+                for name, value in tests.items():
+                    if name not in ROW_FILTER_OPERATORS:
+                        raise ValueError(f"cdc_filter.row_filters: unknown operator {name} of {layout_key}.{column}")
+                    value = self._operand(name, value, f"{layout_key}.{column}")
+                    test = ROW_FILTER_OPERATORS[name]
+                    if name != "is_null":
+                        values = value if name in ("in", "not_in") else [value]
+                        kinds = {ROW_FILTER_KINDS[type(item)] for item in values}
+                        test = _typed(name, test, kinds, f"{layout_key}.{column}")
+                    conditions.append((ordinals[column], test, value))
+        self._compiled[cache_key] = conditions
+        return conditions
+
+    @staticmethod
+    def _operand(name: str, value, column: str):
+        """
+        Checks the configured value of an operator, dates are compared as datetimes at midnight
+        :param name: operator
+        :param value: configured value
+        :param column: "table.column" of the error messages
+        :return: value of the compiled condition
+        """
+        if name == "is_null":
+            if not isinstance(value, bool):
+                raise ValueError(f"cdc_filter.row_filters: is_null of {column} takes true or false, not {value!r}")
+            return value
+        values = value if name in ("in", "not_in") else [value]
+        if name in ("in", "not_in") and not isinstance(value, (list, tuple, set)):
+            raise ValueError(f"cdc_filter.row_filters: {name} of {column} takes a list, not {value!r}")
+        for item in values:
+            if isinstance(item, bool) or not isinstance(_value(item), ROW_FILTER_VALUE_TYPES):
+                raise ValueError(
+                    f"cdc_filter.row_filters: {name} of {column} compares integers, decimals, strings or datetimes, "
+                    f"not {item!r}"
+                )
+            if isinstance(item, datetime.datetime) and item.tzinfo is not None:
+                raise ValueError(
+                    f"cdc_filter.row_filters: {name} of {column}: the binlog datetimes have no time zone, {item!r} has"
+                )
+        if name in ("in", "not_in"):
+            return frozenset(_value(item) for item in values)
+        return _value(value)
+
+    def binlog_predicate(self, table: str, schema: str = None):
+        """
+        Test of a decoded binlog row (UNKNOWN_COL{i} keys) returning the action the row is queued with, None if it is
+        dropped. An update of a row entering the filter (only its row after the change matches) is queued as an insert,
+        the target does not have the row. A row leaving the filter (only its row before the change matches) is still
+        updated in the target.
+        :param table:
+        :param schema:
+        :return: callable taking the row and the action of a rows event, None for a table without predicates
+        """
+        cache_key = (table, schema)
+        if cache_key in self._binlog_predicates:
+            return self._binlog_predicates[cache_key]
+        conditions = self._conditions(table, schema)
+        if conditions is None:
+            self._binlog_predicates[cache_key] = None
+            return None
+        conditions = [(f"UNKNOWN_COL{ordinal}", test, value) for ordinal, test, value in conditions]
+
+        def matches(values: dict) -> bool:
+            for key, test, value in conditions:
+                if not test(values.get(key), value):
+                    return False
+            return True
+
+        def predicate(row: dict, action: str):
+            if "values" in row:
+                return action if matches(row["values"]) else None
+            if matches(row["before_values"]):
+                return action
+            return "insert" if matches(row["after_values"]) else None
+
+        self._binlog_predicates[cache_key] = predicate
+        return predicate
+
+    def source_predicate(self, table: str, schema: str = None):
+        """
+        Test of a source row in column ordinal order (a ``select *`` result)
+        :param table:
+        :param schema:
+        :return: callable taking the row, None for a table without predicates
+        """
+        conditions = self._conditions(table, schema)
+        if conditions is None:
+            return None
+
+        def predicate(row) -> bool:
+            for ordinal, test, value in conditions:
+                if not test(row[ordinal], value):
+                    return False
+            return True
+
+        return predicate
+
+
+if __name__ == "__main__":
+    pass
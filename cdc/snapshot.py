@@ -0,0 +1,412 @@
+import datetime
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+from pathlib import Path
+
+import pymysql
+import pymysql.cursors
+
+from cdc.row_filter import TableFilter
+from checkpoint import CheckpointFile
+from change_event import ChangeEvent, convert_value, schema_registry
+from field_mappings import field_mappings_raw
+from persist_queue import put_many
+from spill import spill_store
+from stats import stats_init, stats_inc
+from utils import (
+    LogDBConnection,
+    config_data,
+    log_init,
+    PROJECT_NAME,
+    query_primary_key,
+    LOG_DB_PASSWORD,
+    STATS_PATH,
+    PROJECT_DATA_BASE_PATH,
+)
+
+SNAPSHOT_DEFAULT_WORKERS = 4
+SNAPSHOT_DEFAULT_CHUNK_SIZE = 5000
+
+
+class Snapshot:
+    """
+    The Snapshot class bootstraps a new target by copying the configured tables of the source database.
+    It records the current binlog position, splits every table into primary-key-range chunks and copies them in parallel.
+    The position is read under a global read lock while every worker connection opens a consistent-snapshot
+    transaction, so all chunks are read at exactly that position (the source user needs the RELOAD privilege).
+    Copied rows are turned into ``insert`` events, logged to cdc_log and put into the persistence queue, so they run
+    through the same DPU table processors as the binlog stream.
+
+    All snapshot events carry the recorded binlog position. When the copy is done the CDC checkpoint
+    (checkpoints/cdc.json) is replaced with that position, so the CDC resumes there instead of an older checkpoint.
+    Changes made while the copy was running are not in the snapshot, the CDC replays them after the copied rows.
+
+    Note: the CDC must not be running while the snapshot is taken.
+
+    Attributes:
+        cdc_logger (Logger): Logger instance for general CDC logging.
+        error_logger (Logger): Logger instance for capturing errors.
+        SOURCE_MYSQL_SETTINGS (dict): Configuration settings for connecting to the source MySQL database.
+        SOURCE_MYSQL_SCHEMAS (str): Schema to copy from the source database.
+        LOG_MARIADB_SETTINGS (dict): Configuration settings for connecting to the log MariaDB database.
+        tables (list): Tables to copy, the tables read by the CDC (cdc_filter).
+        table_filter (TableFilter): Tables and row predicates of the CDC, rows not matching are not copied.
+        workers (int): Number of chunks copied in parallel.
+        chunk_size (int): Number of rows per chunk.
+
+    Methods:
+        start(): Records the binlog position and copies all tables.
+        open_snapshot(): Opens the consistent-snapshot worker connections and records their binlog position.
+        binlog_position(connection): Queries the current binlog file and position of the source database.
+        table_chunks(table): Splits a table into primary-key-range chunks.
+        copy_chunk(chunk): Copies one chunk into cdc_log and the persistence queue.
+        save_checkpoint(): Replaces the CDC checkpoint with the recorded binlog position.
+    """
+
+    def __init__(self):
+        """
+        Initializes the Snapshot instance with the source and log database settings and the snapshot configuration.
+        """
+
+        print(f"\n\n{datetime.datetime.now()} | ==========DMP SERVER CDC-Snapshot START==========")
+        print(f"{datetime.datetime.now()} | Project: {PROJECT_NAME}")
+
+        self.cdc_logger, _, self.error_logger = log_init()
+        stats_init(Path(STATS_PATH, "snapshot.stats"))
+
+        self.SOURCE_MYSQL_SETTINGS = {
+            "host": config_data["source_database"]["host"],
+            "port": config_data["source_database"]["port"],
+            "user": config_data["source_database"]["user"],
+            "passwd": config_data["source_database"]["passwd"],
+        }
+        self.SOURCE_MYSQL_SCHEMAS = config_data["source_database"]["schemas"]
+
+        # If the snapshot is running inside a docker container, there is no need to change the following log database connections.
+        self.LOG_MARIADB_SETTINGS = {
+            "host": "db",
+            "port": 3306,
+            "user": "root",
+            "passwd": LOG_DB_PASSWORD,
+        }
+
+        snapshot_config = config_data.get("snapshot") or {}
+        # The target receives the same tables and rows from the snapshot as from the CDC
+        self.table_filter = TableFilter(config_data.get("cdc_filter") or {})
+        self.tables = [
+            table for table in snapshot_config.get("tables") or list(field_mappings_raw.keys())
+            if self.table_filter.table_allowed(table)
+        ]
+        self.workers = snapshot_config.get("workers", SNAPSHOT_DEFAULT_WORKERS)
+        self.chunk_size = snapshot_config.get("chunk_size", SNAPSHOT_DEFAULT_CHUNK_SIZE)
+
+        self.log_file = None
+        self.log_pos = None
+        self.log_dt = None
+        # Last cdc_id of the copied rows, the CDC rebuilds its duplicate filter from the rows logged after it
+        self.last_cdc_id = None
+
+        # Every worker thread keeps its own log database connection
+        self._local = threading.local()
+        # Source connections in a consistent-snapshot transaction at the recorded position, one per worker
+        self._connections = queue.Queue()
+
+        # Mapped batches handed from the worker threads to the main thread, which owns the queue connection
+        self._batches = queue.Queue(maxsize=self.workers * 2)
+        self._aborted = threading.Event()
+
+    def _source_connection(self, cursorclass=pymysql.cursors.Cursor):
+        """
+        Opens a connection to the source database.
+
+        Args:
+            cursorclass: PyMySQL cursor class, use ``SSCursor`` to stream large results.
+
+        Returns:
+            pymysql.connections.Connection: Connection to the source database.
+        """
+
+        return pymysql.connect(
+            host=self.SOURCE_MYSQL_SETTINGS["host"],
+            port=self.SOURCE_MYSQL_SETTINGS["port"],
+            user=self.SOURCE_MYSQL_SETTINGS["user"],
+            password=self.SOURCE_MYSQL_SETTINGS["passwd"],
+            database=self.SOURCE_MYSQL_SCHEMAS,
+            cursorclass=cursorclass,
+        )
+
+    def _thread_log_db(self) -> LogDBConnection:
+        """
+        Returns the log database connection of the current worker thread.
+        """
+
+        if getattr(self._local, "log_db", None) is None:
+            self._local.log_db = LogDBConnection(
+                host=self.LOG_MARIADB_SETTINGS["host"],
+                port=self.LOG_MARIADB_SETTINGS["port"],
+                user=self.LOG_MARIADB_SETTINGS["user"],
+                password=self.LOG_MARIADB_SETTINGS["passwd"],
+            )
+        return self._local.log_db
+
+    def start(self):
+        """
+        Records the current binlog position and copies all configured tables in parallel chunks.
+        """
+
+        try:
+            self.open_snapshot()
+            self.log_dt = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            print(f"{datetime.datetime.now()} | Snapshot binlog position recorded [{self.log_file}:{self.log_pos}]")
+
+            chunks = []
+            for table in self.tables:
+                table_chunks = self.table_chunks(table)
+                print(f"{datetime.datetime.now()} | Snapshot table {table}: {len(table_chunks)} chunk(s)")
+                chunks.extend(table_chunks)
+
+            copied = self._copy(chunks)
+        finally:
+            while not self._connections.empty():
+                self._connections.get().close()
+
+        print(f"{datetime.datetime.now()} | Snapshot completed, {copied} rows copied")
+        self.save_checkpoint()
+        if config_data.get("binlog_file") is not None and config_data.get("binlog_pos") is not None:
+            print(
+                f"{datetime.datetime.now()} | binlog_file and binlog_pos of config.yml take precedence over the "
+                f"checkpoint, remove them before starting the CDC"
+            )
+        print(f"{datetime.datetime.now()} | CDC will resume from [{self.log_file}:{self.log_pos}]")
+
+    def save_checkpoint(self):
+        """
+        Replaces the CDC checkpoint with the recorded binlog position, no row after it is emitted yet.
+        An older checkpoint would resume the CDC at its own position instead.
+        """
+
+        CheckpointFile(Path(PROJECT_DATA_BASE_PATH, "checkpoints", "cdc.json")).save({
+            "source": None,
+            "log_file": self.log_file,
+            "log_pos": self.log_pos,
+            "cdc_id": self.last_cdc_id,
+            "emitted": [],
+        })
+
+    def _copy(self, chunks: list) -> int:
+        """
+        Copies the chunks in parallel and puts the mapped batches into the persistence queue.
+
+        Returns:
+            int: Number of rows copied.
+        """
+
+        copied = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = {executor.submit(self.copy_chunk, chunk): chunk for chunk in chunks}
+            while pending or not self._batches.empty():
+                # Drain mapped batches into the persistence queue
+                try:
+                    batch = self._batches.get(timeout=0.1)
+                    for event in batch:
+                        event["stage_ts"]["enqueued"] = time.time()
+                    put_many(batch)
+                    self.last_cdc_id = max(self.last_cdc_id or 0, max(event["cdc_id"] for event in batch))
+                except queue.Empty:
+                    pass
+
+                done, _ = wait(list(pending), timeout=0, return_when=FIRST_EXCEPTION)
+                for future in done:
+                    table, _, lower, upper = pending.pop(future)
+                    try:
+                        rows = future.result()
+                    except Exception as e:
+                        self.error_logger.critical(f"Snapshot chunk {table} [{lower}, {upper}) failed: {e}")
+                        self._aborted.set()
+                        for other in pending:
+                            other.cancel()
+                        raise
+                    copied += rows
+                    stats_inc("dfs_snapshot_rows_total", rows, table=table)
+                    print(f"{datetime.datetime.now()} | Snapshot chunk {table} [{lower}, {upper}) copied {rows} rows", flush=True)
+        return copied
+
+    def open_snapshot(self):
+        """
+        Opens a source connection per worker in a consistent-snapshot transaction and records the binlog position
+        of these snapshots. Writes are blocked by a global read lock until every transaction is started, so the
+        position read under the lock is the position of the snapshots.
+        """
+
+        lock_connection = self._source_connection()
+        try:
+            with lock_connection.cursor() as cursor:
+                cursor.execute("flush tables with read lock;")
+            try:
+                for _ in range(self.workers):
+                    connection = self._source_connection(pymysql.cursors.SSCursor)
+                    with connection.cursor() as cursor:
+                        cursor.execute("set session transaction isolation level repeatable read;")
+                        cursor.execute("start transaction with consistent snapshot;")
+                    self._connections.put(connection)
+                self.log_file, self.log_pos = self.binlog_position(lock_connection)
+            finally:
+                with lock_connection.cursor() as cursor:
+                    cursor.execute("unlock tables;")
+        finally:
+            lock_connection.close()
+
+    def binlog_position(self, connection) -> tuple:
+        """
+        Queries the current binlog file and position of the source database.
+
+        Args:
+            connection: Source connection, holding the global read lock while the snapshots are opened.
+
+        Returns:
+            tuple: (log_file, log_pos)
+        """
+
+        with connection.cursor() as cursor:
+            cursor.execute("show master status;")
+            result = cursor.fetchone()
+
+        if result is None:
+            raise RuntimeError("Binlog is not enabled on the source database")
+
+        return result[0], result[1]
+
+    def table_chunks(self, table: str) -> list:
+        """
+        Splits a table into primary-key-range chunks of ``chunk_size`` rows. The bounds are walked on the primary key
+        index (keyset: the ``chunk_size``-th key after the previous bound), so sparse keys make no empty chunks.
+        Tables without a single integer primary key are copied as one chunk.
+
+        Args:
+            table (str): Table name.
+
+        Returns:
+            list: List of (table, primary_key, lower, upper) tuples, ``lower`` inclusive and ``upper`` exclusive,
+            ``upper`` is None for the last chunk.
+        """
+
+        # The bounds are read in a snapshot transaction, rows inserted later are replayed from the binlog
+        connection = self._connections.get()
+        try:
+            primary_key = query_primary_key(connection, self.SOURCE_MYSQL_SCHEMAS, table)
+            if len(primary_key) != 1 or "int" not in primary_key[0][1]:
+                return [(table, None, None, None)]
+            key = primary_key[0][0]
+
+            bounds = []
+            with connection.cursor() as cursor:
+                cursor.execute(f"select min(`{key}`) from `{table}`;")
+                lower = cursor.fetchone()[0]
+                while lower is not None:
+                    bounds.append(lower)
+                    cursor.execute(
+                        f"select `{key}` from `{table}` where `{key}` > %s order by `{key}` limit %s, 1;",
+                        (lower, self.chunk_size - 1),
+                    )
+                    row = cursor.fetchone()
+                    lower = row[0] if row is not None else None
+        finally:
+            self._connections.put(connection)
+
+        return [(table, key, lower, upper) for lower, upper in zip(bounds, bounds[1:] + [None])]
+
+    def copy_chunk(self, chunk: tuple) -> int:
+        """
+        Copies one chunk of a table. Rows are streamed from the source, mapped like binlog rows, logged to cdc_log and
+        put into the persistence queue in batches of ``chunk_size``.
+
+        Args:
+            chunk (tuple): (table, primary_key, lower, upper) as returned by ``table_chunks``.
+
+        Returns:
+            int: Number of rows copied, rows not matching the row predicates are left out.
+        """
+
+        table, primary_key, lower, upper = chunk
+        log_db = self._thread_log_db()
+        # One snapshot connection per worker thread, all read at the recorded binlog position
+        connection = self._connections.get()
+
+        copied = 0
+        try:
+            if primary_key is None:
+                _sql, args = f"select * from `{table}`;", None
+            elif upper is None:
+                _sql, args = f"select * from `{table}` where `{primary_key}` >= %s;", (lower,)
+            else:
+                _sql = f"select * from `{table}` where `{primary_key}` >= %s and `{primary_key}` < %s;"
+                args = (lower, upper)
+
+            with connection.cursor() as cursor:
+                cursor.execute(_sql, args)
+                while True:
+                    rows = cursor.fetchmany(self.chunk_size)
+                    if not rows:
+                        break
+                    copied += self._emit(log_db, table, rows)
+        finally:
+            self._connections.put(connection)
+
+        return copied
+
+    def _emit(self, log_db: LogDBConnection, table: str, rows: list):
+        """
+        Turns source rows into insert events, logs them to cdc_log and hands them to the main thread,
+        which puts them into the persistence queue.
+
+        Args:
+            log_db (LogDBConnection): Log database connection of the current worker thread.
+            table (str): Table name.
+            rows (list): Rows as returned by the source cursor, in column ordinal order.
+
+        Returns:
+            int: Number of rows emitted.
+        """
+
+        row_predicate = self.table_filter.source_predicate(table)
+        if row_predicate is not None:
+            rows = [row for row in rows if row_predicate(row)]
+            if not rows:
+                return 0
+
+        table_schema = schema_registry.table_schema(table)
+        events = []
+        for row in rows:
+            events.append(
+                ChangeEvent(
+                    table_schema,
+                    "insert",
+                    # Same layout as a binlog row, the source cursor returns the columns in ordinal order
+                    spill_store.spill_values(table_schema.row_values(row)),
+                    cdc_dt=convert_value(datetime.datetime.now()),
+                    log_file=self.log_file,
+                    log_pos=self.log_pos,
+                    log_dt=self.log_dt,
+                    schema=self.SOURCE_MYSQL_SCHEMAS,
+                    # Snapshot rows have no source commit time
+                    stage_ts={"commit": None, "captured": time.time()},
+                )
+            )
+
+        cdc_ids = log_db.cdc_processed_execute_insert_many(events)
+        for event, cdc_id in zip(events, cdc_ids):
+            event["cdc_id"] = cdc_id
+
+        while not self._aborted.is_set():
+            try:
+                self._batches.put(events, timeout=1)
+                return len(events)
+            except queue.Full:
+                continue
+        raise RuntimeError("Snapshot aborted")
+
+
+if __name__ == "__main__":
+    pass
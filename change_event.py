@@ -0,0 +1,453 @@
+import datetime
+import decimal
+import fcntl
+import json
+import os
+import pickle
+import threading
+import zlib
+from pathlib import Path
+
+from field_mappings import field_mappings, field_mappings_raw
+
+# Fields of an event, ChangeEvent exposes them with the same dictionary access as the former event dicts
+EVENT_FIELDS = (
+    "cdc_id", "cdc_dt", "source", "log_file", "log_pos", "row_index", "log_dt", "schema", "table", "action", "data",
+    "stage_ts",
+)
+
+# Queue records starting with this tag are ChangeEvent wire tuples, anything else is a plain pickle (legacy dicts)
+WIRE_TAG = b"E1"
+PICKLE_PROTOCOL = pickle.HIGHEST_PROTOCOL
+
+
+def convert_value(value):
+    """
+    Convert a decoded column value to the type stored in events (datetimes as strings, decimals as floats)
+    :param value:
+    :return:
+    """
+    # Time type 1
+    if isinstance(value, datetime.datetime):
+        return value.strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+
+    # Time type 2
+    elif isinstance(value, datetime.date):
+        return value.strftime("%Y-%m-%d")
+
+    # Exact Fractional Types
+    elif isinstance(value, decimal.Decimal):
+        return float(value)
+
+    return value
+
+
+def mapping_key(table: str, schema: str = None) -> str:
+    """
+    Key of the source column layout in field_mappings_raw, a schema-qualified entry ("schema.table")
+    overrides the column order of the table for one source schema
+    :param table:
+    :param schema:
+    :return:
+    """
+    if schema is not None:
+        qualified = f"{schema}.{table}"
+        if qualified in field_mappings_raw:
+            return qualified
+    return table
+
+
+class TableSchema:
+    """
+    Column layout of a table: the source column ordinals kept in events and their names, held once per table.
+    The version is derived from the layout, so the CDC and DPU processes agree on it without coordination.
+    """
+
+    __slots__ = ("table", "ordinals", "columns", "keys", "version")
+
+    def __init__(self, table: str, ordinals: tuple, columns: tuple):
+        self.table = table
+        self.ordinals = ordinals
+        self.columns = columns
+        # Column keys of a decoded binlog row
+        self.keys = tuple(f"UNKNOWN_COL{i}" for i in ordinals)
+        self.version = zlib.crc32(f"{table}|{ordinals}|{columns}".encode())
+
+    def binlog_values(self, row: dict) -> tuple:
+        """
+        Converted values of a decoded binlog row (UNKNOWN_COL{i} keys) in layout order
+        """
+        return tuple([convert_value(row[key]) for key in self.keys])
+
+    def row_values(self, row) -> tuple:
+        """
+        Converted values of a row in column ordinal order (e.g. a ``select *`` result) in layout order
+        """
+        return tuple([convert_value(row[i]) for i in self.ordinals])
+
+
+class SchemaRegistry:
+    """
+    Table layouts by table and by version. Every layout used by the CDC is recorded in a JSON file next to the queue,
+    so the DPU can read queued events of a previous layout after field_mappings.py has changed.
+
+    With column projection a layout only holds the source columns the target uses (field_mappings)
+    and the columns of the keep list, the other columns are dropped right after the binlog row is decoded.
+    """
+
+    def __init__(self, path: Path = None, projection: bool = False, keep: dict = None):
+        self.path = path
+        self.projection = projection
+        self.keep = keep or {}
+        self.by_table = {}
+        self.by_version = {}
+        self.lock = threading.Lock()
+
+    def projected_ordinals(self, table: str, key: str = None) -> tuple:
+        """
+        Source column ordinals kept in the events of a table
+        :param table:
+        :param key: key of the layout in field_mappings_raw, the table by default
+        :return:
+        """
+        key = key or table
+        mapping = field_mappings_raw[key]
+        # Without a target mapping the columns the processor uses are unknown, all columns are kept
+        if not self.projection or table not in field_mappings:
+            return tuple(sorted(mapping))
+        # Columns are matched by name, a schema-qualified layout may order them differently
+        target_layout = field_mappings_raw.get(table, mapping)
+        used = {target_layout[i] for i in field_mappings[table] if i in target_layout}
+        used.update(self.keep.get(key) or self.keep.get(table) or [])
+        return tuple(sorted(i for i, column in mapping.items() if column in used))
+
+    def table_schema(self, table: str, schema: str = None) -> TableSchema:
+        """
+        Current layout of a table, derived from field_mappings_raw
+        :param table:
+        :param schema: source schema, selects a schema-qualified layout if there is one
+        :return:
+        """
+        key = mapping_key(table, schema)
+        table_schema = self.by_table.get(key)
+        if table_schema is None:
+            mapping = field_mappings_raw[key]
+            ordinals = self.projected_ordinals(table, key)
+            table_schema = TableSchema(table, ordinals, tuple(mapping[i] for i in ordinals))
+            with self.lock:
+                self.by_table[key] = table_schema
+                self.by_version[table_schema.version] = table_schema
+                self._record(table_schema)
+        return table_schema
+
+    def version_schema(self, version: int) -> TableSchema:
+        """
+        Layout of a version, the registry file is reloaded for versions recorded by another process
+        :param version:
+        :return:
+        """
+        table_schema = self.by_version.get(version)
+        if table_schema is None:
+            with self.lock:
+                self._load()
+            table_schema = self.by_version.get(version)
+            if table_schema is None:
+                raise KeyError(f"Unknown table schema version {version}")
+        return table_schema
+
+    def _read(self) -> dict:
+        if self.path is None or not self.path.exists():
+            return {}
+        with open(self.path, "r") as registry_file:
+            return json.load(registry_file)
+
+    def _load(self):
+        for version, (table, ordinals, columns) in self._read().items():
+            self.by_version.setdefault(int(version), TableSchema(table, tuple(ordinals), tuple(columns)))
+
+    def _record(self, table_schema: TableSchema):
+        if self.path is None:
+            return
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        # The CDC and DPU processes record their layouts in the same file, the read-merge-write is serialised
+        # with an exclusive lock on a lock file next to it, the rename keeps the readers from a partial file
+        with open(self.path.with_suffix(".lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                recorded = self._read()
+                if str(table_schema.version) in recorded:
+                    return
+                recorded[str(table_schema.version)] = [table_schema.table, table_schema.ordinals, table_schema.columns]
+                tmp_path = self.path.with_suffix(f".{os.getpid()}.tmp")
+                with open(tmp_path, "w") as registry_file:
+                    json.dump(recorded, registry_file)
+                os.replace(tmp_path, self.path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+schema_registry = SchemaRegistry()
+
+
+def schema_registry_init(path: Path, projection_config: dict = None) -> SchemaRegistry:
+    """
+    Set the registry file and the column projection of the current process
+    :param path:
+    :param projection_config: column_projection section of config.yml
+    :return:
+    """
+    projection_config = projection_config or {}
+    keep = projection_config.get("keep") or {}
+    for table, columns in keep.items():
+        unknown = set(columns) - set(field_mappings_raw.get(table, {}).values())
+        if unknown:
+            raise ValueError(f"column_projection.keep: unknown columns of {table} in field_mappings_raw: {unknown}")
+
+    schema_registry.path = path
+    schema_registry.projection = bool(projection_config.get("enabled", True))
+    schema_registry.keep = keep
+    return schema_registry
+
+
+class ChangeEvent:
+    """
+    One captured row change. Row values are tuples in the order of the table layout (TableSchema),
+    updates keep the values before the change in ``before`` and after the change in ``values``.
+    Events are read like the former event dicts (``event["table"]``, ``event["data"]["id"]``),
+    ``data`` is built from the tuples on first access.
+    """
+
+    __slots__ = (
+        "cdc_id",
+        "cdc_dt",
+        "source",
+        "log_file",
+        "log_pos",
+        "row_index",
+        "log_dt",
+        "schema",
+        "table",
+        "action",
+        "stage_ts",
+        "table_schema",
+        "values",
+        "before",
+        "_data",
+    )
+
+    def __init__(
+            self,
+            table_schema: TableSchema,
+            action: str,
+            values: tuple,
+            before: tuple = None,
+            cdc_id: int = None,
+            cdc_dt=None,
+            log_file: str = None,
+            log_pos: int = None,
+            log_dt: str = None,
+            schema: str = None,
+            stage_ts: dict = None,
+            source: str = None,
+            row_index: int = None,
+    ):
+        self.table_schema = table_schema
+        self.table = table_schema.table
+        self.action = action
+        self.values = values
+        self.before = before
+        self.cdc_id = cdc_id
+        self.cdc_dt = cdc_dt
+        self.log_file = log_file
+        self.log_pos = log_pos
+        self.log_dt = log_dt
+        self.schema = schema
+        self.stage_ts = stage_ts
+        # Name of the source server in source_databases, None for the single source_database
+        self.source = source
+        # Index of the row in its binlog rows event, (log_file, log_pos, row_index) identifies a captured row
+        self.row_index = row_index
+        self._data = None
+
+    @property
+    def data(self) -> dict:
+        if self._data is None:
+            columns = self.table_schema.columns
+            if self.action == "update":
+                self._data = {
+                    "before_values": dict(zip(columns, self.before)),
+                    "after_values": dict(zip(columns, self.values)),
+                }
+            else:
+                self._data = dict(zip(columns, self.values))
+        return self._data
+
+    @data.setter
+    def data(self, value: dict):
+        self._data = value
+
+    def __getitem__(self, key: str):
+        if key not in EVENT_FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key: str, value):
+        if key not in EVENT_FIELDS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key: str) -> bool:
+        return key in EVENT_FIELDS and getattr(self, key) is not None
+
+    def get(self, key: str, default=None):
+        if key not in EVENT_FIELDS:
+            return default
+        value = getattr(self, key)
+        return default if value is None else value
+
+    def as_dict(self) -> dict:
+        return {field: getattr(self, field) for field in EVENT_FIELDS}
+
+    def __repr__(self) -> str:
+        return repr(self.as_dict())
+
+    def original(self) -> "ChangeEvent":
+        """
+        The event as captured, without the changes made through ``data`` (e.g. IDs translated by a table processor)
+        """
+        return ChangeEvent(
+            self.table_schema,
+            self.action,
+            self.values,
+            before=self.before,
+            cdc_id=self.cdc_id,
+            cdc_dt=self.cdc_dt,
+            log_file=self.log_file,
+            log_pos=self.log_pos,
+            log_dt=self.log_dt,
+            schema=self.schema,
+            stage_ts=self.stage_ts,
+            source=self.source,
+            row_index=self.row_index,
+        )
+
+    def unchanged(self) -> bool:
+        """
+        Whether an update changes none of the columns in the layout (e.g. only columns dropped by the projection)
+        """
+        return self.action == "update" and self.values == self.before
+
+    def _current_values(self) -> tuple:
+        """
+        Row tuples, taking changes made through ``data`` into account
+        :return: (values, before)
+        """
+        if self._data is None:
+            return self.values, self.before
+        columns = self.table_schema.columns
+        if self.action == "update":
+            return (
+                tuple(self._data["after_values"].get(column) for column in columns),
+                tuple(self._data["before_values"].get(column) for column in columns),
+            )
+        return tuple(self._data.get(column) for column in columns), None
+
+    def payload(self) -> tuple:
+        """
+        Compact row payload stored in cdc_log: (version, values) or (version, after values, before values)
+        """
+        values, before = self._current_values()
+        if self.action == "update":
+            return self.table_schema.version, values, before
+        return self.table_schema.version, values
+
+    def to_wire(self) -> tuple:
+        values, before = self._current_values()
+        return (
+            self.cdc_id,
+            self.cdc_dt,
+            self.log_file,
+            self.log_pos,
+            self.log_dt,
+            self.schema,
+            self.action,
+            self.table_schema.version,
+            values,
+            before,
+            self.stage_ts,
+            self.source,
+            self.row_index,
+        )
+
+    @classmethod
+    def from_wire(cls, wire: tuple) -> "ChangeEvent":
+        # Events queued before the source and the row index were carried have neither
+        source = wire[11] if len(wire) > 11 else None
+        row_index = wire[12] if len(wire) > 12 else None
+        cdc_id, cdc_dt, log_file, log_pos, log_dt, schema, action, version, values, before, stage_ts = wire[:11]
+        return cls(
+            schema_registry.version_schema(version),
+            action,
+            values,
+            before=before,
+            cdc_id=cdc_id,
+            cdc_dt=cdc_dt,
+            log_file=log_file,
+            log_pos=log_pos,
+            log_dt=log_dt,
+            schema=schema,
+            stage_ts=stage_ts,
+            source=source,
+            row_index=row_index,
+        )
+
+    def __reduce__(self):
+        return ChangeEvent.from_wire, (self.to_wire(),)
+
+
+def event_payload(event) -> object:
+    """
+    Row payload of an event stored in cdc_log, the compact tuple for a ChangeEvent and the data dict otherwise
+    :param event:
+    :return:
+    """
+    if isinstance(event, ChangeEvent):
+        return event.payload()
+    return event["data"]
+
+
+def expand_payload(payload):
+    """
+    Row data dictionary of a cdc_log payload, data dicts of former versions are returned as they are
+    :param payload:
+    :return:
+    """
+    if not isinstance(payload, tuple):
+        return payload
+    columns = schema_registry.version_schema(payload[0]).columns
+    if len(payload) == 3:
+        return {"before_values": dict(zip(columns, payload[2])), "after_values": dict(zip(columns, payload[1]))}
+    return dict(zip(columns, payload[1]))
+
+
+class QueueSerializer:
+    """
+    Serializer of the persistence queue: ChangeEvents are stored as compact wire tuples without column names,
+    other items (e.g. event dicts queued by a former version) as plain pickles.
+    """
+
+    @staticmethod
+    def dumps(item, sort_keys: bool = False) -> bytes:
+        if isinstance(item, ChangeEvent):
+            return WIRE_TAG + pickle.dumps(item.to_wire(), protocol=PICKLE_PROTOCOL)
+        return pickle.dumps(item, protocol=PICKLE_PROTOCOL)
+
+    @staticmethod
+    def loads(data: bytes):
+        if data[:len(WIRE_TAG)] == WIRE_TAG:
+            return ChangeEvent.from_wire(pickle.loads(data[len(WIRE_TAG):]))
+        return pickle.loads(data)
+
+
+if __name__ == "__main__":
+    pass
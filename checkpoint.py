@@ -0,0 +1,47 @@
+import datetime
+import json
+import os
+import threading
+from pathlib import Path
+
+
+class CheckpointFile:
+    """
+    A JSON state file replaced atomically (written to a temporary file, synced and renamed),
+    a crash leaves either the previous or the new checkpoint. Saves of several threads (a writer thread and the SIGTERM
+    handler) are serialised, they share the temporary file.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def load(self):
+        """
+        Read the last checkpoint
+        :return: dictionary, None if there is none
+        """
+        try:
+            with open(self.path, "r") as checkpoint_file:
+                return json.load(checkpoint_file)
+        except FileNotFoundError:
+            return None
+
+    def save(self, state: dict):
+        """
+        Replace the checkpoint
+        :param state: JSON serialisable dictionary, the save time is added as "dt"
+        :return:
+        """
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        tmp_path = self.path.with_suffix(".tmp")
+        with self.lock:
+            with open(tmp_path, "w") as checkpoint_file:
+                json.dump(dict(state, dt=datetime.datetime.now().isoformat(timespec="milliseconds")), checkpoint_file)
+                checkpoint_file.flush()
+                os.fsync(checkpoint_file.fileno())
+            os.replace(tmp_path, self.path)
+
+
+if __name__ == "__main__":
+    pass
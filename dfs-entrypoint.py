@@ -4,21 +4,81 @@ parser = argparse.ArgumentParser(description="mysql-dataflowsync by Jinx@qqAys i
 parser.add_argument(
     "--mode", "-m",
     type=str,
-    choices=["cdc", "dpu", "monitor"],
+    choices=["cdc", "dpu", "pipeline", "monitor", "snapshot", "verify", "dlq", "rel"],
     required=True,
     help="Selecting the mysql-dataflowsync startup method"
 )
+parser.add_argument(
+    "action",
+    nargs="?",
+    choices=["list", "retry", "discard", "export", "import"],
+    default=None,
+    help="Dead-letter queue action of --mode dlq (list by default), relationship action of --mode rel"
+)
+parser.add_argument("--table", type=str, default=None, help="Dead-letter queue: only events of this table")
+parser.add_argument("--ids", type=int, nargs="+", default=None, help="Dead-letter queue: only these dlq_id")
+parser.add_argument("--limit", type=int, default=100, help="Dead-letter queue: number of listed events")
+parser.add_argument("--target", type=str, default=None,
+                    help="Dead-letter queue and relationships: target of target_databases")
+parser.add_argument("--file", type=str, default=None, help="Relationships: CSV file to export to or import from")
+parser.add_argument("--field", type=str, default=None, help="Relationships: only this field_define")
 args = parser.parse_args()
 mode = str(args.mode).lower()
+if mode == "dlq" and args.action not in (None, "list", "retry", "discard"):
+    parser.error("--mode dlq: action is list, retry or discard")
+if mode == "rel" and (args.action not in ("export", "import") or not args.file):
+    parser.error("--mode rel: action is export or import, with --file")
 
 if mode == "cdc":
-    from cdc.binlog_processor import CDC
-    cdc = CDC()
+    from utils import config_data
+    if config_data.get("source_databases"):
+        from cdc.binlog_processor import CDCGroup
+        cdc = CDCGroup()
+    else:
+        from cdc.binlog_processor import CDC
+        cdc = CDC()
     cdc.start()
 elif mode == "dpu":
-    from dpu.queue_processor import DPU
-    dpu = DPU()
+    from utils import config_data
+    if config_data.get("target_databases"):
+        from dpu.fan_out import FanOutDPU
+        dpu = FanOutDPU()
+    elif config_data.get("parallel_apply"):
+        from dpu.write_set import WriteSetScheduler
+        dpu = WriteSetScheduler()
+    else:
+        from dpu.queue_processor import DPU
+        dpu = DPU()
     dpu.start()
+elif mode == "pipeline":
+    from pipeline import Pipeline
+    pipeline = Pipeline()
+    pipeline.start()
+elif mode == "snapshot":
+    from cdc.snapshot import Snapshot
+    snapshot = Snapshot()
+    snapshot.start()
+elif mode == "verify":
+    from dpu.verifier import Verifier
+    verifier = Verifier()
+    verifier.start()
+elif mode == "dlq":
+    from dpu.dead_letter import DeadLetterCommand
+    command = DeadLetterCommand(target=args.target)
+    if args.action == "retry":
+        command.retry(table=args.table, ids=args.ids)
+    elif args.action == "discard":
+        command.discard(table=args.table, ids=args.ids)
+    else:
+        command.list(table=args.table, limit=args.limit)
+elif mode == "rel":
+    from pathlib import Path
+    from dpu.rel_mgr import RelationshipCommand
+    command = RelationshipCommand(target=args.target)
+    if args.action == "export":
+        command.export_file(Path(args.file), field_define=args.field)
+    else:
+        command.import_file(Path(args.file), field_define=args.field)
 elif mode == "monitor":
     from uvicorn import run
     from fastapi_monitor import app
@@ -0,0 +1,270 @@
+import datetime
+import json
+import threading
+import time
+
+from change_event import ChangeEvent
+from dpu.sinks import row_change
+from field_mappings import field_mappings_raw
+from spill import SpillRef
+from stats import stats_inc
+
+DEAD = "dead"
+PARKED = "parked"
+RETRIED = "retried"
+DISCARDED = "discarded"
+
+DEAD_LETTER_DEFAULT_KEY_COLUMN = "id"
+DEAD_LETTER_DEFAULT_REFRESH_SECONDS = 10
+
+
+class DeadLetterQueue:
+    """
+    The DeadLetterQueue class moves the events the DPU cannot apply to the dpu_dead_letter table of the log database,
+    so the DPU continues with the next event. Later events of the same row (table and key column) are parked behind
+    a dead event to keep the per-row order, until the dead event is retried or discarded (--mode dlq).
+
+    Attributes:
+        log_db (LogDBConnection): Connection object for the log database.
+        key_columns (dict): Per table, the column identifying a row (the "id" column by default).
+        refresh_seconds (float): Interval of reloading the unresolved keys, resolved by another process.
+        open_keys (set): (table, key) of the rows with unresolved events.
+        lock (threading.Lock): Serialises the log database calls, the workers of the parallel apply share the queue.
+    """
+
+    def __init__(self, log_db, dead_letter_config: dict = None, tables=None):
+        """
+        Args:
+            log_db (LogDBConnection): Connection object for the log database.
+            dead_letter_config (dict, optional): dead_letter section of config.yml.
+            tables (optional): Tables applied by the DPU, each needs its key column in field_mappings_raw.
+        """
+
+        dead_letter_config = dead_letter_config or {}
+        self.log_db = log_db
+        self.key_columns = dead_letter_config.get("key_columns") or {}
+        for table in tables or ():
+            self.check_key_column(table)
+        self.refresh_seconds = dead_letter_config.get("refresh_seconds", DEAD_LETTER_DEFAULT_REFRESH_SECONDS)
+        self.open_keys = set()
+        self.refreshed = None
+        self.lock = threading.Lock()
+
+    def check_key_column(self, table: str):
+        """
+        Every layout of the table (schema-qualified ones included) must hold its key column, otherwise all events
+        of the table would share the key "None" and one dead event would park the whole table.
+        """
+        column = self.key_columns.get(table, DEAD_LETTER_DEFAULT_KEY_COLUMN)
+        layouts = [mapping for key, mapping in field_mappings_raw.items() if key == table or key.endswith(f".{table}")]
+        if not layouts or any(column not in mapping.values() for mapping in layouts):
+            raise ValueError(
+                f"dead_letter.key_columns: {table} has no {column!r} column in field_mappings_raw, "
+                f"configure the column identifying its rows"
+            )
+
+    def event_key(self, raw) -> str:
+        """
+        Key of the row changed by an event, updates are keyed by the row before the change.
+        Rows of the named sources (source_databases) are told apart by the source name.
+        """
+        data = raw["data"]
+        if raw["action"] == "update":
+            data = data["before_values"]
+        key = str(data.get(self.key_columns.get(raw["table"], DEAD_LETTER_DEFAULT_KEY_COLUMN)))
+        source = raw.get("source")
+        return key if source is None else f"{source}:{key}"
+
+    def is_parked(self, table: str, key: str) -> bool:
+        with self.lock:
+            if self.refreshed is None or time.monotonic() - self.refreshed >= self.refresh_seconds:
+                self.open_keys = self.log_db.dpu_dead_letter_open_keys()
+                self.refreshed = time.monotonic()
+            return (table, key) in self.open_keys
+
+    def _insert(self, raw, key: str, status: str, reason: str, error: str) -> int:
+        # The event as captured, the table processor may have translated IDs in place
+        if isinstance(raw, ChangeEvent):
+            raw = raw.original()
+        stats_inc("dfs_dpu_dead_letter_total", table=raw["table"], status=status, reason=reason)
+        with self.lock:
+            self.open_keys.add((raw["table"], key))
+            return self.log_db.dpu_dead_letter_insert(raw, key, status, reason, error)
+
+    def dead_letter(self, raw, key: str, reason: str, error: str) -> int:
+        """
+        Store an event that cannot be applied
+        :return: dlq_id
+        """
+        dlq_id = self._insert(raw, key, DEAD, reason, error)
+        print(f"{datetime.datetime.now()} | dead-lettered | cdc_id:{raw['cdc_id']} dlq_id:{dlq_id} {reason}",
+              flush=True)
+        return dlq_id
+
+    def park(self, raw, key: str) -> int:
+        """
+        Store an event behind an unresolved event of the same row
+        :return: dlq_id
+        """
+        dlq_id = self._insert(raw, key, PARKED, "key_parked", None)
+        print(f"{datetime.datetime.now()} | parked | cdc_id:{raw['cdc_id']} dlq_id:{dlq_id} key:{key}", flush=True)
+        return dlq_id
+
+    def spill_digests(self) -> set:
+        """
+        Side files referenced by unresolved events, kept by the spill GC
+        """
+        digests = set()
+        after_id = None
+        while True:
+            with self.lock:
+                rows = self.log_db.dpu_dead_letter_query(after_id=after_id, limit=500)
+            if not rows:
+                return digests
+            for row in rows:
+                data = row["payload"]["data"]
+                for values in (data["before_values"], data["after_values"]) if row["action"] == "update" else (data,):
+                    digests.update(value.digest for value in values.values() if isinstance(value, SpillRef))
+            after_id = rows[-1]["dlq_id"]
+
+
+class DeadLetterCommand:
+    """
+    The DeadLetterCommand class inspects and resolves the dead-letter queue (--mode dlq).
+    Retries apply the unresolved events of every row in their original order with the DPU table processors,
+    a row stops at its first event that fails again.
+
+    Methods:
+        list(table, limit): Prints the unresolved events.
+        retry(table, ids): Applies unresolved events again.
+        discard(table, ids): Resolves events without applying them.
+    """
+
+    def __init__(self, target: str = None):
+        """
+        Args:
+            target (str, optional): Name of the target in target_databases whose events are resolved, the first by default.
+        """
+
+        from dpu.queue_processor import DPU
+        from utils import target_configs
+
+        targets = {target_config["name"]: target_config for target_config in target_configs()}
+        if target is not None and target not in targets:
+            raise ValueError(f"Unknown target: {target}")
+        # The DPU unit may be running: its stats file and queue are left alone, the target is connected for retry only
+        self.dpu = DPU(target=targets[target] if target is not None else None, command=True)
+        self.log_db = self.dpu.log_db
+
+    def _entries(self, table: str = None):
+        after_id = None
+        while True:
+            rows = self.log_db.dpu_dead_letter_query(table=table, after_id=after_id, limit=500)
+            if not rows:
+                return
+            yield from rows
+            after_id = rows[-1]["dlq_id"]
+
+    def list(self, table: str = None, limit: int = 100):
+        for count, row in enumerate(self._entries(table)):
+            if count >= limit:
+                break
+            payload = row.pop("payload")
+            row["data"] = payload["data"]
+            print(json.dumps(row, default=str, ensure_ascii=False), flush=True)
+
+    def retry(self, table: str = None, ids: list = None):
+        """
+        Applies the unresolved events again
+        :param table: only events of this table
+        :param ids: only these dlq_id, an earlier unresolved event of the same row that is not selected blocks the row
+        :return: (retried, failed)
+        """
+        if self.dpu.target_db is None and self.dpu.sink is None:
+            self.dpu.connect_target()
+        blocked = set()
+        retried = failed = 0
+        # Events buffered by a sink target, resolved once their batch is written
+        pending = []
+        for row in list(self._entries(table)):
+            row_key = (row["table"], row["event_key"])
+            if row_key in blocked:
+                continue
+            if ids and row["dlq_id"] not in ids:
+                blocked.add(row_key)
+                continue
+
+            raw = row["payload"]
+            processor = self.dpu.table_processors.get(row["table"])
+            try:
+                if processor is None:
+                    raise ValueError(f"No handler for this table: {row['table']}")
+                if self.dpu.sink is not None:
+                    change = row_change(raw)
+                    pending.append(row)
+                    if self.dpu.sink.write(change):
+                        written, not_written = self._flush(pending, blocked)
+                        retried, failed = retried + written, failed + not_written
+                    continue
+                processor(raw)
+            except Exception as e:
+                self.log_db.dpu_dead_letter_update(row["dlq_id"], row["status"], error=repr(e))
+                blocked.add(row_key)
+                failed += 1
+                print(f"{datetime.datetime.now()} | retry failed | dlq_id:{row['dlq_id']} {e!r}", flush=True)
+                continue
+            self.log_db.dpu_dead_letter_update(row["dlq_id"], RETRIED)
+            retried += 1
+            print(f"{datetime.datetime.now()} | retried | dlq_id:{row['dlq_id']}", flush=True)
+
+        if pending:
+            written, not_written = self._flush(pending, blocked)
+            retried, failed = retried + written, failed + not_written
+
+        print(f"{datetime.datetime.now()} | Dead-letter retry: {retried} applied, {failed} failed", flush=True)
+        return retried, failed
+
+    def _flush(self, pending: list, blocked: set) -> tuple:
+        """
+        Writes the batch buffered by a sink target, its events are marked retried once it is written
+        :param pending: dead-letter entries of the buffered events, emptied
+        :param blocked: rows stopped at a failed event, the rows of a failed batch are added
+        :return: (retried, failed)
+        """
+        rows = list(pending)
+        pending.clear()
+        try:
+            self.dpu.sink.flush()
+        except Exception as e:
+            self.dpu.sink.discard()
+            for row in rows:
+                self.log_db.dpu_dead_letter_update(row["dlq_id"], row["status"], error=repr(e))
+                blocked.add((row["table"], row["event_key"]))
+                print(f"{datetime.datetime.now()} | retry failed | dlq_id:{row['dlq_id']} {e!r}", flush=True)
+            return 0, len(rows)
+        for row in rows:
+            self.log_db.dpu_dead_letter_update(row["dlq_id"], RETRIED)
+            print(f"{datetime.datetime.now()} | retried | dlq_id:{row['dlq_id']}", flush=True)
+        return len(rows), 0
+
+    def discard(self, table: str = None, ids: list = None):
+        """
+        Resolves events without applying them, later parked events of the same rows stay parked until retried
+        :param table:
+        :param ids:
+        :return: number of discarded events
+        """
+        if not table and not ids:
+            raise ValueError("Discarding needs --table or --ids")
+        discarded = 0
+        for row in list(self._entries(table)):
+            if ids and row["dlq_id"] not in ids:
+                continue
+            self.log_db.dpu_dead_letter_update(row["dlq_id"], DISCARDED)
+            discarded += 1
+        print(f"{datetime.datetime.now()} | Dead-letter discard: {discarded} discarded", flush=True)
+        return discarded
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,235 @@
+import datetime
+import os
+import signal
+import sys
+import threading
+import time
+from pathlib import Path
+
+from checkpoint import CheckpointFile
+from dpu.dead_letter import DeadLetterQueue
+from persist_queue import lane_queues, oldest_captured
+from spill import spill_store
+from stats import stats_inc, stats_set
+from utils import target_configs, PROJECT_DATA_BASE_PATH, QUEUE_PATH
+
+# Interval of saving the progress of every target to checkpoints/dpu_<name>.json
+FAN_OUT_CHECKPOINT_SECONDS = 1
+# Events a target queue holds at most (max_queue_events of the target), the dispatch waits while a queue is full
+FAN_OUT_DEFAULT_MAX_QUEUE_EVENTS = 1000000
+# Interval of checking a full target queue again
+FAN_OUT_POLL_SECONDS = 0.1
+
+
+class TargetApplier:
+    """
+    Applies the events of one target of the fan-out DPU from its own persistent queue (the apply cursor of the target),
+    so a slow target only falls behind on its own.
+
+    Attributes:
+        name (str): Name of the target in target_databases.
+        dpu (DPU): Table processors, log database connection and target database connection of the target.
+        queue: Persistent queue of the target, persist_queue/targets/<name> (split into its priority lanes if configured).
+        checkpoint (CheckpointFile): Progress of the target.
+        applied (dict): cdc_id, binlog position and capture time of the last applied event.
+        applied_events (int): Number of events applied since the start.
+        max_queue_events (int): Events the target queue holds at most, the dispatch waits while it is full.
+        dispatched (int): Number of events copied to the target queue since the start.
+    """
+
+    def __init__(self, target: dict, log_db=None, target_db=None):
+        from dpu.queue_processor import DPU
+
+        self.name = target["name"]
+        self.queue = lane_queues(Path(QUEUE_PATH, "targets", self.name), labels={"target": self.name})
+        self.dpu = DPU(log_db=log_db, target_db=target_db, queue=self.queue, target=target)
+        # The spill files are collected by the fan-out DPU once every target has applied the events using them
+        self.dpu.spill_gc = False
+        self.checkpoint = CheckpointFile(Path(PROJECT_DATA_BASE_PATH, "checkpoints", f"dpu_{self.name}.json"))
+        self.applied = (self.checkpoint.load() or {}).get("applied")
+        self.applied_events = 0
+        self.saved = time.monotonic()
+        self.max_queue_events = target.get("max_queue_events", FAN_OUT_DEFAULT_MAX_QUEUE_EVENTS)
+        # The depth is tracked from the counters of the dispatch and the applier, without reading the queue per event
+        self.queued_at_start = self.queue.qsize()
+        self.dispatched = 0
+
+    def depth(self) -> int:
+        """
+        Events in the target queue not applied yet: queued at the start and dispatched since, less the applied ones
+        """
+        return self.queued_at_start + self.dispatched - self.applied_events
+
+    def apply(self):
+        """
+        Applies the next event of the target queue
+        :return: the applied event
+        """
+        raw = self.dpu._next_queue_item()
+        self.dpu._handle_process_data(raw)
+        self.applied_events += 1
+        self.update_applied()
+        return raw
+
+    def update_applied(self):
+        """
+        Progress of the target from the last event written to it, the events buffered by a sink are not applied yet
+        """
+        written = self.dpu.last_applied
+        if written is not None:
+            self.applied = {
+                "cdc_id": written["cdc_id"],
+                "log_file": written["log_file"],
+                "log_pos": written["log_pos"],
+                "captured": (written.get("stage_ts") or {}).get("captured"),
+            }
+
+    def save_checkpoint(self):
+        self.checkpoint.save({"target": self.name, "applied": self.applied, "applied_events": self.applied_events})
+        self.saved = time.monotonic()
+
+    def publish(self):
+        """
+        Publishes the progress of the target: backlog of its queue and last applied cdc_id
+        """
+        stats_set("dfs_dpu_target_backlog_events", self.queue.qsize(), target=self.name)
+        if self.applied is not None and self.applied["cdc_id"] is not None:
+            stats_set("dfs_dpu_target_applied_cdc_id", self.applied["cdc_id"], target=self.name)
+
+
+class FanOutDPU:
+    """
+    The FanOutDPU class applies one change stream to all targets of target_databases concurrently (--mode dpu).
+    Events taken from the persistence queue are copied to a persistent queue per target, every target is applied
+    by its own thread with its own connections and db_rel namespace, and tracks its progress in checkpoints/dpu_<name>.json.
+    Every event is written to N + 1 SQLite queues (the shared one and one per target). A target queue holds at most
+    max_queue_events events: while one is full the dispatch waits, the shared queue grows and the backpressure of the
+    CDC holds back the binlog reader.
+
+    Attributes:
+        queue: Shared queue the events are taken from, the persistence queue by default.
+        appliers (list): TargetApplier of each target.
+        gc_log_db (LogDBConnection): Log database connection of the spill GC, the applier connections are not shared
+            across threads.
+        failed (Exception): Error that stopped an applier thread, the DPU exits with it.
+
+    Methods:
+        dispatch(): Copies the next event of the shared queue to every target queue.
+        start(): Starts an applier thread per target and dispatches the shared queue.
+    """
+
+    def __init__(self, queue=None, targets: list = None, gc_log_db=None):
+        """
+        Args:
+            queue (optional): Queue to use instead of the persistence queue.
+            targets (list, optional): TargetApplier instances, one per entry of target_databases by default.
+            gc_log_db (optional): Log database connection of the spill GC, connected on the first collection by default.
+        """
+
+        if queue is None:
+            from persist_queue import EventQueue
+            queue = EventQueue
+        self.queue = queue
+        self.appliers = targets if targets is not None else [TargetApplier(target) for target in target_configs()]
+        self.gc_lock = threading.Lock()
+        self.gc_log_db = gc_log_db
+        self.failed = None
+
+    def dispatch(self):
+        """
+        Copies the next event of the shared queue to every target queue.
+        """
+
+        raw = self.queue.get()
+        for applier in self.appliers:
+            if applier.depth() >= applier.max_queue_events:
+                self._wait_for_room(applier)
+            applier.queue.put(raw)
+            applier.dispatched += 1
+        # Removed from the shared queue once it is in every target queue
+        self.queue.ack(raw)
+        stats_inc("dfs_dpu_fan_out_events_total")
+
+    def _wait_for_room(self, applier: TargetApplier):
+        """
+        Waits until the queue of a target is below its max_queue_events, the other targets wait as well
+        """
+
+        start = time.monotonic()
+        while applier.depth() >= applier.max_queue_events and self.failed is None:
+            time.sleep(FAN_OUT_POLL_SECONDS)
+        stats_inc("dfs_dpu_target_queue_full_seconds_total", time.monotonic() - start, target=applier.name)
+
+    def _spill_gc(self):
+        """
+        Removes the spill files no target needs anymore, based on the oldest capture time not acknowledged yet in
+        the shared queue and the target queues (their lanes are not applied in capture order).
+        """
+
+        with self.gc_lock:
+            if not spill_store.gc_due():
+                return
+            if self.gc_log_db is None:
+                from dpu.queue_processor import LOG_MARIADB_SETTINGS
+                from utils import LogDBConnection
+
+                self.gc_log_db = LogDBConnection(
+                    host=LOG_MARIADB_SETTINGS["host"],
+                    port=LOG_MARIADB_SETTINGS["port"],
+                    user=LOG_MARIADB_SETTINGS["user"],
+                    password=LOG_MARIADB_SETTINGS["passwd"],
+                )
+            # Dead-letter entries of every target, read with the connection of the GC under gc_lock
+            keep = set()
+            for applier in self.appliers:
+                self.gc_log_db.target = applier.name
+                keep |= DeadLetterQueue(self.gc_log_db).spill_digests()
+            unapplied_since = oldest_captured([self.queue] + [applier.queue for applier in self.appliers])
+            removed = spill_store.gc(unapplied_since, keep=keep)
+            if removed:
+                stats_inc("dfs_spill_files_removed_total", removed)
+                print(f"{datetime.datetime.now()} | Removed {removed} spill files", flush=True)
+
+    def _run(self, applier: TargetApplier):
+        """
+        Applier thread of a target. An error stops the DPU, the target would not be applied anymore otherwise.
+        """
+
+        try:
+            while True:
+                applier.apply()
+                applier.publish()
+                if time.monotonic() - applier.saved >= FAN_OUT_CHECKPOINT_SECONDS:
+                    applier.save_checkpoint()
+                if spill_store.gc_due():
+                    try:
+                        self._spill_gc()
+                    except Exception as e:
+                        applier.dpu.error_logger.error(f"Spill GC error: {e!r}")
+        except Exception as e:
+            self.failed = e
+            applier.dpu.error_logger.critical(f"Applier of target {applier.name} stopped: {e!r}")
+            stats_inc("dfs_dpu_target_failures_total", target=applier.name)
+            # The SIGTERM handler in the main thread saves the checkpoints and exits
+            os.kill(os.getpid(), signal.SIGTERM)
+
+    def _terminate(self, *_):
+        for applier in self.appliers:
+            applier.save_checkpoint()
+        print(f"{datetime.datetime.now()} | Fan-out DPU checkpoints saved", flush=True)
+        sys.exit(1 if self.failed is not None else 0)
+
+    def start(self):
+        """
+        Starts the applier threads and dispatches the shared queue to the targets until interrupted.
+        """
+
+        signal.signal(signal.SIGTERM, self._terminate)
+        for applier in self.appliers:
+            threading.Thread(target=self._run, args=(applier,), name=f"dpu-{applier.name}", daemon=True).start()
+        while True:
+            self.dispatch()
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,178 @@
+import threading
+import time
+from collections import deque
+
+from stats import stats_set, stats_observe
+
+# Stage timestamps carried by every event in event["stage_ts"]
+COMMIT = "commit"
+CAPTURED = "captured"
+ENQUEUED = "enqueued"
+DEQUEUED = "dequeued"
+APPLIED = "applied"
+
+# Latency stages: name -> (start timestamp, end timestamp)
+LAG_STAGES = {
+    "source_to_capture": (COMMIT, CAPTURED),
+    "queue_wait": (ENQUEUED, DEQUEUED),
+    "apply": (DEQUEUED, APPLIED),
+    "end_to_end": (COMMIT, APPLIED),
+}
+LAG_QUANTILES = (0.5, 0.95, 0.99)
+
+
+def percentile(sorted_values: list, quantile: float) -> float:
+    """
+    Nearest-rank percentile of a sorted list
+    :param sorted_values:
+    :param quantile:
+    :return:
+    """
+    index = min(len(sorted_values) - 1, max(0, round(quantile * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+class LagTracker:
+    """
+    Aggregates the stage timestamps of applied events into rolling p50/p95/p99 latencies per table.
+    The latest window of samples is kept per table and stage, the percentiles are published to the stats file
+    as ``dfs_lag_seconds{table, stage, quantile}`` gauges by a timer thread once per publish interval.
+    Events being applied are tracked as well: while one is not applied, the end-to-end lag of its table is at least
+    its age, so the lag keeps growing when the DPU stalls instead of staying at the last applied event.
+
+    Attributes:
+        window (int): Number of samples kept per table and stage.
+        publish_interval (float): Seconds between two publications.
+        samples (dict): (table, stage) -> deque of latencies in seconds.
+        in_flight (dict): Event being applied (its stage_ts id) -> (table, commit or capture time).
+        labels (dict): Labels added to the published stats, e.g. the target of a fan-out DPU.
+    """
+
+    def __init__(self, window: int = 1000, publish_interval: float = 1, labels: dict = None):
+        self.window = window
+        self.publish_interval = publish_interval
+        self.samples = {}
+        self.in_flight = {}
+        self.labels = labels or {}
+        # The DPU thread(s) record, the timer thread publishes
+        self.lock = threading.Lock()
+        self.timer = None
+        # Tables whose published end-to-end lag was only the age of an event being applied
+        self.aged_tables = set()
+
+    def begin(self, table: str, stage_ts: dict):
+        """
+        Marks an event as being applied, its age counts in the lag until it is recorded or ended.
+
+        Args:
+            table (str): Table name.
+            stage_ts (dict): Stage timestamps of the event.
+        """
+
+        since = stage_ts.get(COMMIT) or stage_ts.get(CAPTURED)
+        if since is None:
+            return
+        with self.lock:
+            self.in_flight[id(stage_ts)] = (table, since)
+        if self.timer is None:
+            self.start()
+
+    def end(self, stage_ts: dict):
+        """
+        Marks an event as no longer being applied (applied, dead-lettered or failed).
+        """
+
+        with self.lock:
+            self.in_flight.pop(id(stage_ts), None)
+
+    def record(self, table: str, stage_ts: dict):
+        """
+        Records the stage latencies of one applied event.
+
+        Args:
+            table (str): Table name.
+            stage_ts (dict): Stage timestamps (epoch seconds), missing stages are skipped.
+        """
+
+        with self.lock:
+            self.in_flight.pop(id(stage_ts), None)
+            for stage, (start, end) in LAG_STAGES.items():
+                if stage_ts.get(start) is None or stage_ts.get(end) is None:
+                    continue
+                latency = max(stage_ts[end] - stage_ts[start], 0)
+                samples = self.samples.get((table, stage))
+                if samples is None:
+                    samples = self.samples[(table, stage)] = deque(maxlen=self.window)
+                samples.append(latency)
+                stats_observe("dfs_lag_stage_seconds", latency, table=table, stage=stage, **self.labels)
+
+    def percentiles(self) -> dict:
+        """
+        Computes the rolling percentiles, the end-to-end lag of a table is at least the age of its oldest event
+        being applied.
+
+        Returns:
+            dict: table -> stage -> {"p50": ..., "p95": ..., "p99": ...}
+        """
+
+        now = time.time()
+        with self.lock:
+            snapshot = {key: sorted(samples) for key, samples in self.samples.items()}
+            in_flight = list(self.in_flight.values())
+
+        result = {}
+        for (table, stage), sorted_samples in snapshot.items():
+            result.setdefault(table, {})[stage] = {
+                f"p{int(quantile * 100)}": percentile(sorted_samples, quantile) for quantile in LAG_QUANTILES
+            }
+        for table, since in in_flight:
+            age = max(now - since, 0)
+            quantiles = result.setdefault(table, {}).setdefault("end_to_end", {})
+            for quantile in LAG_QUANTILES:
+                name = f"p{int(quantile * 100)}"
+                quantiles[name] = max(quantiles.get(name, 0), age)
+        return result
+
+    def publish(self):
+        """
+        Publishes the rolling percentiles to the stats file.
+        """
+
+        result = self.percentiles()
+        with self.lock:
+            aged_tables = {
+                table for table, _ in self.in_flight.values() if (table, "end_to_end") not in self.samples
+            }
+        # A table without applied events goes back to no lag once its event is no longer being applied
+        for table in self.aged_tables - aged_tables:
+            result.setdefault(table, {})["end_to_end"] = {
+                f"p{int(quantile * 100)}": 0 for quantile in LAG_QUANTILES
+            }
+        self.aged_tables = aged_tables
+        for table, stages in result.items():
+            for stage, quantiles in stages.items():
+                for quantile, value in quantiles.items():
+                    stats_set("dfs_lag_seconds", value, table=table, stage=stage, quantile=quantile, **self.labels)
+
+    def _run(self):
+        while True:
+            time.sleep(self.publish_interval)
+            try:
+                self.publish()
+            except Exception as e:
+                print(f"Lag publication failed: {e}", flush=True)
+
+    def start(self):
+        """
+        Starts the timer thread publishing the lag, called on the first event.
+        """
+
+        with self.lock:
+            if self.timer is not None:
+                return
+            self.timer = threading.Thread(target=self._run, name="lag-publisher", daemon=True)
+        self.timer.start()
+
+
+if __name__ == "__main__":
+    pass
@@ -1,16 +1,32 @@
 import datetime
 import inspect
-
-from persist_queue import PersistQueue
+import time
+from pathlib import Path
+
+import persistqueue
+
+from dpu.dead_letter import DeadLetterQueue
+from dpu.lag_tracker import LagTracker
+from dpu.sinks import row_change, sink_init
+from field_mappings import field_mappings_raw, TABLE_PROCESSORS
+from profiling import profiling_init, span
+from spill import spill_store
+from stats import stats_init, stats_inc, stats_observe
 from utils import (
+    PermanentApplyError,
     TargetDBConnection,
     LogDBConnection,
     config_data,
     generate_update_statement,
     generate_insert_statement,
+    generate_overwrite_statement,
     log_init,
+    target_configs,
     PROJECT_NAME,
     LOG_DB_PASSWORD,
+    STATS_PATH,
+    LOG_PATH,
+    PROJECT_DATA_BASE_PATH,
 )
 
 INSERT = "insert"
@@ -24,13 +40,7 @@ LOG_MARIADB_SETTINGS = {
     "user": "root",
     "passwd": LOG_DB_PASSWORD,
 }
-TARGET_MYSQL_SETTINGS = {
-    "host": config_data["target_database"]["host"],
-    "port": config_data["target_database"]["port"],
-    "user": config_data["target_database"]["user"],
-    "passwd": config_data["target_database"]["passwd"],
-    "schemas": config_data["target_database"]["schemas"]
-}
+
 
 
 class DPU:
@@ -42,13 +52,21 @@ class DPU:
     Attributes:
         error_logger (Logger): Logger instance for capturing errors.
         log_db (LogDBConnection): Connection object for the log database.
-        target_db (TargetDBConnection): Connection object for the target database.
+        target_db (TargetDBConnection): Connection object for the target database, None for a sink target.
+        sink (Sink): SQLite or file sink of a target of type sqlite, jsonl or csv, None for a MySQL target.
+        target_name (str): Name of the target in target_databases, None for target_database.
+        queue: Queue the events are taken from, the persistence queue (or its priority lanes) by default, None for a
+            command. An event is acknowledged once it is written to the target or dead-lettered.
+        last_applied (dict): Last event written to the target or dead-lettered, events buffered by a sink are not.
+        dead_letters (DeadLetterQueue): Events that cannot be applied and the events parked behind them.
         table_processors (dict): Dictionary mapping table names to their respective processing methods.
 
     Methods:
-        __init__(): Initializes the DPU instance, establishes database connections, and sets up table processors.
+        __init__(log_db=None, target_db=None, queue=None, target=None, command=False): Initializes the DPU instance, establishes database connections, and sets up table processors.
+        connect_target(target_db=None): Connects the target database or opens the sink of the target.
         _get_queue_item(): Retrieves an item from the persistence queue.
         _handle_process_data(raw): Processes raw CDC data by routing it to the appropriate table processor.
+        idle(): Writes the buffered batch of a sink target, called whenever the queue runs empty.
         start(): Continuously retrieves items from the queue and processes them.
 
         ---example---
@@ -57,10 +75,19 @@ class DPU:
         ---example---
     """
 
-    def __init__(self):
+    def __init__(self, log_db=None, target_db=None, queue=None, target=None, command=False):
         """
         Initializes the DPU instance. Sets up logging, establishes connections to the log and target databases,
         and defines table-specific processing methods.
+
+        Args:
+            log_db (optional): Log database connection to use instead of connecting to the log MariaDB.
+            target_db (optional): Target database connection to use instead of connecting to the target database.
+            queue (optional): Queue to use instead of the persistence queue.
+            target (dict, optional): Target database to apply to, the first of target_configs() by default.
+            command (bool, optional): Table processors of a command run next to the DPU (--mode dlq): the stats file
+                and the profiler of the running DPU are left alone, no queue is opened and the target is connected
+                by connect_target().
         """
 
         print(
@@ -69,67 +96,219 @@ class DPU:
         print(f"{datetime.datetime.now()} | Project: {PROJECT_NAME}")
 
         _, _, self.error_logger = log_init()
-
-        self.log_db = LogDBConnection(
-            host=LOG_MARIADB_SETTINGS["host"],
-            port=LOG_MARIADB_SETTINGS["port"],
-            user=LOG_MARIADB_SETTINGS["user"],
-            password=LOG_MARIADB_SETTINGS["passwd"],
-        )
+        if not command:
+            stats_init(Path(STATS_PATH, "dpu.stats"))
+            profiling_init("dpu", LOG_PATH, config_data.get("profiling") or {})
+
+        if log_db is None:
+            log_db = LogDBConnection(
+                host=LOG_MARIADB_SETTINGS["host"],
+                port=LOG_MARIADB_SETTINGS["port"],
+                user=LOG_MARIADB_SETTINGS["user"],
+                password=LOG_MARIADB_SETTINGS["passwd"],
+            )
+        self.target = target_configs()[0] if target is None else target
+        self.target_name = self.target.get("name")
+        # dpu_log, dead letters and relationships of a named target are kept apart from the other targets
+        log_db.target = self.target_name
+        self.log_db = log_db
+        # Stats of the named targets carry a target label
+        self.target_labels = {} if self.target_name is None else {"target": self.target_name}
 
         print(f"{datetime.datetime.now()} | DPU log database connection successful")
 
-        self.target_db = TargetDBConnection(
-            host=TARGET_MYSQL_SETTINGS["host"],
-            port=TARGET_MYSQL_SETTINGS["port"],
-            user=TARGET_MYSQL_SETTINGS["user"],
-            password=TARGET_MYSQL_SETTINGS["passwd"],
-            schemas=TARGET_MYSQL_SETTINGS["schemas"],
-        )
+        # Targets of type sqlite, jsonl or csv are written by a sink instead of the table processors
+        self.sink = None
+        self.target_db = None
+        if not command:
+            self.connect_target(target_db)
 
-        print(f"{datetime.datetime.now()} | Target database connection successful")
+        if queue is None and not command:
+            from persist_queue import EventQueue
+            queue = EventQueue
+        self.queue = queue
 
-        self.table_processors = {
-            "example_table": self._process_example_table,
-            "skip_table": self._process_skip_table,
-        }
+        self.table_processors = {table: getattr(self, method) for table, method in TABLE_PROCESSORS.items()}
+        if self.target.get("type", "mysql") != "mysql":
+            self.table_processors = {table: self._process_sink for table in field_mappings_raw if "." not in table}
 
-    @staticmethod
-    def _get_queue_item():
+        # Rolling per-table lag percentiles, published to the stats file
+        self.lag_tracker = LagTracker(window=config_data.get("lag_window", 1000), labels=self.target_labels)
+        # Spill files are collected after an apply, the fan-out DPU collects them for all targets instead
+        self.spill_gc = True
+
+        self.dead_letters = DeadLetterQueue(self.log_db, config_data.get("dead_letter"), tables=self.table_processors)
+        self.last_applied = None
+
+    def connect_target(self, target_db=None):
+        """
+        Connects the target database, or opens the sink of a target of type sqlite, jsonl or csv.
+
+        Args:
+            target_db (optional): Target database connection to use instead of connecting to the target database.
+        """
+
+        if self.target.get("type", "mysql") != "mysql":
+            self.sink = sink_init(self.target, PROJECT_DATA_BASE_PATH)
+        else:
+            if target_db is None:
+                target_db = TargetDBConnection(
+                    host=self.target["host"],
+                    port=self.target["port"],
+                    user=self.target["user"],
+                    password=self.target["passwd"],
+                    schemas=self.target["schemas"],
+                )
+            self.target_db = target_db
+
+        print(f"{datetime.datetime.now()} | Target database connection successful")
+
+    def _get_queue_item(self, block: bool = True):
         """
         Retrieves an item from the persistence queue.
 
+        Args:
+            block (bool, optional): Wait for an item, persistqueue.Empty is raised on an empty queue otherwise.
+
+        Returns:
+            dict: A dictionary containing CDC data.
+        """
+
+        queue_item = self.queue.get() if block else self.queue.get(block=False)
+        if "stage_ts" in queue_item:
+            queue_item["stage_ts"]["dequeued"] = time.time()
+        return queue_item
+
+    def _next_queue_item(self):
+        """
+        Retrieves the next item, the buffered batch of a sink is written first when the queue runs empty or once it
+        is flush_seconds old.
+
         Returns:
             dict: A dictionary containing CDC data.
         """
 
-        return PersistQueue.get()
+        if self.sink is not None and self.sink.due():
+            self.idle()
+        try:
+            return self._get_queue_item(block=False)
+        except persistqueue.Empty:
+            self.idle()
+            return self._get_queue_item()
 
     def _handle_process_data(self, raw):
         """
         Processes raw CDC data by identifying the appropriate table processor and executing it.
+        Events without a processor or failing permanently go to the dead-letter queue, later events of the same row
+        are parked behind them.
 
         Args:
             raw (dict): Raw CDC data including table name and action type.
-
-        Raises:
-            ValueError: If no processor is found for the specified table.
         """
 
         print(f"{datetime.datetime.now()} | processing cdc_id:{raw['cdc_id']}", flush=True)
 
         table_name = raw["table"]
         processor = self.table_processors.get(table_name)
-
-        if processor is None:
-            raise ValueError(f"No handler for this table: {table_name}")
+        key = self.dead_letters.event_key(raw)
+
+        if self.dead_letters.is_parked(table_name, key):
+            stats_inc("dfs_dpu_events_total", table=table_name, action=raw["action"], status="parked",
+                      **self.target_labels)
+            self.dead_letters.park(raw, key)
+        elif processor is None:
+            stats_inc("dfs_dpu_events_total", table=table_name, action=raw["action"], status="no_processor",
+                      **self.target_labels)
+            self.dead_letters.dead_letter(raw, key, "no_processor", f"No handler for this table: {table_name}")
         else:
+            start = time.perf_counter()
+            applied = False
+            if "stage_ts" in raw:
+                self.lag_tracker.begin(table_name, raw["stage_ts"])
             try:
-                processor(raw)
+                with span("dpu.processor"):
+                    processor(raw)
+                # Sink targets record the events of a batch once it is written
+                if "stage_ts" in raw and self.sink is None:
+                    raw["stage_ts"]["applied"] = time.time()
+                    with span("dpu.lag_record"):
+                        self.lag_tracker.record(table_name, raw["stage_ts"])
+                stats_inc("dfs_dpu_events_total", table=table_name, action=raw["action"], status="ok",
+                          **self.target_labels)
                 print(f"{datetime.datetime.now()} | processing complete | cdc_id:{raw['cdc_id']}", flush=True)
+                applied = True
+            except PermanentApplyError as e:
+                stats_inc("dfs_dpu_events_total", table=table_name, action=raw["action"], status="dead_letter",
+                          **self.target_labels)
+                self.dead_letters.dead_letter(raw, key, "permanent_error", str(e))
             except Exception as e:
                 self.error_logger.critical(e, raw)
+                stats_inc("dfs_dpu_events_total", table=table_name, action=raw["action"], status="failed",
+                          **self.target_labels)
                 print(f"{datetime.datetime.now()} | processing failure | cdc_id:{raw['cdc_id']}", flush=True)
+                self.dead_letters.dead_letter(raw, key, "processor_error", repr(e))
+            finally:
+                if "stage_ts" in raw and not (applied and self.sink is not None):
+                    self.lag_tracker.end(raw["stage_ts"])
+            stats_observe("dfs_dpu_process_seconds", time.perf_counter() - start, table=table_name,
+                          **self.target_labels)
+            # Outside the apply, a failing collection must not dead-letter the event already applied
+            if applied and self.spill_gc and spill_store.gc_due():
+                try:
+                    self._spill_gc()
+                except Exception as e:
+                    self.error_logger.error(f"Spill GC error: {e!r}")
+            # Buffered by a sink, acknowledged with its batch
+            if applied and self.sink is not None:
+                return
+        self._done(raw)
+
+    def _done(self, raw):
+        """
+        Acknowledges an event written to the target or dead-lettered, it is removed from the queue.
+        """
+
+        self.queue.ack(raw)
+        self.last_applied = raw
+
+    def _spill_gc(self):
+        """
+        Removes the spill side files past retention that no queued event references anymore, based on the capture
+        time of the oldest event of the queue not acknowledged yet (the lanes are not applied in capture order).
+        """
+
+        removed = spill_store.gc(self.queue.oldest_captured(), keep=self.dead_letters.spill_digests())
+        if removed:
+            stats_inc("dfs_spill_files_removed_total", removed)
+            print(f"{datetime.datetime.now()} | Removed {removed} spill files", flush=True)
+
+    def idle(self):
+        """
+        Writes the buffered batch of a sink target. Events of a batch the sink rejects go to the dead-letter queue.
+        """
+
+        if self.sink is None:
+            return
+        try:
+            with span("dpu.sink_flush"):
+                changes = self.sink.flush()
+        except Exception as e:
+            self.error_logger.critical(e)
+            for raw in self.sink.discard():
+                stats_inc("dfs_dpu_events_total", table=raw["table"], action=raw["action"], status="dead_letter",
+                          **self.target_labels)
+                self.dead_letters.dead_letter(raw, self.dead_letters.event_key(raw), "sink_error", repr(e))
+                if "stage_ts" in raw:
+                    self.lag_tracker.end(raw["stage_ts"])
+                self._done(raw)
+            return
+        applied = time.time()
+        for change in changes:
+            raw = change.raw
+            if "stage_ts" in raw:
+                raw["stage_ts"]["applied"] = applied
+                self.lag_tracker.record(raw["table"], raw["stage_ts"])
+            self._done(raw)
 
     def start(self):
         """
@@ -137,8 +316,19 @@ class DPU:
         """
 
         while True:
-            queue_item = self._get_queue_item()
-            self._handle_process_data(queue_item)
+            self._handle_process_data(self._next_queue_item())
+
+    def _process_sink(self, raw):
+        """
+        Hands the event to the sink of the target, the source columns are renamed to the target columns.
+        A full batch is written right away.
+
+        Args:
+            raw (dict): Raw CDC data of any table.
+        """
+
+        if self.sink.write(row_change(raw)):
+            self.idle()
 
     def _process_example_table(self, raw):
         """
@@ -150,6 +340,8 @@ class DPU:
 
         cdc_data = raw["data"]
         action = raw["action"]
+        # IDs of the named sources are translated by their own relationships
+        source = raw.get("source")
 
         # INSERT action
         if action == INSERT:
@@ -160,9 +352,25 @@ class DPU:
 
             # Query if there is a DPU relationship, if so replace the value.
             cdc_data["foreign_id"] = self.log_db.dpu_relationship_query(
-                "foreign_id", foreign_id
+                "foreign_id", foreign_id, source
             )
 
+            # Upsert: the row has already been applied (e.g. an event applied again after a restart),
+            # overwrite it instead of inserting a duplicate. New rows are looked up once, the misses are cached.
+            if self.log_db.dpu_relationship_exists("primary_id", primary_id, source):
+                new_primary_id = self.log_db.dpu_relationship_query(
+                    "primary_id", primary_id, source
+                )
+                dml = generate_overwrite_statement(
+                    inspect.currentframe().f_code.co_name,
+                    cdc_data,
+                    f"id = {new_primary_id}",
+                )
+                dpu_id = self.log_db.dpu_processed_log_insert(raw, dml)
+                rowcount = self.target_db.insert_and_update(dml)
+                self.log_db.dpu_after_dml_execute_update(dpu_id, executed=rowcount is not None)
+                return
+
             # DML build
             dml = generate_insert_statement(
                 inspect.currentframe().f_code.co_name, cdc_data
@@ -178,8 +386,13 @@ class DPU:
             if row_id != 0 and row_id is not None:
                 self.log_db.dpu_after_dml_execute_update(dpu_id)
 
-                # Creating DPU Relationships
-                self.log_db.dpu_relationship_create("primary_id", primary_id, row_id)
+                # Creating DPU Relationships, the rows copied by the snapshot (no binlog row_index) are recorded
+                # with identical IDs as well so that they are recognised when applied again
+                self.log_db.dpu_relationship_create(
+                    "primary_id", primary_id, row_id, source, identical=raw.get("row_index") is None
+                )
+            else:
+                self.log_db.dpu_after_dml_execute_update(dpu_id, executed=False)
 
         # UPDATE action
         elif action == UPDATE:
@@ -188,10 +401,10 @@ class DPU:
             foreign_id = cdc_data["after_values"]["foreign_id"]
 
             new_primary_id = self.log_db.dpu_relationship_query(
-                "primary_id", primary_id
+                "primary_id", primary_id, source
             )
             cdc_data["after_values"]["foreign_id"] = self.log_db.dpu_relationship_query(
-                "foreign_id", foreign_id
+                "foreign_id", foreign_id, source
             )
 
             dml = generate_update_statement(
@@ -208,6 +421,8 @@ class DPU:
             # Update DPU-DML Execution Status
             if rowcount != 0 and rowcount is not None:
                 self.log_db.dpu_after_dml_execute_update(dpu_id)
+            else:
+                self.log_db.dpu_after_dml_execute_update(dpu_id, executed=False)
 
         # DELETE action
         elif action == DELETE:
@@ -215,7 +430,7 @@ class DPU:
             primary_id = cdc_data["id"]
 
             new_primary_id = self.log_db.dpu_relationship_query(
-                "primary_id", primary_id
+                "primary_id", primary_id, source
             )
 
             # Delete actions are rarely encountered when I actually use them, so here you need to manually process the delete sql statement.
@@ -225,8 +440,10 @@ class DPU:
 
             row_count = self.target_db.insert_and_update(delete_sql)
 
-            if row_count != 0:
+            if row_count != 0 and row_count is not None:
                 self.log_db.dpu_after_dml_execute_update(dpu_id)
+            else:
+                self.log_db.dpu_after_dml_execute_update(dpu_id, executed=False)
 
         else:
             pass
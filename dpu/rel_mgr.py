@@ -0,0 +1,135 @@
+import csv
+import datetime
+import gzip
+import time
+from pathlib import Path
+
+REL_DEFAULT_BATCH_SIZE = 5000
+REL_FILE_COLUMNS = ("field_define", "old_id", "new_id")
+
+
+def _open(path: Path, mode: str):
+    """
+    Text file of relationships, gzip compressed when the name ends with .gz
+    """
+    if path.suffix == ".gz":
+        return gzip.open(path, f"{mode}t", newline="")
+    return open(path, mode, newline="")
+
+
+class RelationshipCommand:
+    """
+    The RelationshipCommand class exports and imports the DPU relationships of db_rel (--mode rel export|import),
+    e.g. to seed the ID mappings of the rows copied by an earlier migration before the DPU starts, or to move the
+    relationships of a target to another log database. Files are CSV with a field_define, old_id, new_id header,
+    gzip compressed when the name ends with .gz. An imported relationship replaces the target ID of an existing one.
+
+    Attributes:
+        log_db (LogDBConnection): Connection object for the log database, relationships of its target.
+        batch_size (int): Relationships read or written per statement.
+
+    Methods:
+        export_file(path, field_define): Writes the relationships to a file in primary key order.
+        import_file(path, field_define): Creates or replaces the relationships of a file.
+    """
+
+    def __init__(self, target: str = None, log_db=None, batch_size: int = REL_DEFAULT_BATCH_SIZE):
+        """
+        Args:
+            target (str, optional): Name of the target in target_databases whose relationships are used.
+            log_db (optional): Log database connection to use instead of connecting to the log MariaDB.
+            batch_size (int, optional): Relationships per statement.
+        """
+
+        from dpu.queue_processor import LOG_MARIADB_SETTINGS
+        from utils import LogDBConnection, target_configs
+
+        if target is not None and target not in [target_config["name"] for target_config in target_configs()]:
+            raise ValueError(f"Unknown target: {target}")
+        if log_db is None:
+            log_db = LogDBConnection(
+                host=LOG_MARIADB_SETTINGS["host"],
+                port=LOG_MARIADB_SETTINGS["port"],
+                user=LOG_MARIADB_SETTINGS["user"],
+                password=LOG_MARIADB_SETTINGS["passwd"],
+            )
+        log_db.target = target
+        self.log_db = log_db
+        self.batch_size = batch_size
+
+    def export_file(self, path: Path, field_define: str = None) -> int:
+        """
+        Writes the relationships of the target to a file
+        :param path: CSV file, .csv.gz for a compressed file
+        :param field_define: only the relationships of this field
+        :return: number of exported relationships
+        """
+        start = time.perf_counter()
+        exported = 0
+        after = None
+        path.parent.mkdir(exist_ok=True, parents=True)
+        with _open(path, "w") as rel_file:
+            writer = csv.writer(rel_file)
+            writer.writerow(REL_FILE_COLUMNS)
+            while True:
+                rows = self.log_db.dpu_relationship_export(field_define, after=after, limit=self.batch_size)
+                if not rows:
+                    break
+                writer.writerows(rows)
+                exported += len(rows)
+                after = rows[-1][:2]
+        print(
+            f"{datetime.datetime.now()} | Relationship export: {exported} relationships written to {path} "
+            f"in {time.perf_counter() - start:.1f} s",
+            flush=True,
+        )
+        return exported
+
+    def _rows(self, path: Path, field_define: str = None):
+        """
+        (field_define, old_id, new_id) of the lines of a file
+        :param path:
+        :param field_define: field of a file with the old_id and new_id columns only, replaces the field_define column
+        :return:
+        """
+        with _open(path, "r") as rel_file:
+            reader = csv.DictReader(rel_file)
+            if not {"old_id", "new_id"} <= set(reader.fieldnames or ()):
+                raise ValueError(f"{path}: the header needs the old_id and new_id columns")
+            if field_define is None and "field_define" not in reader.fieldnames:
+                raise ValueError(f"{path}: no field_define column, select the field with --field")
+            for row in reader:
+                try:
+                    yield field_define or row["field_define"], int(row["old_id"]), int(row["new_id"])
+                except (TypeError, ValueError) as e:
+                    raise ValueError(f"{path}:{reader.line_num}: invalid relationship {row}") from e
+
+    def import_file(self, path: Path, field_define: str = None) -> tuple:
+        """
+        Creates the relationships of a file, existing relationships of the same IDs get the new target ID
+        :param path: CSV file, .csv.gz for a compressed file
+        :param field_define: field of a file with the old_id and new_id columns only
+        :return: (relationships read, affected rows: 1 per created and 2 per replaced relationship)
+        """
+        start = time.perf_counter()
+        read = affected = 0
+        batch = []
+        for relationship in self._rows(path, field_define):
+            batch.append(relationship)
+            if len(batch) >= self.batch_size:
+                affected += self.log_db.dpu_relationship_create_many(batch)
+                read += len(batch)
+                batch = []
+        if batch:
+            affected += self.log_db.dpu_relationship_create_many(batch)
+            read += len(batch)
+        print(
+            f"{datetime.datetime.now()} | Relationship import: {read} relationships read from {path}, "
+            f"{affected} rows affected in {time.perf_counter() - start:.1f} s",
+            flush=True,
+        )
+        return read, affected
+
+
+if __name__ == "__main__":
+    pass
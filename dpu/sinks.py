@@ -0,0 +1,357 @@
+import abc
+import base64
+import csv
+import gzip
+import io
+import json
+import re
+import sqlite3
+import time
+from pathlib import Path
+
+from field_mappings import field_mappings, field_mappings_raw
+from spill import SpillRef
+
+SINK_DEFAULT_BATCH_SIZE = 1000
+# A buffered batch is written once its first row change is this old, even while the queue still holds events
+SINK_DEFAULT_FLUSH_SECONDS = 1
+SINK_DEFAULT_KEY_COLUMN = "id"
+SINK_DEFAULT_COMPRESS_LEVEL = 6
+
+# Columns of the file sinks describing the change, followed by the columns of the table
+FILE_META_COLUMNS = ("op", "cdc_id", "source", "log_file", "log_pos", "log_dt")
+# Marks a spilled value in a line of a file sink, replaced by the value copied from its side file
+_SPILL_TOKEN = "\ufffe{}\ufffe"
+_SPILL_TOKEN_PATTERN = re.compile("\ufffe(\\d+)\ufffe")
+
+
+def target_columns(table: str) -> dict:
+    """
+    Source column -> target column of a table, tables without a target mapping keep the source column names
+    :param table:
+    :return:
+    """
+    source_columns = field_mappings_raw.get(table, {})
+    if table not in field_mappings:
+        return {column: column for column in source_columns.values()}
+    return {source_columns[i]: column for i, column in field_mappings[table].items() if i in source_columns}
+
+
+class RowChange:
+    """
+    One row change handed to a sink: values by target column, ``before`` holds the values before an update.
+    Spilled values stay SpillRef until the batch is written, a buffered batch does not hold them in memory.
+    """
+
+    __slots__ = ("raw", "table", "action", "values", "before")
+
+    def __init__(self, raw, table: str, action: str, values: dict, before: dict = None):
+        self.raw = raw
+        self.table = table
+        self.action = action
+        self.values = values
+        self.before = before
+
+
+def row_change(raw) -> RowChange:
+    """
+    Row change of an event with the source columns renamed to the target columns
+    :param raw: event
+    :return:
+    """
+    columns = target_columns(raw["table"])
+
+    def mapped(data: dict) -> dict:
+        return {columns[column]: value for column, value in data.items() if column in columns}
+
+    data = raw["data"]
+    if raw["action"] == "update":
+        return RowChange(raw, raw["table"], "update", mapped(data["after_values"]), mapped(data["before_values"]))
+    return RowChange(raw, raw["table"], raw["action"], mapped(data))
+
+
+class Sink(abc.ABC):
+    """
+    Target of the DPU apply path other than a MySQL server. Row changes are buffered and written in batches,
+    a batch is written when it is full, when it is flush_seconds old and whenever the DPU queue runs empty.
+    The DPU acknowledges the events of a batch once it is written, a crash writes the batch again after the restart.
+
+    Attributes:
+        batch_size (int): Number of buffered row changes written at once.
+        flush_seconds (float): Age of the first buffered row change at which the batch is written.
+        key_columns (dict): Per table, the target column identifying a row (the "id" column by default).
+        buffer (list): RowChange objects not yet written.
+        buffered (float): time.monotonic() of the first buffered row change.
+
+    Methods:
+        write(change): Buffers a row change, returns whether the batch is full.
+        due(): Whether the buffered batch is flush_seconds old.
+        flush(): Writes the buffered row changes, returns them.
+        discard(): Drops the buffered row changes after a failed flush.
+        close(): Flushes and releases the files or connections.
+    """
+
+    def __init__(self, sink_config: dict):
+        self.batch_size = sink_config.get("batch_size", SINK_DEFAULT_BATCH_SIZE)
+        self.flush_seconds = sink_config.get("flush_seconds", SINK_DEFAULT_FLUSH_SECONDS)
+        self.key_columns = sink_config.get("key_columns") or {}
+        self.buffer = []
+        self.buffered = None
+
+    def key_column(self, table: str) -> str:
+        return self.key_columns.get(table, SINK_DEFAULT_KEY_COLUMN)
+
+    def write(self, change: RowChange) -> bool:
+        if not self.buffer:
+            self.buffered = time.monotonic()
+        self.buffer.append(change)
+        return len(self.buffer) >= self.batch_size
+
+    def due(self) -> bool:
+        return bool(self.buffer) and time.monotonic() - self.buffered >= self.flush_seconds
+
+    def flush(self) -> list:
+        """
+        Writes the buffered row changes, they stay buffered if the write fails
+        :return: the written row changes
+        """
+        changes = self.buffer
+        if changes:
+            self._write_batch(changes)
+            self.buffer = []
+        return changes
+
+    def discard(self) -> list:
+        """
+        Drops the buffered row changes
+        :return: events of the dropped row changes
+        """
+        events = [change.raw for change in self.buffer]
+        self.buffer = []
+        return events
+
+    @abc.abstractmethod
+    def _write_batch(self, changes: list):
+        """
+        Writes a batch of row changes
+        :param changes:
+        :return:
+        """
+
+    def close(self):
+        self.flush()
+
+
+def _read_spilled(params: list):
+    """
+    Parameters of an executemany with the spilled values read row by row, while the row is bound
+    """
+    for row in params:
+        yield tuple(value.read() if isinstance(value, SpillRef) else value for value in row)
+
+
+class SQLiteSink(Sink):
+    """
+    Applies the row changes to a SQLite database, one table per source table with the target columns.
+    Inserts and updates are upserts on the key column, consecutive changes of the same kind are written with one
+    executemany, a batch is one transaction. Spilled values are read one row at a time.
+    """
+
+    def __init__(self, path: Path, sink_config: dict):
+        super().__init__(sink_config)
+        path.parent.mkdir(exist_ok=True, parents=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.tables = set()
+
+    def _create_table(self, table: str):
+        columns = list(dict.fromkeys(target_columns(table).values()))
+        key_column = self.key_column(table)
+        column_defs = ", ".join(f'"{column}"' for column in columns)
+        primary_key = f', primary key ("{key_column}")' if key_column in columns else ""
+        self.connection.execute(f'create table if not exists "{table}" ({column_defs}{primary_key});')
+        self.tables.add(table)
+
+    def _write_batch(self, changes: list):
+        # Consecutive changes of the same statement are grouped, the order of the changes is kept
+        groups = []
+        for change in changes:
+            if change.table not in self.tables:
+                self._create_table(change.table)
+            key_column = self.key_column(change.table)
+            if change.action == "delete":
+                statement = f'delete from "{change.table}" where "{key_column}" = ?;'
+                params = (change.values.get(key_column),)
+            else:
+                if change.before is not None and change.before.get(key_column) != change.values.get(key_column):
+                    groups.append((
+                        f'delete from "{change.table}" where "{key_column}" = ?;',
+                        [(change.before.get(key_column),)],
+                    ))
+                column_list = ", ".join(f'"{column}"' for column in change.values)
+                placeholders = ", ".join("?" * len(change.values))
+                statement = f'insert or replace into "{change.table}" ({column_list}) values ({placeholders});'
+                params = tuple(change.values.values())
+            if groups and groups[-1][0] == statement:
+                groups[-1][1].append(params)
+            else:
+                groups.append((statement, [params]))
+
+        with self.connection:
+            for statement, params in groups:
+                self.connection.executemany(statement, _read_spilled(params))
+
+    def close(self):
+        super().close()
+        self.connection.close()
+
+
+def _file_value(value, spilled: list):
+    """
+    Value written to a JSON/CSV file, binary values as base64. A spilled value is replaced by a token
+    and added to ``spilled``, it is copied from its side file when the line is written.
+    """
+    if isinstance(value, SpillRef):
+        spilled.append(value)
+        return _SPILL_TOKEN.format(len(spilled) - 1)
+    if isinstance(value, (bytes, bytearray)):
+        return base64.b64encode(value).decode()
+    return value
+
+
+def _spilled_chunks(ref: SpillRef):
+    """
+    Chunks of a spilled value as written to a file, binary values as base64
+    """
+    for chunk in ref.chunks():
+        yield chunk if ref.text else base64.b64encode(chunk).decode()
+
+
+def _write_line(partition_file, line: str, spilled: list, file_format: str):
+    """
+    Writes a line of a file sink, the spilled values are copied from their side files in chunks
+    (escaped for JSON, quoted for CSV) in place of their tokens
+    """
+    if not spilled:
+        partition_file.write(line)
+        return
+    parts = _SPILL_TOKEN_PATTERN.split(line)
+    partition_file.write(parts[0])
+    for i in range(1, len(parts), 2):
+        ref = spilled[int(parts[i])]
+        if file_format == "csv":
+            partition_file.write('"')
+            for chunk in _spilled_chunks(ref):
+                partition_file.write(chunk.replace('"', '""'))
+            partition_file.write('"')
+        else:
+            # The token is inside the quotes of the JSON string
+            for chunk in _spilled_chunks(ref):
+                partition_file.write(json.dumps(chunk, ensure_ascii=False)[1:-1])
+        partition_file.write(parts[i + 1])
+
+
+class FileSink(Sink):
+    """
+    Appends the row changes to JSON Lines or CSV files partitioned by table and hour of the binlog event
+    (``<path>/<table>/<YYYY-MM-DD-HH>.jsonl.gz``). A file is closed once a later hour of its table is written,
+    gzip files are written as one member per batch so a reader sees every completed batch.
+    """
+
+    def __init__(self, path: Path, file_format: str, sink_config: dict):
+        super().__init__(sink_config)
+        self.path = path
+        self.format = file_format
+        self.compress = sink_config.get("compress", True)
+        self.compress_level = sink_config.get("compress_level", SINK_DEFAULT_COMPRESS_LEVEL)
+        # table -> (hour, file)
+        self.files = {}
+
+    def _file(self, table: str, hour: str):
+        current = self.files.get(table)
+        if current is not None:
+            if current[0] == hour:
+                return current[1]
+            current[1].close()
+
+        suffix = f".{self.format}" + (".gz" if self.compress else "")
+        path = Path(self.path, table, f"{hour}{suffix}")
+        path.parent.mkdir(exist_ok=True, parents=True)
+        new_file = not path.exists()
+        partition_file = gzip.open(path, "at", compresslevel=self.compress_level, newline="") if self.compress else open(path, "a", newline="")
+        if self.format == "csv" and new_file:
+            csv.writer(partition_file).writerow([*FILE_META_COLUMNS, *dict.fromkeys(target_columns(table).values())])
+        self.files[table] = (hour, partition_file)
+        return partition_file
+
+    def _record(self, change: RowChange) -> dict:
+        raw = change.raw
+        return {
+            "op": change.action,
+            "cdc_id": raw["cdc_id"],
+            "source": raw.get("source"),
+            "log_file": raw["log_file"],
+            "log_pos": raw["log_pos"],
+            "log_dt": raw["log_dt"],
+        }
+
+    def _write_batch(self, changes: list):
+        written = set()
+        for change in changes:
+            hour = str(change.raw["log_dt"])[:13].replace(" ", "-")
+            partition_file = self._file(change.table, hour)
+            record = self._record(change)
+            spilled = []
+            if self.format == "csv":
+                columns = dict.fromkeys(target_columns(change.table).values())
+                line = io.StringIO(newline="")
+                csv.writer(line).writerow(
+                    [*record.values(), *(_file_value(change.values.get(column), spilled) for column in columns)]
+                )
+                line = line.getvalue()
+            else:
+                record["data"] = {column: _file_value(value, spilled) for column, value in change.values.items()}
+                if change.before is not None:
+                    record["before"] = {
+                        column: _file_value(value, spilled) for column, value in change.before.items()
+                    }
+                line = json.dumps(record, ensure_ascii=False, default=str) + "\n"
+            _write_line(partition_file, line, spilled, self.format)
+            written.add(change.table)
+
+        for table in written:
+            partition_file = self.files[table][1]
+            # Ends the gzip member, the batch is readable before the file is closed
+            if self.compress:
+                partition_file.close()
+                del self.files[table]
+            else:
+                partition_file.flush()
+
+    def close(self):
+        super().close()
+        for _, partition_file in self.files.values():
+            partition_file.close()
+        self.files = {}
+
+
+SINK_TYPES = ("sqlite", "jsonl", "csv")
+
+
+def sink_init(target: dict, base_path: Path) -> Sink:
+    """
+    Sink of a target of type sqlite, jsonl or csv
+    :param target: target_database section or entry of target_databases
+    :param base_path: data directory, relative paths are resolved against it
+    :return:
+    """
+    sink_type = target["type"]
+    if sink_type not in SINK_TYPES:
+        raise ValueError(f"Unknown target type: {sink_type}")
+    path = Path(base_path, target.get("path") or f"sinks/{target.get('name') or 'target'}")
+    if sink_type == "sqlite":
+        return SQLiteSink(path, target)
+    return FileSink(path, sink_type, target)
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,481 @@
+import datetime
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pymysql
+
+from field_mappings import field_mappings, field_mappings_raw
+from utils import (
+    LogDBConnection,
+    config_data,
+    dict_to_hash,
+    log_init,
+    query_primary_key,
+    PROJECT_NAME,
+    LOG_DB_PASSWORD,
+    LOG_PATH,
+)
+
+VERIFY_DEFAULT_WORKERS = 4
+VERIFY_DEFAULT_CHUNK_SIZE = 10000
+VERIFY_DEFAULT_ROW_THRESHOLD = 64
+
+MISSING = "missing"
+EXTRA = "extra"
+DIFFERENT = "different"
+
+
+def _row_checksum_expression(columns: list) -> str:
+    """
+    Builds a server-side CRC32 expression over a list of columns, NULL and empty string are distinguished.
+    :param columns:
+    :return:
+    """
+    if not columns:
+        return "0"
+    parts = ", ".join(f"isnull(`{column}`), `{column}`" for column in columns)
+    return f"crc32(concat_ws('#', {parts}))"
+
+
+class Verifier:
+    """
+    The Verifier class checks that the target database is consistent with the source database.
+    Every table is split into primary-key chunks that are compared in parallel.
+
+    Tables without relationship columns are compared with server-side chunk checksums (row count and the sum of the
+    CRC32 of every row), chunks that differ are bisected until they are small enough to compare row checksums.
+    Tables with relationship columns (IDs translated by the DPU through db_rel) are compared row by row, the source
+    IDs are translated through db_rel and only the key, the translated IDs and a server-side checksum of the other
+    columns are fetched. Target rows no source row maps to are reported as extra, when the primary key itself is
+    translated the target is scanned in chunks of its own keys once the source chunks are compared.
+    Column renames are taken from field_mappings.
+
+    Attributes:
+        error_logger (Logger): Logger instance for capturing errors.
+        tables (list): Tables to verify.
+        workers (int): Number of chunks compared in parallel.
+        chunk_size (int): Number of rows per chunk.
+        row_threshold (int): Number of rows of a chunk at or below which row checksums are compared.
+        relationships (dict): Per table, target column -> db_rel field_define.
+
+    Methods:
+        start(): Verifies all tables and writes the report.
+        table_plan(table): Builds the column pairs, primary key and chunks of a table.
+        verify_chunk(plan, lower, upper): Compares one chunk and returns the mismatched keys.
+        extra_target_keys(plan, lower, upper): Target keys of a chunk no source row maps to.
+    """
+
+    def __init__(self):
+        """
+        Initializes the Verifier instance with the source, target and log database settings.
+        """
+
+        print(f"\n\n{datetime.datetime.now()} | ==========DMP SERVER DPU-Verify START==========")
+        print(f"{datetime.datetime.now()} | Project: {PROJECT_NAME}")
+
+        _, _, self.error_logger = log_init()
+
+        self.SOURCE_MYSQL_SETTINGS = {
+            "host": config_data["source_database"]["host"],
+            "port": config_data["source_database"]["port"],
+            "user": config_data["source_database"]["user"],
+            "passwd": config_data["source_database"]["passwd"],
+            "schemas": config_data["source_database"]["schemas"],
+        }
+        self.TARGET_MYSQL_SETTINGS = {
+            "host": config_data["target_database"]["host"],
+            "port": config_data["target_database"]["port"],
+            "user": config_data["target_database"]["user"],
+            "passwd": config_data["target_database"]["passwd"],
+            "schemas": config_data["target_database"]["schemas"],
+        }
+        # If the verifier is running inside a docker container, there is no need to change the following log database connections.
+        self.LOG_MARIADB_SETTINGS = {
+            "host": "db",
+            "port": 3306,
+            "user": "root",
+            "passwd": LOG_DB_PASSWORD,
+        }
+
+        verify_config = config_data.get("verify") or {}
+        self.tables = verify_config.get("tables") or [
+            table for table in field_mappings_raw if table in field_mappings
+        ]
+        self.workers = verify_config.get("workers", VERIFY_DEFAULT_WORKERS)
+        self.chunk_size = verify_config.get("chunk_size", VERIFY_DEFAULT_CHUNK_SIZE)
+        self.row_threshold = verify_config.get("row_threshold", VERIFY_DEFAULT_ROW_THRESHOLD)
+        self.relationships = verify_config.get("relationships") or {}
+
+        # Every worker thread keeps its own connections
+        self._local = threading.local()
+
+    @staticmethod
+    def _connect(settings: dict):
+        """
+        Opens a connection to the source or target database.
+        """
+
+        return pymysql.connect(
+            host=settings["host"],
+            port=settings["port"],
+            user=settings["user"],
+            password=settings["passwd"],
+            database=settings["schemas"],
+        )
+
+    def _thread_connections(self) -> tuple:
+        """
+        Returns the (source, target, log database) connections of the current worker thread.
+        """
+
+        if getattr(self._local, "source", None) is None:
+            self._local.source = self._connect(self.SOURCE_MYSQL_SETTINGS)
+            self._local.target = self._connect(self.TARGET_MYSQL_SETTINGS)
+            self._local.log_db = LogDBConnection(
+                host=self.LOG_MARIADB_SETTINGS["host"],
+                port=self.LOG_MARIADB_SETTINGS["port"],
+                user=self.LOG_MARIADB_SETTINGS["user"],
+                password=self.LOG_MARIADB_SETTINGS["passwd"],
+            )
+        return self._local.source, self._local.target, self._local.log_db
+
+    def start(self):
+        """
+        Verifies all configured tables in parallel chunks and writes the report to the log directory.
+        """
+
+        plans = [self.table_plan(table) for table in self.tables]
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [
+                (plan, executor.submit(self.verify_chunk, plan, lower, upper))
+                for plan in plans
+                for lower, upper in plan["chunks"]
+            ]
+            report = {plan["table"]: [] for plan in plans}
+            for plan, future in futures:
+                report[plan["table"]].extend(future.result())
+
+            # The target keys of translated primary keys are known once every source chunk is compared
+            futures = [
+                (plan, executor.submit(self.extra_target_keys, plan, lower, upper))
+                for plan in plans if plan["expected_target_keys"] is not None
+                for lower, upper in plan["target_chunks"]
+            ]
+            for plan, future in futures:
+                report[plan["table"]].extend(future.result())
+
+        for table, mismatches in report.items():
+            print(f"{datetime.datetime.now()} | Verify table {table}: {len(mismatches)} mismatched key(s)")
+            for mismatch in mismatches[:20]:
+                print(f"{datetime.datetime.now()} |     {mismatch}")
+
+        LOG_PATH.mkdir(exist_ok=True, parents=True)
+        report_path = Path(LOG_PATH, f"verify_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+        with open(report_path, "w") as report_file:
+            json.dump(report, report_file, indent=2, default=str)
+        print(f"{datetime.datetime.now()} | Verify report written to {report_path}")
+
+        return report
+
+    def table_plan(self, table: str) -> dict:
+        """
+        Builds the comparison plan of a table.
+
+        Args:
+            table (str): Table name.
+
+        Returns:
+            dict: table, source/target primary key, source/target checksum columns, translated columns and chunks.
+        """
+
+        source, target, _ = self._thread_connections()
+
+        primary_key = query_primary_key(source, self.SOURCE_MYSQL_SETTINGS["schemas"], table)
+        if len(primary_key) != 1 or "int" not in primary_key[0][1]:
+            raise ValueError(f"Table {table} has no single integer primary key, it cannot be verified in chunks")
+        source_primary_key = primary_key[0][0]
+
+        # Column pairs in the same position of both mappings
+        source_columns = field_mappings_raw[table]
+        target_columns = field_mappings[table]
+        pairs = [
+            (source_columns[i], target_columns[i])
+            for i in sorted(source_columns)
+            if i in target_columns
+        ]
+        target_primary_key = dict(pairs)[source_primary_key]
+
+        relationships = self.relationships.get(table) or {}
+        # (source column, target column, field_define) of the columns translated through db_rel
+        translated = [
+            (source_column, target_column, relationships[target_column])
+            for source_column, target_column in pairs
+            if target_column in relationships
+        ]
+        checksum_pairs = [
+            (source_column, target_column)
+            for source_column, target_column in pairs
+            if target_column not in relationships and source_column != source_primary_key
+        ]
+
+        primary_key_translated = target_primary_key in relationships
+        source_bounds = self._chunk_bounds(source, table, source_primary_key)
+        target_bounds = self._chunk_bounds(target, table, target_primary_key)
+        if primary_key_translated:
+            # Source and target keys differ, the target keys are checked against the translated source keys
+            chunks = self._chunks(source_bounds)
+            target_chunks = self._chunks(target_bounds)
+        else:
+            # Chunks cover the keys of both sides, target rows beyond the source keys are extra
+            chunks = self._chunks(source_bounds, target_bounds)
+            target_chunks = []
+
+        print(f"{datetime.datetime.now()} | Verify table {table}: {len(chunks)} chunk(s), "
+              f"{'row' if translated else 'server-side chunk'} checksums")
+
+        return {
+            "table": table,
+            "source_primary_key": source_primary_key,
+            "target_primary_key": target_primary_key,
+            "source_columns": [pair[0] for pair in checksum_pairs],
+            "target_columns": [pair[1] for pair in checksum_pairs],
+            "translated": translated,
+            "chunks": chunks,
+            "target_chunks": target_chunks,
+            # Target keys the source rows map to, collected by the source chunks of a translated primary key
+            "expected_target_keys": set() if primary_key_translated else None,
+            "lock": threading.Lock(),
+        }
+
+    def _chunk_bounds(self, connection, table: str, primary_key: str) -> list:
+        """
+        Keys starting the chunks of ``chunk_size`` rows of a table and the highest key + 1, empty if the table is empty.
+        The bounds are walked on the primary key index (keyset: the ``chunk_size``-th key after the previous bound),
+        so sparse keys make no empty chunks.
+        """
+
+        lower, upper = self._query(connection, f"select min(`{primary_key}`), max(`{primary_key}`) from `{table}`;")[0]
+        if lower is None:
+            return []
+        bounds = [lower]
+        _sql = f"select `{primary_key}` from `{table}` where `{primary_key}` > %s order by `{primary_key}` limit %s, 1;"
+        while True:
+            rows = self._query(connection, _sql, (bounds[-1], self.chunk_size - 1))
+            if not rows:
+                break
+            bounds.append(rows[0][0])
+        bounds.append(upper + 1)
+        return bounds
+
+    @staticmethod
+    def _chunks(*bounds) -> list:
+        """
+        Primary key chunks [lower, upper) between the chunk bounds of one or both sides,
+        a chunk holds at most ``chunk_size`` rows of each side.
+        """
+
+        keys = sorted(set().union(*bounds))
+        return list(zip(keys, keys[1:]))
+
+    def verify_chunk(self, plan: dict, lower: int, upper: int) -> list:
+        """
+        Compares one chunk of a table.
+
+        Args:
+            plan (dict): Comparison plan as returned by ``table_plan``.
+            lower (int): Lower primary key bound (inclusive).
+            upper (int): Upper primary key bound (exclusive).
+
+        Returns:
+            list: Mismatches, dictionaries of key, target key and issue (missing, extra or different).
+        """
+
+        try:
+            if plan["translated"]:
+                return self._compare_translated_rows(plan, lower, upper)
+            return self._bisect(plan, lower, upper)
+        except Exception as e:
+            self.error_logger.error(f"Verify chunk {plan['table']} [{lower}, {upper}) failed: {e}")
+            raise
+
+    @staticmethod
+    def _query(connection, sql: str, args=None) -> tuple:
+        """
+        Runs a read query and returns all rows.
+        """
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, args)
+            rows = cursor.fetchall()
+        connection.commit()
+        return rows
+
+    def _chunk_checksum(self, connection, table: str, primary_key: str, columns: list, lower: int, upper: int) -> tuple:
+        """
+        Computes the server-side checksum of a chunk: (row count, sum of row CRC32).
+        """
+
+        _sql = f"""select count(*), coalesce(sum({_row_checksum_expression([primary_key] + columns)}), 0)
+        from `{table}`
+        where `{primary_key}` >= %s
+          and `{primary_key}` < %s;"""
+        count, checksum = self._query(connection, _sql, (lower, upper))[0]
+        return count, int(checksum)
+
+    def _row_checksums(self, connection, table: str, primary_key: str, columns: list, lower: int, upper: int) -> dict:
+        """
+        Computes the server-side checksum of every row of a chunk.
+        """
+
+        _sql = f"""select `{primary_key}`, {_row_checksum_expression(columns)}
+        from `{table}`
+        where `{primary_key}` >= %s
+          and `{primary_key}` < %s;"""
+        return dict(self._query(connection, _sql, (lower, upper)))
+
+    def _bisect(self, plan: dict, lower: int, upper: int) -> list:
+        """
+        Compares the chunk checksums of both sides and bisects differing chunks down to row checksums.
+        """
+
+        source, target, _ = self._thread_connections()
+        table = plan["table"]
+
+        source_checksum = self._chunk_checksum(
+            source, table, plan["source_primary_key"], plan["source_columns"], lower, upper
+        )
+        target_checksum = self._chunk_checksum(
+            target, table, plan["target_primary_key"], plan["target_columns"], lower, upper
+        )
+        if source_checksum == target_checksum:
+            return []
+
+        # Bisected by row count, the key range of a few rows with sparse keys may be wide
+        if max(source_checksum[0], target_checksum[0]) > self.row_threshold and upper - lower > 1:
+            middle = (lower + upper) // 2
+            return self._bisect(plan, lower, middle) + self._bisect(plan, middle, upper)
+
+        source_rows = self._row_checksums(
+            source, table, plan["source_primary_key"], plan["source_columns"], lower, upper
+        )
+        target_rows = self._row_checksums(
+            target, table, plan["target_primary_key"], plan["target_columns"], lower, upper
+        )
+
+        mismatches = []
+        for key in sorted(source_rows.keys() | target_rows.keys()):
+            if key not in target_rows:
+                mismatches.append({"key": key, "target_key": None, "issue": MISSING})
+            elif key not in source_rows:
+                mismatches.append({"key": None, "target_key": key, "issue": EXTRA})
+            elif source_rows[key] != target_rows[key]:
+                mismatches.append({"key": key, "target_key": key, "issue": DIFFERENT})
+        return mismatches
+
+    def _compare_translated_rows(self, plan: dict, lower: int, upper: int) -> list:
+        """
+        Compares a chunk row by row, translating the source IDs through db_rel.
+        Only the key, the relationship columns and a server-side checksum of the other columns are fetched.
+        """
+
+        source, target, log_db = self._thread_connections()
+        table = plan["table"]
+        source_primary_key = plan["source_primary_key"]
+        target_primary_key = plan["target_primary_key"]
+        translated_source_columns = [
+            f"`{source_column}`" for source_column, _, _ in plan["translated"] if source_column != source_primary_key
+        ]
+        translated_target_columns = [
+            f"`{target_column}`" for _, target_column, _ in plan["translated"] if target_column != target_primary_key
+        ]
+
+        _sql = f"""select `{source_primary_key}`, {", ".join(translated_source_columns + [_row_checksum_expression(plan["source_columns"])])}
+        from `{table}`
+        where `{source_primary_key}` >= %s
+          and `{source_primary_key}` < %s;"""
+        source_rows = self._query(source, _sql, (lower, upper))
+
+        # Translate every relationship column of the chunk with one db_rel query per field
+        translations = {}
+        for source_column, _, field_define in plan["translated"]:
+            if source_column == source_primary_key:
+                index = 0
+            else:
+                index = translated_source_columns.index(f"`{source_column}`") + 1
+            translations[index] = log_db.dpu_relationship_query_many(
+                field_define, {row[index] for row in source_rows if row[index] is not None}
+            )
+
+        # source key -> (expected target key, expected row hash)
+        expected = {}
+        for row in source_rows:
+            row = list(row)
+            source_key = row[0]
+            for index, relationship in translations.items():
+                row[index] = relationship.get(row[index], row[index])
+            expected[source_key] = (row[0], dict_to_hash({"values": row[1:]}))
+
+        target_keys = [target_key for target_key, _ in expected.values()]
+        target_rows = {}
+        for i in range(0, len(target_keys), 1000):
+            batch = target_keys[i:i + 1000]
+            _sql = f"""select `{target_primary_key}`, {", ".join(translated_target_columns + [_row_checksum_expression(plan["target_columns"])])}
+            from `{table}`
+            where `{target_primary_key}` in ({", ".join(["%s"] * len(batch))});"""
+            for row in self._query(target, _sql, batch):
+                target_rows[row[0]] = dict_to_hash({"values": list(row[1:])})
+
+        mismatches = []
+        for source_key, (target_key, source_hash) in expected.items():
+            target_hash = target_rows.get(target_key)
+            if target_hash is None:
+                mismatches.append({"key": source_key, "target_key": target_key, "issue": MISSING})
+            elif target_hash != source_hash:
+                mismatches.append({"key": source_key, "target_key": target_key, "issue": DIFFERENT})
+
+        if plan["expected_target_keys"] is not None:
+            with plan["lock"]:
+                plan["expected_target_keys"].update(target_keys)
+        else:
+            # Same keys on both sides, the target rows of the chunk without a source row are extra
+            _sql = f"""select `{target_primary_key}`
+            from `{table}`
+            where `{target_primary_key}` >= %s
+              and `{target_primary_key}` < %s;"""
+            for (target_key,) in self._query(target, _sql, (lower, upper)):
+                if target_key not in expected:
+                    mismatches.append({"key": None, "target_key": target_key, "issue": EXTRA})
+        return mismatches
+
+    def extra_target_keys(self, plan: dict, lower: int, upper: int) -> list:
+        """
+        Reports the target rows of a chunk of target keys that no source row maps to, for a table whose primary key
+        is translated through db_rel. Runs once every source chunk of the table is compared.
+
+        Args:
+            plan (dict): Comparison plan as returned by ``table_plan``.
+            lower (int): Lower target primary key bound (inclusive).
+            upper (int): Upper target primary key bound (exclusive).
+
+        Returns:
+            list: Mismatches with the extra issue.
+        """
+
+        _, target, _ = self._thread_connections()
+        target_primary_key = plan["target_primary_key"]
+        _sql = f"""select `{target_primary_key}`
+        from `{plan["table"]}`
+        where `{target_primary_key}` >= %s
+          and `{target_primary_key}` < %s;"""
+        return [
+            {"key": None, "target_key": target_key, "issue": EXTRA}
+            for (target_key,) in self._query(target, _sql, (lower, upper))
+            if target_key not in plan["expected_target_keys"]
+        ]
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,280 @@
+import collections
+import datetime
+import os
+import signal
+import sys
+import threading
+import time
+
+from spill import spill_store
+from stats import stats_inc, stats_set
+from utils import config_data
+
+PARALLEL_APPLY_DEFAULT_WORKERS = 4
+PARALLEL_APPLY_DEFAULT_WINDOW = 1000
+# Rows are identified by the "id" column unless configured in dead_letter.key_columns
+WRITE_SET_DEFAULT_KEY_COLUMN = "id"
+
+
+def write_set(raw, key_columns: dict, relationships: dict):
+    """
+    Items an event writes or reads: its row (table and key column) before and after the change, and the db_rel IDs
+    of its relationship columns. Two events sharing an item are applied in queue order.
+    :param raw: event
+    :param key_columns: per table, the source column identifying a row
+    :param relationships: per table, source column: field_define of the columns translated through db_rel
+    :return: frozenset of items, None if the row key is missing (the event is applied alone)
+    """
+    table = raw["table"]
+    data = raw["data"]
+    rows = (data["before_values"], data["after_values"]) if raw["action"] == "update" else (data,)
+    key_column = key_columns.get(table, WRITE_SET_DEFAULT_KEY_COLUMN)
+    source = raw.get("source")
+
+    items = set()
+    for values in rows:
+        key = values.get(key_column)
+        if key is None:
+            return None
+        items.add(("row", source, table, str(key)))
+        for column, field_define in (relationships.get(table) or {}).items():
+            value = values.get(column)
+            if value is not None:
+                items.add(("rel", source, field_define, str(value)))
+    return frozenset(items)
+
+
+class Task:
+    """
+    Event of the apply window with the events it waits for.
+    """
+
+    __slots__ = ("seq", "raw", "items", "waiting", "dependents", "done")
+
+    def __init__(self, seq: int, raw, items):
+        self.seq = seq
+        self.raw = raw
+        self.items = items
+        self.waiting = 0
+        self.dependents = []
+        self.done = False
+
+
+class WriteSetScheduler:
+    """
+    The WriteSetScheduler class applies the events of one queue with a pool of DPU workers (--mode dpu with
+    parallel_apply), like the WRITESET based parallel replication of MySQL. The write set of every event is computed
+    from its row key and its db_rel relationship columns, an event is handed to the next free worker once the
+    earlier events with an overlapping write set are applied. Events of different rows of one table run concurrently,
+    events of the same row, and a child row after the insert of its parent, run in queue order.
+    The events of the window are taken from the queue without removing them, a worker acknowledges an event once it is
+    applied or dead-lettered. After a crash the events of the window not applied yet are taken again in queue order,
+    the applied ones are not, and an event is never applied before the earlier events it conflicts with.
+
+    Attributes:
+        dpus (list): DPU of every worker, each with its own log and target database connections.
+        queue: Queue the events are taken from, the persistence queue (or its priority lanes) by default.
+        window (int): Events taken from the queue and not yet applied, the dispatcher waits while the window is full.
+        key_columns (dict): Per table, the source column identifying a row, dead_letter.key_columns.
+        relationships (dict): Per table, source column: field_define of the columns translated through db_rel.
+        dead_letters (DeadLetterQueue): Dead-letter queue shared by the workers.
+        applied: Last event applied with all earlier events applied, the queue keeps every event not applied yet.
+        conflicts (int): Events that waited for an earlier event.
+        failed (Exception): Error that stopped a worker thread, the DPU exits with it.
+
+    Methods:
+        dispatch(raw): Adds an event to the window, ready once its conflicting earlier events are applied.
+        start(): Starts the worker threads and dispatches the queue until interrupted.
+    """
+
+    def __init__(self, dpus: list = None, queue=None, parallel_config: dict = None, dead_letter_log_db=None):
+        """
+        Args:
+            dpus (list, optional): DPU instances of the workers, parallel_apply.workers DPUs of target_database by default.
+            queue (optional): Queue to use instead of the persistence queue.
+            parallel_config (dict, optional): parallel_apply section, from config.yml by default.
+            dead_letter_log_db (optional): Log database connection of the shared dead-letter queue.
+        """
+
+        from dpu.dead_letter import DeadLetterQueue
+        from dpu.queue_processor import DPU, LOG_MARIADB_SETTINGS
+        from utils import LogDBConnection
+
+        if parallel_config is None:
+            parallel_config = config_data.get("parallel_apply") or {}
+        if queue is None:
+            from persist_queue import EventQueue
+            queue = EventQueue
+        self.queue = queue
+        if dpus is None:
+            dpus = [DPU(queue=queue) for _ in range(parallel_config.get("workers", PARALLEL_APPLY_DEFAULT_WORKERS))]
+        if any(dpu.sink is not None for dpu in dpus):
+            raise ValueError("parallel_apply applies to a MySQL target, sink targets are written by one DPU")
+        self.dpus = dpus
+        self.window = parallel_config.get("window", PARALLEL_APPLY_DEFAULT_WINDOW)
+        self.relationships = parallel_config.get("relationships") or {}
+        self.key_columns = (config_data.get("dead_letter") or {}).get("key_columns") or {}
+
+        # Later events of a dead-lettered row are parked by whichever worker applies them
+        if dead_letter_log_db is None:
+            dead_letter_log_db = LogDBConnection(
+                host=LOG_MARIADB_SETTINGS["host"],
+                port=LOG_MARIADB_SETTINGS["port"],
+                user=LOG_MARIADB_SETTINGS["user"],
+                password=LOG_MARIADB_SETTINGS["passwd"],
+            )
+        dead_letter_log_db.target = dpus[0].target_name
+        self.dead_letters = DeadLetterQueue(dead_letter_log_db, config_data.get("dead_letter"))
+        # One lag tracker publishes the lag of all workers
+        self.lag_tracker = dpus[0].lag_tracker
+        for dpu in dpus:
+            dpu.dead_letters = self.dead_letters
+            dpu.lag_tracker = self.lag_tracker
+            # Spill files are collected by the scheduler up to the oldest unacknowledged event
+            dpu.spill_gc = False
+
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        # Tasks in queue order, the applied ones are removed from the front
+        self.pending = collections.deque()
+        self.ready = collections.deque()
+        # Write set item -> last task of the window writing it
+        self.last_writer = {}
+        # Last task without a write set, later tasks wait for it
+        self.barrier = None
+        self.seq = 0
+        self.applied = None
+        self.conflicts = 0
+        self.failed = None
+
+    def dispatch(self, raw):
+        """
+        Adds an event to the window, it is ready once the earlier events it conflicts with are applied.
+        """
+
+        items = write_set(raw, self.key_columns, self.relationships)
+        with self.changed:
+            while len(self.pending) >= self.window:
+                self.changed.wait()
+            self.seq += 1
+            task = Task(self.seq, raw, items)
+            if items is None:
+                waits_for = {pending for pending in self.pending if not pending.done}
+                self.barrier = task
+            else:
+                waits_for = set()
+                if self.barrier is not None and not self.barrier.done:
+                    waits_for.add(self.barrier)
+                for item in items:
+                    writer = self.last_writer.get(item)
+                    if writer is not None and not writer.done:
+                        waits_for.add(writer)
+                    self.last_writer[item] = task
+            for earlier in waits_for:
+                earlier.dependents.append(task)
+            task.waiting = len(waits_for)
+            self.pending.append(task)
+            if waits_for:
+                self.conflicts += 1
+                stats_inc("dfs_dpu_parallel_conflicts_total")
+            else:
+                self.ready.append(task)
+                self.changed.notify_all()
+
+    def _complete(self, task: Task):
+        """
+        Marks a task applied, releases the tasks waiting for it and advances the applied event.
+        """
+
+        with self.changed:
+            task.done = True
+            for item in task.items or ():
+                if self.last_writer.get(item) is task:
+                    del self.last_writer[item]
+            for dependent in task.dependents:
+                dependent.waiting -= 1
+                if not dependent.waiting:
+                    self.ready.append(dependent)
+            while self.pending and self.pending[0].done:
+                self.applied = self.pending.popleft().raw
+            self.changed.notify_all()
+
+    def _worker(self, dpu):
+        """
+        Worker thread, applies the ready tasks with its DPU. An error stops the DPU, the task would never complete
+        and the window would fill up otherwise.
+        """
+
+        try:
+            while True:
+                with self.changed:
+                    while not self.ready:
+                        self.changed.wait()
+                    task = self.ready.popleft()
+                dpu._handle_process_data(task.raw)
+                self._complete(task)
+                if spill_store.gc_due():
+                    try:
+                        self._spill_gc()
+                    except Exception as e:
+                        dpu.error_logger.error(f"Spill GC error: {e!r}")
+        except Exception as e:
+            self.failed = e
+            dpu.error_logger.critical(f"Parallel apply worker stopped: {e!r}")
+            stats_inc("dfs_dpu_parallel_failures_total")
+            # The SIGTERM handler in the main thread exits, the unapplied events of the window stay in the queue
+            os.kill(os.getpid(), signal.SIGTERM)
+
+    def _terminate(self, *_):
+        print(f"{datetime.datetime.now()} | Parallel apply stopped, {len(self.pending)} events of the window not applied",
+              flush=True)
+        sys.exit(1 if self.failed is not None else 0)
+
+    def _spill_gc(self):
+        """
+        Removes the spill files no queued event needs anymore, based on the capture time of the oldest event not
+        acknowledged yet. The events of the window stay in the queue until they are applied.
+        """
+
+        with self.lock:
+            if not spill_store.gc_due():
+                return
+            spill_store.last_gc = time.monotonic()
+        removed = spill_store.gc(self.queue.oldest_captured(), keep=self.dead_letters.spill_digests())
+        if removed:
+            stats_inc("dfs_spill_files_removed_total", removed)
+            print(f"{datetime.datetime.now()} | Removed {removed} spill files", flush=True)
+
+    def join(self):
+        """
+        Waits until every dispatched event is applied.
+        """
+
+        with self.changed:
+            while self.pending:
+                self.changed.wait()
+
+    def start(self, threads_only: bool = False):
+        """
+        Starts a thread per worker and dispatches the queue until interrupted.
+
+        Args:
+            threads_only (bool, optional): Only start the worker threads, events are added with dispatch().
+        """
+
+        signal.signal(signal.SIGTERM, self._terminate)
+        for i, dpu in enumerate(self.dpus):
+            threading.Thread(target=self._worker, args=(dpu,), name=f"dpu-worker-{i}", daemon=True).start()
+        print(f"{datetime.datetime.now()} | Parallel apply: {len(self.dpus)} workers, window {self.window}", flush=True)
+        if threads_only:
+            return
+        while True:
+            queue_item = self.queue.get()
+            if "stage_ts" in queue_item:
+                queue_item["stage_ts"]["dequeued"] = time.time()
+            self.dispatch(queue_item)
+            stats_set("dfs_dpu_parallel_window_events", len(self.pending))
+
+
+if __name__ == "__main__":
+    pass
@@ -1,18 +1,395 @@
 import asyncio
+import datetime
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager
 
-import persistqueue
-import tailer
-from fastapi import FastAPI
-from fastapi.responses import FileResponse
+import pymysql
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import FileResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.websockets import WebSocket
 
-from utils import Path, QUEUE_PATH, LOG_PATH
+from persist_queue import open_queue_reader, queue_paths, queue_stats, queue_usage
+from stats import read_stats, prometheus_text
+from utils import Path, LOG_PATH, STATS_PATH, QUEUE_PATH, LOG_DB_PASSWORD, LogDBConnection, config_data
 
-app = FastAPI(docs_url=None, redoc_url=None)
+QUEUE_SAMPLE_INTERVAL = 1
+METRICS_SAMPLE_INTERVAL = 1
+
+monitor_config = config_data.get("monitor") or {}
+# New log lines are batched into one websocket frame at most every N ms
+LOG_FRAME_INTERVAL_MS = monitor_config.get("log_frame_interval_ms", 200)
+# Lines buffered per client, older lines are dropped and replaced by a "skipped N lines" marker
+LOG_CLIENT_BUFFER_LINES = monitor_config.get("log_client_buffer_lines", 1000)
+# Replication lag (end-to-end p95 of the slowest table) above which the dashboards raise an alert
+LAG_ALERT_SECONDS = monitor_config.get("lag_alert_seconds", 5)
+# Default and maximum number of rows per page of the history APIs
+API_PAGE_SIZE = monitor_config.get("api_page_size", 500)
+API_MAX_PAGE_SIZE = monitor_config.get("api_max_page_size", 5000)
+UNITS = ("cdc", "dpu")
+
+
+class Broadcaster:
+    """
+    Fans out one payload per tick to every subscribed websocket.
+    Every subscriber only keeps the latest payload, so a slow client skips ticks instead of queueing them.
+    """
+
+    def __init__(self):
+        self.subscribers = set()
+        self.latest = None
+
+    def subscribe(self) -> asyncio.Queue:
+        subscriber = asyncio.Queue(maxsize=1)
+        if self.latest is not None:
+            subscriber.put_nowait(self.latest)
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: asyncio.Queue):
+        self.subscribers.discard(subscriber)
+
+    def publish(self, payload):
+        self.latest = payload
+        for subscriber in self.subscribers:
+            if subscriber.full():
+                subscriber.get_nowait()
+            subscriber.put_nowait(payload)
+
+
+queue_broadcaster = Broadcaster()
+metrics_broadcaster = Broadcaster()
+lag_broadcaster = Broadcaster()
+
+
+def flow_control_summary(series_list: list) -> dict:
+    """
+    Collects the pause state of the CDC readers published by the backpressure flow control.
+    :param series_list: series of the cdc stats file
+    :return:
+    """
+    paused = {}
+    throttled = 0
+    for series in series_list:
+        if series["name"] == "dfs_cdc_paused":
+            paused[series["labels"].get("source")] = bool(series["value"])
+        elif series["name"] == "dfs_cdc_throttled_seconds_total":
+            throttled += series["value"]
+    return {
+        "paused": any(paused.values()),
+        "paused_sources": [source for source, source_paused in paused.items() if source_paused and source is not None],
+        "throttled_seconds": round(throttled, 1),
+    }
+
+
+def read_flow_control() -> dict:
+    """
+    Reads the pause state from the CDC stats file, blocking file I/O.
+    :return:
+    """
+    path = Path(STATS_PATH, "cdc.stats")
+    return flow_control_summary(read_stats(path) if path.exists() else [])
+
+
+def read_queues(connections: dict) -> list:
+    """
+    Reads the depth, items ever enqueued and size of the persistence queue, the fan-out target queues and their
+    priority lanes, blocking SQLite reads.
+    :param connections: queue path -> reader connection, opened on first use
+    :return: list of (name, depth, enqueued, size bytes), the persistence queue is named "main"
+    """
+    queues = []
+    for path in queue_paths():
+        connection = connections.get(path)
+        if connection is None:
+            connection = connections[path] = open_queue_reader(path)
+        depth, enqueued = queue_stats(connection)
+        _, size_bytes, _ = queue_usage(connection)
+        name = Path(path).relative_to(QUEUE_PATH).as_posix()
+        queues.append((name if name != "." else "main", depth, enqueued, size_bytes))
+    return queues
+
+
+async def queue_sampler():
+    """
+    Samples the persistence queues once per tick off the event loop and broadcasts depth, size, enqueue/dequeue rates
+    and whether the CDC is paused by the backpressure flow control. The totals cover the target queues and the
+    priority lanes as well (an event dispatched to the targets is counted once per queue), "queues" has the depth
+    of every queue.
+    """
+    connections = {}
+    previous = None
+    while True:
+        try:
+            queues = await asyncio.to_thread(read_queues, connections)
+            depth = sum(queue[1] for queue in queues)
+            enqueued = sum(queue[2] for queue in queues)
+            size_bytes = sum(queue[3] for queue in queues)
+            flow_control = await asyncio.to_thread(read_flow_control)
+            now = time.monotonic()
+            payload = {
+                "depth": depth, "size_bytes": size_bytes, "enqueue_rate": None, "dequeue_rate": None,
+                "queues": [{"name": name, "depth": queue_depth} for name, queue_depth, _, _ in queues],
+                **flow_control, "ts": time.time(),
+            }
+            if previous is not None:
+                elapsed = now - previous[0]
+                enqueue_rate = (enqueued - previous[2]) / elapsed
+                dequeue_rate = ((enqueued - previous[2]) - (depth - previous[1])) / elapsed
+                payload["enqueue_rate"] = round(enqueue_rate, 2)
+                payload["dequeue_rate"] = round(max(dequeue_rate, 0), 2)
+            previous = (now, depth, enqueued)
+            queue_broadcaster.publish(json.dumps(payload))
+        except Exception as e:
+            print(e)
+            for connection in connections.values():
+                connection.close()
+            connections = {}
+        await asyncio.sleep(QUEUE_SAMPLE_INTERVAL)
+
+
+def read_all_stats() -> dict:
+    """
+    Reads the stats files written by the CDC, DPU and other units, blocking file I/O.
+    :return: dictionary of unit -> series
+    """
+    return {path.stem: read_stats(path) for path in sorted(STATS_PATH.glob("*.stats"))}
+
+
+def lag_summary(stats_by_unit: dict) -> dict:
+    """
+    Collects the rolling lag percentiles published by the DPU and compares the lag with the alert threshold.
+    :param stats_by_unit: dictionary of unit -> series
+    :return:
+    """
+    tables = {}
+    for series_list in stats_by_unit.values():
+        for series in series_list:
+            if series["name"] != "dfs_lag_seconds":
+                continue
+            labels = series["labels"]
+            stages = tables.setdefault(labels["table"], {})
+            stages.setdefault(labels["stage"], {})[labels["quantile"]] = round(series["value"], 3)
+
+    lag = max(
+        (stages["end_to_end"]["p95"] for stages in tables.values() if "p95" in stages.get("end_to_end", {})),
+        default=None,
+    )
+    return {
+        "tables": tables,
+        "lag_seconds": lag,
+        "threshold_seconds": LAG_ALERT_SECONDS,
+        "alert": lag is not None and lag > LAG_ALERT_SECONDS,
+    }
+
+
+async def metrics_sampler():
+    """
+    Reads the stats files once per tick off the event loop and broadcasts them and the lag summary as JSON.
+    """
+    while True:
+        try:
+            stats_by_unit = await asyncio.to_thread(read_all_stats)
+            metrics_broadcaster.publish(json.dumps(stats_by_unit))
+            lag_broadcaster.publish(json.dumps(lag_summary(stats_by_unit)))
+        except Exception as e:
+            print(e)
+        await asyncio.sleep(METRICS_SAMPLE_INTERVAL)
+
+
+class LogSubscriber:
+    """
+    Bounded line buffer of one websocket client.
+    When the client cannot keep up, the oldest lines are dropped and counted.
+    """
+
+    def __init__(self, max_lines: int):
+        self.lines = deque()
+        self.max_lines = max_lines
+        self.skipped = 0
+        self.ready = asyncio.Event()
+
+    def push(self, lines: list):
+        self.lines.extend(lines)
+        overflow = len(self.lines) - self.max_lines
+        for _ in range(overflow):
+            self.lines.popleft()
+        if overflow > 0:
+            self.skipped += overflow
+        self.ready.set()
+
+    async def next_frame(self) -> list:
+        await self.ready.wait()
+        self.ready.clear()
+        frame = []
+        if self.skipped:
+            frame.append(f"... skipped {self.skipped} lines ...")
+            self.skipped = 0
+        frame.extend(self.lines)
+        self.lines.clear()
+        return frame
+
+
+class LogTail:
+    """
+    Single non-blocking tail of a log file, shared by every websocket client.
+    New lines are read off the event loop once per frame interval and fanned out to the subscribers.
+    The file is reopened when it is rotated (loguru rotates at midnight) or truncated.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.file = None
+        self.inode = None
+        self.partial = ""
+        self.subscribers = set()
+
+    def subscribe(self) -> LogSubscriber:
+        subscriber = LogSubscriber(LOG_CLIENT_BUFFER_LINES)
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: LogSubscriber):
+        self.subscribers.discard(subscriber)
+
+    def _close(self):
+        if self.file is not None:
+            try:
+                self.file.close()
+            except OSError:
+                pass
+        self.file = None
+
+    def _open(self, from_start: bool):
+        self._close()
+        self.file = open(self.path, "r")
+        self.inode = os.fstat(self.file.fileno()).st_ino
+        self.partial = ""
+        if not from_start:
+            # Like tail -f, only lines written after the monitor started are followed
+            self.file.seek(0, os.SEEK_END)
+
+    def _read(self) -> list:
+        """
+        Reads the complete lines written since the last call, blocking file I/O.
+        """
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return []
+
+        if self.file is None:
+            self._open(from_start=False)
+        elif stat.st_ino != self.inode or stat.st_size < self.file.tell():
+            # Rotated or truncated, the remainder of the old file is read before switching
+            lines = self._split(self.file.read())
+            self._open(from_start=True)
+            return lines + self._split(self.file.read())
+
+        return self._split(self.file.read())
+
+    def _split(self, data: str) -> list:
+        if not data:
+            return []
+        lines = (self.partial + data).split("\n")
+        self.partial = lines.pop()
+        return lines
+
+    async def run(self):
+        while True:
+            try:
+                lines = await asyncio.to_thread(self._read)
+                if lines:
+                    for subscriber in self.subscribers:
+                        subscriber.push(lines)
+            except Exception as e:
+                print(e)
+                self._close()
+            await asyncio.sleep(LOG_FRAME_INTERVAL_MS / 1000)
+
+
+log_tails = {
+    "cdc": LogTail(Path(LOG_PATH, "cdc.log")),
+    "dpu": LogTail(Path(LOG_PATH, "dpu.log")),
+}
+
+
+class LogDBReader:
+    """
+    Log database connection of the history APIs, connected on first use and shared by the endpoint threads.
+    Queries are serialised, a lost connection is re-established once per query.
+    """
+
+    def __init__(self):
+        self.log_db = None
+        self.lock = threading.Lock()
+
+    def query(self, method: str, **kwargs):
+        with self.lock:
+            if self.log_db is None:
+                self.log_db = LogDBConnection(host="db", port=3306, user="root", password=LOG_DB_PASSWORD)
+            try:
+                return getattr(self.log_db, method)(**kwargs)
+            except (pymysql.err.OperationalError, pymysql.err.InterfaceError):
+                self.log_db.connect()
+                return getattr(self.log_db, method)(**kwargs)
+
+
+log_db_reader = LogDBReader()
+
+
+def page_limit(limit: int) -> int:
+    if limit is None:
+        return API_PAGE_SIZE
+    return max(1, min(limit, API_MAX_PAGE_SIZE))
+
+
+def check_unit(unit: str):
+    if unit not in UNITS:
+        raise HTTPException(status_code=404, detail=f"Unknown unit {unit}")
+
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    tasks = [asyncio.create_task(queue_sampler()), asyncio.create_task(metrics_sampler())]
+    tasks.extend(asyncio.create_task(log_tail.run()) for log_tail in log_tails.values())
+    yield
+    for task in tasks:
+        task.cancel()
+
+
+app = FastAPI(docs_url=None, redoc_url=None, lifespan=lifespan)
 app.mount("/static", StaticFiles(directory="monitor/static"), name="static")
 
 
+async def send_broadcast(websocket: WebSocket, broadcaster: Broadcaster):
+    """
+    Forwards the payloads of a broadcaster to a websocket until the client disconnects.
+    """
+    subscriber = broadcaster.subscribe()
+    try:
+        while True:
+            await websocket.send_text(await subscriber.get())
+    finally:
+        broadcaster.unsubscribe(subscriber)
+
+
+async def send_log(websocket: WebSocket, log_tail: LogTail):
+    """
+    Forwards batched log frames (JSON list of lines) to a websocket until the client disconnects.
+    """
+    subscriber = log_tail.subscribe()
+    try:
+        while True:
+            await websocket.send_text(json.dumps(await subscriber.next_frame()))
+    finally:
+        log_tail.unsubscribe(subscriber)
+
+
 @app.get("/cdc")
 async def root():
     return FileResponse(path="monitor/cdc_index.html", status_code=200)
@@ -23,15 +400,110 @@ async def root():
     return FileResponse(path="monitor/dpu_index.html", status_code=200)
 
 
+@app.get("/metrics")
+async def metrics():
+    stats_by_unit = await asyncio.to_thread(read_all_stats)
+    lag = lag_summary(stats_by_unit)
+    text = prometheus_text(stats_by_unit)
+    text += f"# TYPE dfs_lag_alert_threshold_seconds gauge\ndfs_lag_alert_threshold_seconds {LAG_ALERT_SECONDS}\n"
+    text += f"# TYPE dfs_lag_alert gauge\ndfs_lag_alert {int(lag['alert'])}\n"
+    return PlainTextResponse(text, media_type="text/plain; version=0.0.4")
+
+
+@app.get("/api/metrics")
+async def api_metrics():
+    return await asyncio.to_thread(read_all_stats)
+
+
+@app.get("/api/lag")
+async def api_lag():
+    return lag_summary(await asyncio.to_thread(read_all_stats))
+
+
+@app.get("/api/{unit}/rollups")
+def api_rollups(
+        unit: str,
+        table: str = None,
+        action: str = None,
+        start: datetime.datetime = None,
+        end: datetime.datetime = None,
+        after: str = None,
+        limit: int = None,
+):
+    """
+    Per-minute throughput time series from the rollup tables.
+    The next page is requested with the returned ``next`` cursor as ``after``.
+    """
+    check_unit(unit)
+    limit = page_limit(limit)
+    after_key = None
+    if after is not None:
+        try:
+            minute, after_table, after_action = after.split("|", 2)
+            after_key = (datetime.datetime.fromisoformat(minute), after_table, after_action)
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"Invalid cursor {after}")
+
+    items = log_db_reader.query(
+        "rollup_query", unit=unit, table=table, action=action, start=start, end=end, after=after_key, limit=limit
+    )
+    next_cursor = None
+    if len(items) == limit:
+        last = items[-1]
+        next_cursor = f"{last['minute'].isoformat()}|{last['table']}|{last['action']}"
+    return {"items": items, "next": next_cursor}
+
+
+@app.get("/api/{unit}/log")
+def api_log(unit: str, table: str = None, after_id: int = None, before_id: int = None, limit: int = None):
+    """
+    cdc_log/dpu_log detail rows, keyset paginated on cdc_id/dpu_id.
+    Without a cursor the latest page is returned, newest first, continue with ``before_id`` for older rows
+    or poll with ``after_id`` for newer rows (oldest first).
+    """
+    check_unit(unit)
+    if after_id is not None and before_id is not None:
+        raise HTTPException(status_code=400, detail="after_id and before_id are mutually exclusive")
+    limit = page_limit(limit)
+    items = log_db_reader.query(
+        "log_page_query", unit=unit, table=table, after_id=after_id, before_id=before_id, limit=limit
+    )
+    id_column = f"{unit}_id"
+    last_id = items[-1][id_column] if items else None
+    if after_id is not None:
+        # Polling for newer rows continues from the last row, or the same cursor when there is none yet
+        return {"items": items, "next_after_id": last_id if last_id is not None else after_id}
+    return {"items": items, "next_before_id": last_id if len(items) == limit else None}
+
+
+@app.websocket("/ws/lag")
+async def websocket_endpoint(websocket: WebSocket):
+    await websocket.accept()
+    await websocket.send_bytes(b"")
+    try:
+        await send_broadcast(websocket, lag_broadcaster)
+    except Exception as e:
+        print(e)
+        pass
+
+
+@app.websocket("/ws/metrics")
+async def websocket_endpoint(websocket: WebSocket):
+    await websocket.accept()
+    await websocket.send_bytes(b"")
+    try:
+        await send_broadcast(websocket, metrics_broadcaster)
+    except Exception as e:
+        print(e)
+        pass
+
+
 @app.websocket("/ws/cdc/queue-length")
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
     await websocket.send_bytes(b"")
     try:
-        while True:
-            q = persistqueue.SQLiteQueue(QUEUE_PATH, auto_commit=True)
-            await websocket.send_text(str(q.qsize()))
-            await asyncio.sleep(1)
+        await send_broadcast(websocket, queue_broadcaster)
     except Exception as e:
         print(e)
         pass
@@ -42,10 +514,7 @@ async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
     await websocket.send_bytes(b"")
     try:
-        with open(Path(LOG_PATH, "cdc.log"), "r") as f:
-            for line in tailer.follow(f):
-                await websocket.send_text(line)
-                await asyncio.sleep(0.1)
+        await send_log(websocket, log_tails["cdc"])
     except Exception as e:
         print(e)
         pass
@@ -56,10 +525,7 @@ async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
     await websocket.send_bytes(b"")
     try:
-        while True:
-            q = persistqueue.SQLiteQueue(QUEUE_PATH, auto_commit=True)
-            await websocket.send_text(str(q.qsize()))
-            await asyncio.sleep(1)
+        await send_broadcast(websocket, queue_broadcaster)
     except Exception as e:
         print(e)
         pass
@@ -70,10 +536,7 @@ async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
     await websocket.send_bytes(b"")
     try:
-        with open(Path(LOG_PATH, "dpu.log"), "r") as f:
-            for line in tailer.follow(f):
-                await websocket.send_text(line)
-                await asyncio.sleep(0.1)
+        await send_log(websocket, log_tails["dpu"])
     except Exception as e:
         print(e)
         pass
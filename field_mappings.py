@@ -24,5 +24,13 @@ field_mappings_raw = {
     },
 }
 
+# Table processors of the DPU (method names of dpu/queue_processor.py by source table), tables processed by
+# _process_skip_table are not applied. The CDC reads only these tables with cdc_filter.processed_tables_only.
+TABLE_PROCESSORS = {
+    "example_table": "_process_example_table",
+    "skip_table": "_process_skip_table",
+}
+SKIP_PROCESSOR = "_process_skip_table"
+
 if __name__ == "__main__":
     pass
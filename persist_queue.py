@@ -1,10 +1,429 @@
+import shutil
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
 import persistqueue
 
-from utils import QUEUE_PATH
+from change_event import QueueSerializer
+from stats import stats_inc, stats_observe, stats_set
+from utils import QUEUE_PATH, config_data
 
 # https://github.com/peter-wangxu/persist-queue
 # BSD-3-Clause license
-PersistQueue = persistqueue.SQLiteQueue(QUEUE_PATH, auto_commit=True)
+# ChangeEvents are stored as compact tuples, items queued as pickled dicts by former versions are still read.
+# The reader threads of several sources (source_databases) put into the same queue.
+PersistQueue = persistqueue.SQLiteQueue(
+    QUEUE_PATH, auto_commit=True, multithreading=True, serializer=QueueSerializer()
+)
+
+DEFAULT_LANE = "default"
+LANE_DEFAULT_WEIGHT = 1
+LANE_DEFAULT_MAX_WAIT_SECONDS = 5
+# Interval of looking for events put by another process while every lane is empty
+LANE_POLL_SECONDS = 0.1
+# Interval of publishing the lane depths
+LANE_PUBLISH_SECONDS = 1
+
+
+def _put_many(queue, items: list):
+    """
+    Put a batch of items into a SQLite queue within a single SQLite transaction
+    :param queue: persistqueue.SQLiteQueue
+    :param items:
+    :return:
+    """
+    # persist-queue has no batch put, this mirrors SQLiteQueue.put of persist-queue 1.0.0 (tran_lock, _putter,
+    # _sql_insert, total, put_event are its internals), the version is pinned in requirements.txt for this reason.
+    if not items:
+        return
+    now = time.time()
+    records = [(queue._serializer.dumps(item), now) for item in items]
+    with queue.tran_lock:
+        with queue._putter as conn:
+            conn.executemany(queue._sql_insert, records)
+    queue.total += len(records)
+    queue.put_event.set()
+
+
+def queue_depth(queue) -> int:
+    """
+    Depth of a SQLite queue from its rows, counts the items put by another process as well.
+    Acknowledged items leave gaps in the ids (out of order acks of the parallel apply), the rows are counted.
+    :param queue: persistqueue.SQLiteQueue
+    :return:
+    """
+    with queue.tran_lock:
+        return queue._getter.execute(f"SELECT COUNT(*) FROM {queue._table_name}").fetchone()[0]
+
+
+class AckQueue:
+    """
+    Reader of a SQLite queue removing an event only once it is acknowledged. get hands out the events in order
+    without removing them, ack removes one. The events of a batch held by a sink or of the apply window of the parallel
+    apply stay in the queue until they are written, a restart takes the unacknowledged events again.
+    The queue is read by one process, puts of other processes (the CDC) are seen within LANE_POLL_SECONDS.
+
+    Attributes:
+        queue (persistqueue.SQLiteQueue): Queue read, opened with auto_commit.
+        cursor (int): Queue id of the last event handed out.
+        pending (dict): id of an event handed out -> (event, queue id), until it is acknowledged.
+    """
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.cursor = 0
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def put(self, item):
+        self.queue.put(item)
+
+    def put_many(self, items: list):
+        _put_many(self.queue, items)
+
+    def _next(self, raw: bool):
+        """
+        Next event after the cursor, from persist-queue 1.0.0 internals (_select, _KEY_COLUMN) like _put_many
+        :return: the event, None if there is none
+        """
+        with self.lock:
+            row = self.queue._select(self.cursor, op=">", column=self.queue._KEY_COLUMN)
+            if not row or row[0] is None:
+                return None
+            self.cursor = row[0]
+            item = self.queue._serializer.loads(row[1])
+            self.pending[id(item)] = (item, row[0])
+        if raw:
+            return {"pqid": row[0], "data": item, "timestamp": row[2]}
+        return item
+
+    def get(self, block: bool = True, raw: bool = False):
+        while True:
+            item = self._next(raw)
+            if item is not None:
+                return item
+            if not block:
+                raise persistqueue.Empty
+            self.queue.put_event.clear()
+            self.queue.put_event.wait(LANE_POLL_SECONDS)
+
+    def ack(self, item):
+        """
+        Removes an event handed out by get from the queue, other events (e.g. retried from the dead-letter queue)
+        are ignored
+        :param item: the event as returned by get
+        """
+        with self.lock:
+            pending = self.pending.pop(id(item), None)
+        if pending is None:
+            return
+        self.queue._delete(pending[1])
+
+    def qsize(self) -> int:
+        """
+        Number of events not handed out yet, read from the queue table so the events put by another process (the CDC)
+        are counted. The events after the cursor are never acknowledged, their ids have no gaps.
+        """
+        with self.queue.tran_lock:
+            first, last = self.queue._getter.execute(
+                f"SELECT MIN(_id), MAX(_id) FROM {self.queue._table_name} WHERE _id > ?", (self.cursor,)
+            ).fetchone()
+        return 0 if first is None else last - first + 1
+
+    def oldest_captured(self):
+        """
+        Capture time of the oldest event not acknowledged yet, handed out or not (its queue time if it has none)
+        :return: epoch seconds, None if the queue is empty
+        """
+        with self.lock:
+            row = self.queue._select(0, op=">", column=self.queue._KEY_COLUMN)
+        if not row or row[0] is None:
+            return None
+        item = self.queue._serializer.loads(row[1])
+        return (item.get("stage_ts") or {}).get("captured") or row[2]
+
+
+class Lane:
+    """
+    One priority lane: its queue (read by an AckQueue), weight and scheduling state.
+    """
+
+    __slots__ = ("name", "weight", "queue", "credit", "served")
+
+    def __init__(self, name: str, weight: int, queue):
+        self.name = name
+        self.weight = weight
+        self.queue = AckQueue(queue)
+        # Events the lane may still take in the current round
+        self.credit = 0
+        self.served = time.monotonic()
+
+
+class LaneQueues:
+    """
+    Persistent queue split into priority lanes by table (priority_lanes in config.yml). put routes an event to the
+    lane of its table, the tables not listed go to the default lane (the queue at the base path itself).
+    get takes the events with a deficit round robin: every round grants each lane its weight in events, a lane that
+    runs empty gives up the rest of its round. The events of a table stay in one lane, so the events of a row keep
+    their order. A lane holding events that was not served for max_wait_seconds is served first (starvation guard).
+    The depth of every lane and the time its events waited are published as dfs_queue_lane_depth_events{lane} and
+    dfs_queue_lane_wait_seconds{lane}.
+
+    Attributes:
+        lanes (list): Lane objects, highest weight first.
+        table_lanes (dict): Table -> Lane, tables not listed use the default lane.
+        max_wait_seconds (float): Starvation guard.
+        labels (dict): Labels added to the published stats, e.g. the target of a fan-out DPU.
+
+    Methods:
+        put(item): Puts an event into the lane of its table.
+        put_many(items): Puts a batch of events, one transaction per lane.
+        get(block=True): Takes the next event of the scheduled lane.
+        ack(item): Removes a taken event from its lane.
+        qsize(): Number of events in all lanes.
+    """
+
+    def __init__(self, path, lanes_config: dict, default_queue=None, labels: dict = None):
+        """
+        Args:
+            path: Base path, the default lane uses it, the other lanes use lanes/<name> below it.
+            lanes_config (dict): priority_lanes section.
+            default_queue (optional): Queue of the default lane already opened at the base path.
+            labels (dict, optional): Labels added to the published stats.
+        """
+
+        self.max_wait_seconds = lanes_config.get("max_wait_seconds", LANE_DEFAULT_MAX_WAIT_SECONDS)
+        self.labels = labels or {}
+        if default_queue is None:
+            default_queue = persistqueue.SQLiteQueue(
+                path, auto_commit=True, multithreading=True, serializer=QueueSerializer()
+            )
+        default_lane = Lane(DEFAULT_LANE, lanes_config.get("default_weight", LANE_DEFAULT_WEIGHT), default_queue)
+
+        self.lanes = [default_lane]
+        self.table_lanes = {}
+        for lane_config in lanes_config.get("lanes") or []:
+            if lane_config["name"] in (lane.name for lane in self.lanes):
+                raise ValueError(f"priority_lanes: lane {lane_config['name']} is configured twice")
+            lane = Lane(
+                lane_config["name"],
+                lane_config.get("weight", LANE_DEFAULT_WEIGHT),
+                persistqueue.SQLiteQueue(
+                    Path(path, "lanes", lane_config["name"]), auto_commit=True, multithreading=True,
+                    serializer=QueueSerializer(),
+                ),
+            )
+            self.lanes.append(lane)
+            for table in lane_config.get("tables") or []:
+                self.table_lanes[table] = lane
+        self.lanes.sort(key=lambda lane: lane.weight, reverse=True)
+        self.default_lane = default_lane
+
+        self.lock = threading.Lock()
+        self.put_event = threading.Event()
+        self.published = 0
+
+    def lane(self, item) -> Lane:
+        return self.table_lanes.get(item["table"], self.default_lane)
+
+    def put(self, item):
+        self.lane(item).queue.put(item)
+        self.put_event.set()
+
+    def put_many(self, items: list):
+        by_lane = {}
+        for item in items:
+            by_lane.setdefault(self.lane(item).name, []).append(item)
+        for lane in self.lanes:
+            lane.queue.put_many(by_lane.get(lane.name, []))
+        self.put_event.set()
+
+    def ack(self, item):
+        self.lane(item).queue.ack(item)
+
+    def _take(self, lane: Lane):
+        """
+        Takes the next event of a lane and records how long it waited
+        :return: the event, None if the lane is empty
+        """
+        try:
+            record = lane.queue.get(block=False, raw=True)
+        except persistqueue.Empty:
+            # An empty lane is not starving
+            lane.served = time.monotonic()
+            return None
+        lane.served = time.monotonic()
+        stats_observe("dfs_queue_lane_wait_seconds", time.time() - record["timestamp"], lane=lane.name, **self.labels)
+        return record["data"]
+
+    def _next(self):
+        """
+        Takes the next event by the starvation guard or the round robin
+        :return: the event, None if every lane is empty
+        """
+        now = time.monotonic()
+        for lane in self.lanes:
+            if now - lane.served >= self.max_wait_seconds:
+                item = self._take(lane)
+                if item is not None:
+                    stats_inc("dfs_queue_lane_starvation_total", lane=lane.name, **self.labels)
+                    return item
+
+        for _ in range(2):
+            for lane in self.lanes:
+                if lane.credit <= 0:
+                    continue
+                item = self._take(lane)
+                if item is not None:
+                    lane.credit -= 1
+                    return item
+                lane.credit = 0
+            # Next round
+            for lane in self.lanes:
+                lane.credit = lane.weight
+        return None
+
+    def publish(self):
+        """
+        Publishes the depth of every lane
+        """
+        for lane in self.lanes:
+            stats_set("dfs_queue_lane_depth_events", queue_depth(lane.queue.queue), lane=lane.name, **self.labels)
+        self.published = time.monotonic()
+
+    def get(self, block: bool = True):
+        while True:
+            with self.lock:
+                if time.monotonic() - self.published >= LANE_PUBLISH_SECONDS:
+                    self.publish()
+                item = self._next()
+            if item is not None:
+                return item
+            if not block:
+                raise persistqueue.Empty
+            self.put_event.clear()
+            self.put_event.wait(LANE_POLL_SECONDS)
+
+    def qsize(self) -> int:
+        return sum(lane.queue.qsize() for lane in self.lanes)
+
+    def oldest_captured(self):
+        """
+        Capture time of the oldest event not acknowledged yet across the lanes, the lanes are not applied in
+        capture order
+        :return: epoch seconds, None if every lane is empty
+        """
+        return oldest_captured(lane.queue for lane in self.lanes)
+
+
+def lane_queues(path, default_queue=None, labels: dict = None):
+    """
+    Queue at a path, split into the priority lanes when priority_lanes is configured
+    :param path: queue path
+    :param default_queue: queue already opened at the path
+    :param labels: labels added to the lane stats
+    :return: LaneQueues, or the AckQueue of the SQLite queue without priority lanes
+    """
+    lanes_config = config_data.get("priority_lanes")
+    if lanes_config:
+        return LaneQueues(path, lanes_config, default_queue=default_queue, labels=labels)
+    if default_queue is None:
+        default_queue = persistqueue.SQLiteQueue(
+            path, auto_commit=True, multithreading=True, serializer=QueueSerializer()
+        )
+    return AckQueue(default_queue)
+
+
+# Queue between the CDC and the DPU, the persistence queue split into the priority lanes if configured.
+# The DPU acknowledges (ack) every event it has written to the target or dead-lettered.
+EventQueue = lane_queues(QUEUE_PATH, default_queue=PersistQueue)
+
+
+def oldest_captured(queues) -> float:
+    """
+    Oldest capture time of the events not applied yet in several queues
+    :param queues: queues with oldest_captured
+    :return: epoch seconds, None if every queue is empty
+    """
+    captured = [t for t in (queue.oldest_captured() for queue in queues) if t is not None]
+    return min(captured) if captured else None
+
+
+def put_many(items: list):
+    """
+    Put a batch of items into the persistence queue (into their lanes) within a single SQLite transaction per lane
+    :param items:
+    :return:
+    """
+    if isinstance(EventQueue, LaneQueues):
+        EventQueue.put_many(items)
+    else:
+        _put_many(PersistQueue, items)
+
+
+def open_queue_reader(path=QUEUE_PATH) -> sqlite3.Connection:
+    """
+    Open a read-only connection to the persistence queue database, used to observe the queue from another process
+    :param path: queue path
+    :return:
+    """
+    connection = sqlite3.connect(
+        f"file:{Path(path, 'data.db')}?mode=ro", uri=True, check_same_thread=False
+    )
+    return connection
+
+
+def queue_stats(connection: sqlite3.Connection) -> tuple:
+    """
+    Read the queue depth and the number of items ever enqueued (AUTOINCREMENT sequence)
+    :param connection: connection returned by open_queue_reader
+    :return: (depth, enqueued)
+    """
+    depth = connection.execute(f"SELECT COUNT(*) FROM {PersistQueue._table_name}").fetchone()[0]
+    row = connection.execute(
+        "SELECT seq FROM sqlite_sequence WHERE name = ?", (PersistQueue._table_name.strip("`"),)
+    ).fetchone()
+    return depth, row[0] if row else 0
+
+
+def queue_paths(path=QUEUE_PATH) -> list:
+    """
+    Paths of the persistence queue, of the fan-out target queues (targets/<name>) and of their priority lanes
+    (lanes/<name>) that have a database
+    :param path: queue path
+    :return:
+    """
+    queue_paths = [Path(path), *sorted(Path(path, "targets").glob("*"))]
+    # Priority lanes of the queues
+    queue_paths += [lane_path for queue_path in queue_paths for lane_path in sorted(Path(queue_path, "lanes").glob("*"))]
+    return [queue_path for queue_path in queue_paths if Path(queue_path, "data.db").exists()]
+
+
+def queue_usage(connection: sqlite3.Connection) -> tuple:
+    """
+    Read the queue depth and the bytes of the queue database in use. Taken items leave free pages that later
+    items reuse, so the database file does not shrink when the queue drains.
+    Depth is the number of rows, acknowledged items leave gaps in the ids.
+    :param connection: connection returned by open_queue_reader
+    :return: (depth, used bytes, free bytes within the file)
+    """
+    depth = connection.execute(f"SELECT COUNT(*) FROM {PersistQueue._table_name}").fetchone()[0]
+    page_size = connection.execute("PRAGMA page_size").fetchone()[0]
+    page_count = connection.execute("PRAGMA page_count").fetchone()[0]
+    freelist_count = connection.execute("PRAGMA freelist_count").fetchone()[0]
+    return depth, (page_count - freelist_count) * page_size, freelist_count * page_size
+
+
+def disk_free(path=QUEUE_PATH) -> int:
+    """
+    Free bytes of the volume holding the queue
+    :param path: queue path
+    :return:
+    """
+    return shutil.disk_usage(path).free
+
 
 if __name__ == "__main__":
     pass
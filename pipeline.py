@@ -0,0 +1,301 @@
+import datetime
+import os
+import signal
+import sys
+import threading
+import time
+from pathlib import Path
+
+from checkpoint import CheckpointFile
+from stats import stats_init, stats_inc, stats_set
+from utils import config_data, target_configs, PROJECT_DATA_BASE_PATH, STATS_PATH
+
+PIPELINE_DEFAULT_BUFFER_SIZE = 10000
+PIPELINE_DEFAULT_CHECKPOINT_SECONDS = 1
+
+
+class RingBuffer:
+    """
+    Bounded in-memory queue between the CDC and the DPU of the pipeline mode. The slots are allocated once,
+    put blocks while the buffer is full so a slow target holds back the binlog reader instead of growing the memory.
+    Every item may carry a mark, e.g. the binlog position the CDC reads again from to emit it.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.slots = [None] * capacity
+        self.marks = [None] * capacity
+        self.head = 0
+        self.size = 0
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+
+    def put(self, item, mark=None):
+        with self.not_full:
+            while self.size == self.capacity:
+                self.not_full.wait()
+            slot = (self.head + self.size) % self.capacity
+            self.slots[slot] = item
+            self.marks[slot] = mark
+            self.size += 1
+            self.not_empty.notify()
+
+    def get_marked(self) -> tuple:
+        """
+        Takes the next item with its mark
+        :return: (item, mark)
+        """
+        with self.not_empty:
+            while not self.size:
+                self.not_empty.wait()
+            item, mark = self.slots[self.head], self.marks[self.head]
+            self.slots[self.head] = self.marks[self.head] = None
+            self.head = (self.head + 1) % self.capacity
+            self.size -= 1
+            self.not_full.notify()
+            return item, mark
+
+    def get(self):
+        return self.get_marked()[0]
+
+    def wait(self, timeout: float) -> bool:
+        """
+        Wait for an item without taking it
+        :param timeout: seconds
+        :return: whether an item is available
+        """
+        with self.not_empty:
+            return self.not_empty.wait_for(lambda: self.size, timeout)
+
+    def qsize(self) -> int:
+        return self.size
+
+    def ack(self, item):
+        """
+        Events of the ring are not acknowledged one by one, the pipeline checkpoints the applied position
+        """
+
+    def oldest_captured(self):
+        """
+        Capture time of the next event of the ring
+        :return: epoch seconds, None if the ring is empty
+        """
+        with self.lock:
+            item = self.slots[self.head] if self.size else None
+        if item is None:
+            return None
+        return (item.get("stage_ts") or {}).get("captured")
+
+
+class RingFeed:
+    """
+    Queue of the pipeline CDC: puts the events into the ring marked with the resume position of their rows event,
+    the table maps the CDC reads again from to emit the event (the position after the last completely queued rows
+    event without table maps).
+    """
+
+    def __init__(self, ring: RingBuffer):
+        self.ring = ring
+        self.cdc = None
+
+    def put(self, item):
+        if self.cdc.resume_pos is not None:
+            self.ring.put(item, (self.cdc.resume_file, self.cdc.resume_pos))
+        else:
+            self.ring.put(item, (self.cdc.bin_log_file, self.cdc.bin_log_pos))
+
+    def qsize(self) -> int:
+        return self.ring.qsize()
+
+
+class Pipeline:
+    """
+    The Pipeline class runs the CDC and the DPU in one process (--mode pipeline). The CDC reads the binlog in the
+    main thread and hands the events to the DPU thread through a RingBuffer, without the persistence queue.
+    The binlog position read and the applied position are checkpointed to checkpoints/pipeline.json: the resume
+    position of the CDC (the table maps of a rows event) with the keys of the rows applied after it. A restart
+    resumes the CDC there, the rows applied before the checkpoint are dropped before the ring and the rows read but
+    not applied are read again. Rows applied after the last checkpoint are applied again after a crash.
+
+    Attributes:
+        ring (RingBuffer): Events read by the CDC and not yet taken by the DPU, marked with their resume position.
+        checkpoint (CheckpointFile): Read and applied positions.
+        checkpoint_seconds (float): Interval of saving the checkpoint.
+        cdc (CDC): Binlog reader putting the events into the ring.
+        dpu (DPU): Table processors applying the events from the ring.
+        applied (dict): Resume position (log_file, log_pos), keys of the rows applied after it (emitted) and cdc_id
+            of the last applied row, once every taken event is written.
+        applied_events (int): Number of events taken from the ring.
+        failed (Exception): Error that stopped the DPU thread, None while it runs.
+
+    Methods:
+        start(): Resumes the CDC from the applied checkpoint and applies the events in the DPU thread.
+        drain(): Applies the events in the ring until it is empty.
+        save_checkpoint(): Saves the read and applied positions.
+    """
+
+    def __init__(self, cdc_log_db=None, dpu_log_db=None, target_db=None):
+        """
+        Args:
+            cdc_log_db (optional): Log database connection of the CDC, a connection per thread by default.
+            dpu_log_db (optional): Log database connection of the DPU.
+            target_db (optional): Target database connection to use instead of connecting to the target database.
+        """
+
+        from cdc.binlog_processor import CDC, source_configs
+        from dpu.queue_processor import DPU
+
+        if len(source_configs()) > 1:
+            raise ValueError("The pipeline mode reads a single source, use --mode cdc for several source_databases")
+        if len(target_configs()) > 1:
+            raise ValueError("The pipeline mode applies a single target, use --mode dpu for several target_databases")
+
+        pipeline_config = config_data.get("pipeline") or {}
+        stats_init(Path(STATS_PATH, "pipeline.stats"))
+
+        self.ring = RingBuffer(pipeline_config.get("buffer_size", PIPELINE_DEFAULT_BUFFER_SIZE))
+        self.checkpoint = CheckpointFile(Path(PROJECT_DATA_BASE_PATH, "checkpoints", "pipeline.json"))
+        self.checkpoint_seconds = pipeline_config.get("checkpoint_seconds", PIPELINE_DEFAULT_CHECKPOINT_SECONDS)
+
+        feed = RingFeed(self.ring)
+        self.cdc = CDC(log_db=cdc_log_db, queue=feed)
+        feed.cdc = self.cdc
+        # The pipeline checkpoint replaces the one of the CDC, the rows read but not applied are emitted again
+        self.cdc.checkpoint = None
+        self.cdc.handle_sigterm = False
+        self.dpu = DPU(log_db=dpu_log_db, target_db=target_db, queue=self.ring)
+
+        self.applied = None
+        self.applied_events = 0
+        # Error that stopped the DPU thread, the pipeline exits with it
+        self.failed = None
+        # Resume position of the last event taken, keys of the rows taken after it and cdc_id of the last one
+        self.taken = None
+        self.taken_keys = set()
+        self.taken_cdc_id = None
+        self.saved = time.monotonic()
+
+    def _written(self) -> bool:
+        """
+        Whether every taken event is written to the target, a sink target may still buffer some.
+        """
+
+        return self.dpu.sink is None or not self.dpu.sink.buffer
+
+    def _complete(self):
+        """
+        Advances the applied position to the taken events once they are all written to the target.
+        """
+
+        if self.taken is not None and self.taken[1] is not None and self._written():
+            self.applied = {
+                "log_file": self.taken[0],
+                "log_pos": self.taken[1],
+                "emitted": sorted(self.taken_keys),
+                "cdc_id": self.taken_cdc_id,
+            }
+
+    def _apply(self):
+        """
+        Takes one event from the ring and applies it.
+
+        Returns:
+            The applied event.
+        """
+
+        raw, resume = self.ring.get_marked()
+        if "stage_ts" in raw:
+            raw["stage_ts"]["dequeued"] = time.time()
+        # Resuming at a later position reads none of the rows taken before it
+        if resume != self.taken:
+            self.taken = resume
+            self.taken_keys = set()
+        self.taken_keys.add((raw["log_file"], raw["log_pos"], raw["row_index"]))
+        self.taken_cdc_id = raw["cdc_id"]
+        self.dpu._handle_process_data(raw)
+        self.applied_events += 1
+        return raw
+
+    def save_checkpoint(self):
+        """
+        Saves the position read by the CDC and the applied position.
+        """
+
+        read = None
+        if self.cdc.bin_log_pos is not None:
+            read = {"log_file": self.cdc.bin_log_file, "log_pos": self.cdc.bin_log_pos}
+        self.checkpoint.save({"read": read, "applied": self.applied, "applied_events": self.applied_events})
+        self.saved = time.monotonic()
+        stats_inc("dfs_pipeline_checkpoints_total")
+
+    def _applier(self):
+        """
+        DPU thread, applies the events from the ring and saves the checkpoint every checkpoint_seconds.
+        An error stops the pipeline (the CDC would block on the full ring), the applied checkpoint is saved on the way.
+        """
+
+        try:
+            while True:
+                if self.ring.wait(self.checkpoint_seconds):
+                    self._apply()
+                    if not self.ring.qsize():
+                        self.dpu.idle()
+                else:
+                    self._complete()
+                stats_set("dfs_pipeline_buffer_events", self.ring.qsize())
+                if time.monotonic() - self.saved >= self.checkpoint_seconds:
+                    self._complete()
+                    self.save_checkpoint()
+        except Exception as e:
+            self.failed = e
+            self.dpu.error_logger.critical(f"Pipeline DPU thread stopped: {e!r}")
+            stats_inc("dfs_pipeline_failures_total")
+            # Wakes the CDC in the main thread, the SIGTERM handler saves the checkpoint and exits
+            os.kill(os.getpid(), signal.SIGTERM)
+
+    def drain(self):
+        """
+        Applies the events in the ring until it is empty, used when the CDC reads a finite stream.
+        """
+
+        while self.ring.qsize():
+            self._apply()
+        self.dpu.idle()
+        self._complete()
+        self.save_checkpoint()
+
+    def _terminate(self, *_):
+        self.cdc.close()
+        self.save_checkpoint()
+        print(f"{datetime.datetime.now()} | Pipeline checkpoint saved, applied: {self.applied}", flush=True)
+        sys.exit(1 if self.failed is not None else 0)
+
+    def start(self):
+        """
+        Resumes the CDC from the applied checkpoint (the configured or logged position without one)
+        and applies the events in the DPU thread.
+        """
+
+        state = self.checkpoint.load()
+        if state and state.get("applied"):
+            self.applied = state["applied"]
+            self.applied_events = state.get("applied_events", 0)
+
+        signal.signal(signal.SIGTERM, self._terminate)
+        threading.Thread(target=self._applier, name="pipeline-dpu", daemon=True).start()
+
+        try:
+            if self.applied is None:
+                self.cdc.start()
+            else:
+                self.cdc.last_cdc_id = self.applied.get("cdc_id")
+                self.cdc.start(self.applied["log_file"], self.applied["log_pos"], emitted=self.applied.get("emitted", []))
+        except Exception as e:
+            # The CDC stopped (a row the row filter fails on), the applied position is checkpointed
+            self.failed = e
+            self._terminate()
+
+
+if __name__ == "__main__":
+    pass
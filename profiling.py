@@ -0,0 +1,215 @@
+import cProfile
+import collections
+import contextlib
+import datetime
+import functools
+import pstats
+import signal
+import sys
+import threading
+import time
+from pathlib import Path
+
+from stats import stats_observe
+
+# Span instrumentation is off unless enabled in config.yml (profiling.spans) or toggled with SIGUSR2.
+# Disabled spans cost one flag check, enabled spans record dfs_span_seconds{span} in the stats file.
+_enabled = False
+_NOOP_SPAN = contextlib.nullcontext()
+
+PROFILE_DEFAULT_SECONDS = 30
+PROFILE_DEFAULT_MODE = "sample"
+PROFILE_DEFAULT_INTERVAL_MS = 5
+
+
+class _Span:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        stats_observe("dfs_span_seconds", time.perf_counter() - self.start, span=self.name)
+
+
+def span(name: str):
+    """
+    Time a block as a span, e.g. ``with span("cdc.log_write"): ...``
+    :param name: stage name
+    :return: context manager
+    """
+    if not _enabled:
+        return _NOOP_SPAN
+    return _Span(name)
+
+
+# Spans of traced functions running in the current thread, a recursive call (a retry) is not timed again
+_active = threading.local()
+
+
+def traced(name: str):
+    """
+    Decorator timing every call of a function as a span, only the outermost call of a recursive function
+    (e.g. the reconnect retries of the database connections) is timed, so a call is counted once
+    :param name: stage name
+    :return:
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            active = getattr(_active, "spans", None)
+            if active is None:
+                active = _active.spans = set()
+            if name in active:
+                return func(*args, **kwargs)
+            active.add(name)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                active.discard(name)
+                stats_observe("dfs_span_seconds", time.perf_counter() - start, span=name)
+
+        return wrapper
+
+    return decorator
+
+
+def spans_enabled(enabled: bool):
+    global _enabled
+    _enabled = enabled
+
+
+def _frame_name(frame) -> str:
+    return f"{Path(frame.f_code.co_filename).stem}:{frame.f_code.co_name}"
+
+
+class SamplingProfiler(threading.Thread):
+    """
+    Samples the stacks of every other thread at a fixed interval and writes them as collapsed stacks
+    (``thread;module:function;... count`` per line), the input format of flamegraph.pl and speedscope.
+    """
+
+    def __init__(self, seconds: float, interval: float, path: Path, on_done=None):
+        super().__init__(name="dfs-sampling-profiler", daemon=True)
+        self.seconds = seconds
+        self.interval = interval
+        self.path = path
+        self.on_done = on_done
+
+    def run(self):
+        counts = collections.Counter()
+        own_id = threading.get_ident()
+        deadline = time.monotonic() + self.seconds
+        while time.monotonic() < deadline:
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+                stack.append(thread_names.get(thread_id, str(thread_id)))
+                counts[";".join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+        with open(self.path, "w") as profile_file:
+            for stack, count in counts.most_common():
+                profile_file.write(f"{stack} {count}\n")
+        print(f"{datetime.datetime.now()} | Sampling profile written to {self.path}", flush=True)
+        if self.on_done is not None:
+            self.on_done()
+
+
+class Profiling:
+    """
+    Runs cProfile or the sampling profiler for a limited time, started on SIGUSR1 or when the unit starts.
+    cProfile only profiles the main thread, which runs the CDC/DPU loop.
+    """
+
+    def __init__(self, unit: str, log_path: Path, profiling_config: dict):
+        self.unit = unit
+        self.log_path = log_path
+        self.seconds = profiling_config.get("seconds", PROFILE_DEFAULT_SECONDS)
+        self.mode = profiling_config.get("mode", PROFILE_DEFAULT_MODE)
+        self.interval = profiling_config.get("interval_ms", PROFILE_DEFAULT_INTERVAL_MS) / 1000
+        self.running = False
+        self._profile = None
+
+    def _path(self, suffix: str) -> Path:
+        self.log_path.mkdir(exist_ok=True, parents=True)
+        return Path(self.log_path, f"profile_{self.unit}_{datetime.datetime.now():%Y%m%d_%H%M%S}.{suffix}")
+
+    def start(self, *_):
+        if self.running:
+            return
+        self.running = True
+        print(f"{datetime.datetime.now()} | Profiling ({self.mode}) for {self.seconds} seconds", flush=True)
+
+        if self.mode == "cprofile" and threading.current_thread() is threading.main_thread():
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+            signal.signal(signal.SIGALRM, self._stop_cprofile)
+            signal.setitimer(signal.ITIMER_REAL, self.seconds)
+        else:
+            SamplingProfiler(self.seconds, self.interval, self._path("collapsed"), on_done=self._finished).start()
+
+    def _finished(self):
+        self.running = False
+
+    def _stop_cprofile(self, *_):
+        self._profile.disable()
+        stats = pstats.Stats(self._profile)
+        stats.dump_stats(self._path("prof"))
+
+        # cProfile keeps caller -> callee edges only, they are written as two-frame collapsed stacks
+        path = self._path("collapsed")
+        with open(path, "w") as profile_file:
+            for callee, (_, _, _, _, callers) in stats.stats.items():
+                callee_name = f"{Path(callee[0]).stem}:{callee[2]}"
+                for caller, caller_stats in callers.items():
+                    microseconds = int(caller_stats[2] * 1_000_000)
+                    if microseconds:
+                        profile_file.write(f"{Path(caller[0]).stem}:{caller[2]};{callee_name} {microseconds}\n")
+        print(f"{datetime.datetime.now()} | cProfile written to {path.with_suffix('.prof')} and {path}", flush=True)
+        self._profile = None
+        self.running = False
+
+
+def _toggle_spans(*_):
+    spans_enabled(not _enabled)
+    print(f"{datetime.datetime.now()} | Span instrumentation {'enabled' if _enabled else 'disabled'}", flush=True)
+
+
+def profiling_init(unit: str, log_path: Path, profiling_config: dict) -> Profiling:
+    """
+    Configure span instrumentation and on-demand profiling of the current process.
+    ``kill -USR1 <pid>`` profiles for the configured number of seconds, ``kill -USR2 <pid>`` toggles spans.
+    :param unit: unit name used in the profile file names
+    :param log_path: directory of the profile files
+    :param profiling_config: profiling section of config.yml
+    :return:
+    """
+    spans_enabled(bool(profiling_config.get("spans", False)))
+    profiling = Profiling(unit, log_path, profiling_config)
+
+    if threading.current_thread() is threading.main_thread() and hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, profiling.start)
+        signal.signal(signal.SIGUSR2, _toggle_spans)
+
+    if profiling_config.get("on_start", False):
+        profiling.start()
+
+    return profiling
+
+
+if __name__ == "__main__":
+    pass
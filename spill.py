@@ -0,0 +1,227 @@
+import codecs
+import hashlib
+import os
+import time
+from pathlib import Path
+
+SPILL_DEFAULT_THRESHOLD_BYTES = 1024 * 1024
+SPILL_DEFAULT_RETENTION_HOURS = 24
+SPILL_DEFAULT_GC_INTERVAL_SECONDS = 300
+# Bytes read from a side file at once, a multiple of 3 so the base64 of the chunks concatenates
+SPILL_CHUNK_BYTES = 3 * 21 * 1024
+
+# Marks a spilled value while a DML statement is built, replaced by the driver placeholder afterwards
+SPILL_PLACEHOLDER = "\x00spill\x00"
+
+
+class SpillRef:
+    """
+    Reference to a large value stored in a content-addressed side file, carried by the queue and cdc_log
+    in place of the value. References to the same content are equal, so update diffs need not read the files.
+    """
+
+    __slots__ = ("digest", "size", "text")
+
+    def __init__(self, digest: str, size: int, text: bool):
+        self.digest = digest
+        self.size = size
+        # TEXT/JSON values are restored as str, BLOB values as bytes
+        self.text = text
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, SpillRef) and other.digest == self.digest
+
+    def __hash__(self) -> int:
+        return hash(self.digest)
+
+    def __repr__(self) -> str:
+        return f"SpillRef({self.digest[:16]}..., {self.size} bytes)"
+
+    def __reduce__(self):
+        return SpillRef, (self.digest, self.size, self.text)
+
+    def read(self):
+        """
+        Read the value from its side file
+        :return: str or bytes
+        """
+        with open(spill_store.file_path(self.digest), "rb") as spill_file:
+            content = spill_file.read()
+        return content.decode() if self.text else content
+
+    def chunks(self, size: int = SPILL_CHUNK_BYTES):
+        """
+        Read the value from its side file in chunks, TEXT values are decoded across the chunk boundaries
+        :param size: bytes read at once
+        :return: iterator of str or bytes
+        """
+        decoder = codecs.getincrementaldecoder("utf-8")() if self.text else None
+        with open(spill_store.file_path(self.digest), "rb") as spill_file:
+            while True:
+                block = spill_file.read(size)
+                if not block:
+                    break
+                yield block if decoder is None else decoder.decode(block)
+        if decoder is not None:
+            tail = decoder.decode(b"", final=True)
+            if tail:
+                yield tail
+
+
+class SpillStore:
+    """
+    Side files of the values above the threshold, named by the SHA-256 of their content (``<path>/ab/abcd...``).
+    A value is written once, spilling it again only refreshes the modification time that the GC is based on.
+    """
+
+    def __init__(self, path: Path = None, threshold: int = 0, retention: float = 0, gc_interval: float = 0):
+        self.path = path
+        self.threshold = threshold
+        self.retention = retention
+        self.gc_interval = gc_interval
+        self.last_gc = time.monotonic()
+
+    def file_path(self, digest: str) -> Path:
+        return Path(self.path, digest[:2], digest)
+
+    def spill(self, value) -> SpillRef:
+        """
+        Store a value in its side file
+        :param value: str or bytes
+        :return:
+        """
+        text = isinstance(value, str)
+        content = value.encode() if text else value
+        digest = hashlib.sha256(content).hexdigest()
+        path = self.file_path(digest)
+        if path.exists():
+            os.utime(path)
+        else:
+            path.parent.mkdir(exist_ok=True, parents=True)
+            tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+            with open(tmp_path, "wb") as spill_file:
+                spill_file.write(content)
+            os.replace(tmp_path, path)
+        return SpillRef(digest, len(content), text)
+
+    def spill_values(self, values: tuple) -> tuple:
+        """
+        Replace the str/bytes values above the threshold by references
+        :param values: row values of a ChangeEvent
+        :return: the same tuple if nothing was spilled
+        """
+        threshold = self.threshold
+        if not threshold:
+            return values
+        for value in values:
+            if isinstance(value, (str, bytes)) and len(value) > threshold:
+                break
+        else:
+            return values
+        return tuple(
+            self.spill(value) if isinstance(value, (str, bytes)) and len(value) > threshold else value
+            for value in values
+        )
+
+    def gc(self, unapplied_since: float = None, keep: set = frozenset()) -> int:
+        """
+        Remove the side files past retention whose last spill was captured before the oldest event not applied yet.
+        The queues are not applied in capture order (priority lanes, parallel apply, targets), so the callers pass
+        the oldest capture time still queued across all of them rather than the last applied event.
+        :param unapplied_since: capture time (epoch seconds) of the oldest event not applied yet, None if none is queued
+        :param keep: digests still referenced, e.g. by dead-lettered events
+        :return: number of removed files
+        """
+        self.last_gc = time.monotonic()
+        if self.path is None or not self.path.exists():
+            return 0
+        cutoff = time.time() - self.retention
+        if unapplied_since is not None:
+            cutoff = min(cutoff, unapplied_since)
+        removed = 0
+        for path in self.path.glob("*/*"):
+            try:
+                if path.name not in keep and path.stat().st_mtime < cutoff:
+                    path.unlink()
+                    removed += 1
+            except FileNotFoundError:
+                continue
+        return removed
+
+    def gc_due(self) -> bool:
+        return self.path is not None and time.monotonic() - self.last_gc >= self.gc_interval
+
+
+spill_store = SpillStore()
+
+
+def spill_init(path: Path, spill_config: dict = None) -> SpillStore:
+    """
+    Configure the side files of the current process
+    :param path: spill directory
+    :param spill_config: spill section of config.yml
+    :return:
+    """
+    spill_config = spill_config or {}
+    spill_store.path = path
+    spill_store.threshold = spill_config.get("threshold_bytes", SPILL_DEFAULT_THRESHOLD_BYTES)
+    spill_store.retention = spill_config.get("retention_hours", SPILL_DEFAULT_RETENTION_HOURS) * 3600
+    spill_store.gc_interval = spill_config.get("gc_interval_seconds", SPILL_DEFAULT_GC_INTERVAL_SECONDS)
+    return spill_store
+
+
+class SpilledDML(str):
+    """
+    DML statement with ``%s`` placeholders for spilled values, executed with the values read from their side files.
+    The other literals of the statement are escaped for the driver (``%%``). The values are read when the statement
+    is executed, one statement at a time: pymysql escapes the parameters into the query text, it cannot stream them.
+    """
+
+    def __new__(cls, statement: str, refs: list):
+        dml = super().__new__(cls, statement.replace("%", "%%").replace(SPILL_PLACEHOLDER, "%s"))
+        dml.refs = refs
+        return dml
+
+    def __reduce__(self):
+        return _spilled_dml, (str(self), self.refs)
+
+    def params(self) -> list:
+        return [ref.read() for ref in self.refs]
+
+
+def _spilled_dml(dml: str, refs: list) -> SpilledDML:
+    restored = str.__new__(SpilledDML, dml)
+    restored.refs = refs
+    return restored
+
+
+def spilled_dml(statement: str, refs: list):
+    """
+    Statement to execute, a SpilledDML if values were replaced by SPILL_PLACEHOLDER
+    :param statement:
+    :param refs: spilled values in placeholder order
+    :return:
+    """
+    if not refs:
+        return statement
+    return SpilledDML(statement, refs)
+
+
+def describe_spilled(data: dict) -> dict:
+    """
+    Row data with the references replaced by their description, for JSON output
+    :param data: data of an event (updates nest before_values/after_values)
+    :return:
+    """
+    described = {}
+    for key, value in data.items():
+        if isinstance(value, dict):
+            value = describe_spilled(value)
+        elif isinstance(value, SpillRef):
+            value = {"spill": value.digest, "size": value.size}
+        described[key] = value
+    return described
+
+
+if __name__ == "__main__":
+    pass
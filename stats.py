@@ -0,0 +1,266 @@
+import mmap
+import re
+import struct
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from pathlib import Path
+
+# Stats file layout, one file per process (single writer), read by the monitor:
+#   header: magic, used slots, capacity (padded to HEADER_SIZE)
+#   slots:  series name (Prometheus style, e.g. dfs_cdc_rows_total{table="t",action="insert"}), kind, values
+# Counters and gauges use the first value, histograms use one value per bucket followed by count and sum.
+STATS_MAGIC = b"DFSSTAT1"
+STATS_HEADER = struct.Struct("<8sII")
+STATS_HEADER_SIZE = 64
+STATS_SLOT_NAME_SIZE = 128
+STATS_SLOT_HEADER = struct.Struct(f"<{STATS_SLOT_NAME_SIZE}sQ")
+STATS_SLOT_VALUES = 15
+STATS_SLOT_SIZE = STATS_SLOT_HEADER.size + STATS_SLOT_VALUES * 8
+# Slots per file (256 bytes each, the file is sparse): room for the per-table series of a few thousand tables
+STATS_CAPACITY = 16384
+
+COUNTER = 1
+GAUGE = 2
+HISTOGRAM = 3
+KIND_NAMES = {COUNTER: "counter", GAUGE: "gauge", HISTOGRAM: "histogram"}
+
+# Histogram bucket upper bounds in seconds, the +Inf bucket is the count
+HISTOGRAM_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_VALUE = struct.Struct("<d")
+_LABEL_PATTERN = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+
+def series_name(name: str, labels: dict) -> str:
+    """
+    Build a Prometheus style series name
+    :param name: metric name
+    :param labels:
+    :return:
+    """
+    if not labels:
+        return name
+    label_str = ",".join(f'{key}="{_escape(value)}"' for key, value in sorted(labels.items()))
+    return f"{name}{{{label_str}}}"
+
+
+def parse_series_name(series: str) -> tuple:
+    """
+    Split a series name into metric name and labels
+    :param series:
+    :return: (name, labels)
+    """
+    if "{" not in series:
+        return series, {}
+    name, label_str = series.split("{", 1)
+    labels = {
+        key: value.replace('\\"', '"').replace("\\\\", "\\")
+        for key, value in _LABEL_PATTERN.findall(label_str)
+    }
+    return name, labels
+
+
+class StatsFile:
+    """
+    Memory-mapped counters, gauges and latency histograms of one process.
+    The file is recreated when the process starts, updates are plain writes into the mapping,
+    so recording a value costs no system call.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        size = STATS_HEADER_SIZE + STATS_CAPACITY * STATS_SLOT_SIZE
+        with open(self.path, "wb") as stats_file:
+            stats_file.truncate(size)
+        self._file = open(self.path, "r+b")
+        self.mm = mmap.mmap(self._file.fileno(), size)
+        STATS_HEADER.pack_into(self.mm, 0, STATS_MAGIC, 0, STATS_CAPACITY)
+        self.slots = {}
+        # Series whose name does not fit in a slot or that find the file full, they are not recorded
+        self.rejected = set()
+        self.lock = threading.Lock()
+        # The counters of the series not recorded have their slots from the start
+        self._slot(COUNTER, "dfs_stats_series_rejected_total", {})
+        self._slot(COUNTER, "dfs_stats_series_dropped_total", {})
+
+    def _slot(self, kind: int, name: str, labels: dict) -> int:
+        """
+        Returns the values offset of a series, allocating a slot on first use.
+        """
+        series = series_name(name, labels)
+        offset = self.slots.get(series)
+        if offset is not None:
+            return offset
+        if series in self.rejected:
+            return None
+
+        encoded = series.encode()
+        if len(encoded) > STATS_SLOT_NAME_SIZE:
+            # A truncated name would merge series or break their labels, the series is not recorded
+            self.rejected.add(series)
+            print(f"Stats series longer than {STATS_SLOT_NAME_SIZE} bytes is not recorded: {series}", flush=True)
+            self._add(self.slots["dfs_stats_series_rejected_total"], 1)
+            return None
+
+        index = len(self.slots)
+        if index >= STATS_CAPACITY:
+            # The file is full, new series are not recorded
+            self.rejected.add(series)
+            print(f"Stats file full ({STATS_CAPACITY} series), series is not recorded: {series}", flush=True)
+            self._add(self.slots["dfs_stats_series_dropped_total"], 1)
+            return None
+        slot_offset = STATS_HEADER_SIZE + index * STATS_SLOT_SIZE
+        STATS_SLOT_HEADER.pack_into(self.mm, slot_offset, encoded, kind)
+        offset = slot_offset + STATS_SLOT_HEADER.size
+        self.slots[series] = offset
+        # Publish the slot to readers only once it is written
+        STATS_HEADER.pack_into(self.mm, 0, STATS_MAGIC, index + 1, STATS_CAPACITY)
+        return offset
+
+    def _add(self, offset: int, value: float):
+        _VALUE.pack_into(self.mm, offset, _VALUE.unpack_from(self.mm, offset)[0] + value)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        with self.lock:
+            offset = self._slot(COUNTER, name, labels)
+            if offset is not None:
+                self._add(offset, value)
+
+    def set(self, name: str, value: float, **labels):
+        with self.lock:
+            offset = self._slot(GAUGE, name, labels)
+            if offset is not None:
+                _VALUE.pack_into(self.mm, offset, value)
+
+    def observe(self, name: str, seconds: float, **labels):
+        with self.lock:
+            offset = self._slot(HISTOGRAM, name, labels)
+            if offset is None:
+                return
+            bucket = bisect_left(HISTOGRAM_BUCKETS, seconds)
+            if bucket < len(HISTOGRAM_BUCKETS):
+                self._add(offset + bucket * 8, 1)
+            self._add(offset + len(HISTOGRAM_BUCKETS) * 8, 1)
+            self._add(offset + (len(HISTOGRAM_BUCKETS) + 1) * 8, seconds)
+
+
+def read_stats(path: Path) -> list:
+    """
+    Read every series of a stats file
+    :param path:
+    :return: list of dictionaries of name, labels, type and value (counter, gauge) or buckets, count and sum (histogram)
+    """
+    with open(path, "rb") as stats_file:
+        data = stats_file.read()
+    if len(data) < STATS_HEADER_SIZE:
+        return []
+    magic, used, _ = STATS_HEADER.unpack_from(data, 0)
+    if magic != STATS_MAGIC:
+        return []
+
+    result = []
+    for index in range(used):
+        slot_offset = STATS_HEADER_SIZE + index * STATS_SLOT_SIZE
+        raw_name, kind = STATS_SLOT_HEADER.unpack_from(data, slot_offset)
+        values = struct.unpack_from(f"<{STATS_SLOT_VALUES}d", data, slot_offset + STATS_SLOT_HEADER.size)
+        name, labels = parse_series_name(raw_name.rstrip(b"\x00").decode())
+        series = {"name": name, "labels": labels, "type": KIND_NAMES.get(kind, "untyped")}
+        if kind == HISTOGRAM:
+            series["buckets"] = dict(zip(HISTOGRAM_BUCKETS, values[:len(HISTOGRAM_BUCKETS)]))
+            series["count"] = values[len(HISTOGRAM_BUCKETS)]
+            series["sum"] = values[len(HISTOGRAM_BUCKETS) + 1]
+        else:
+            series["value"] = values[0]
+        result.append(series)
+    return result
+
+
+def prometheus_text(series_by_unit: dict) -> str:
+    """
+    Render series in the Prometheus text exposition format
+    :param series_by_unit: dictionary of unit -> series as returned by read_stats
+    :return:
+    """
+    families = {}
+    for unit, series_list in series_by_unit.items():
+        for series in series_list:
+            families.setdefault((series["name"], series["type"]), []).append((unit, series))
+
+    lines = []
+    for (name, kind), members in sorted(families.items()):
+        lines.append(f"# TYPE {name} {kind}")
+        for unit, series in members:
+            labels = dict(series["labels"], unit=unit)
+            if kind == "histogram":
+                cumulative = 0
+                for bound, count in series["buckets"].items():
+                    cumulative += count
+                    lines.append(f"{series_name(name + '_bucket', dict(labels, le=bound))} {cumulative:g}")
+                lines.append(f"{series_name(name + '_bucket', dict(labels, le='+Inf'))} {series['count']:g}")
+                lines.append(f"{series_name(name + '_sum', labels)} {series['sum']:g}")
+                lines.append(f"{series_name(name + '_count', labels)} {series['count']:g}")
+            else:
+                lines.append(f"{series_name(name, labels)} {series['value']:g}")
+    return "\n".join(lines) + "\n"
+
+
+_stats = None
+
+
+def stats_init(path: Path) -> StatsFile:
+    """
+    Create the stats file of the current process, calling it again returns the same file
+    :param path:
+    :return:
+    """
+    global _stats
+    if _stats is None:
+        _stats = StatsFile(path)
+    return _stats
+
+
+def stats_inc(name: str, value: float = 1, **labels):
+    """
+    Increment a counter, a no-op until stats_init is called
+    """
+    if _stats is not None:
+        _stats.inc(name, value, **labels)
+
+
+def stats_set(name: str, value: float, **labels):
+    """
+    Set a gauge, a no-op until stats_init is called
+    """
+    if _stats is not None:
+        _stats.set(name, value, **labels)
+
+
+def stats_observe(name: str, seconds: float, **labels):
+    """
+    Record a latency in a histogram, a no-op until stats_init is called
+    """
+    if _stats is not None:
+        _stats.observe(name, seconds, **labels)
+
+
+@contextmanager
+def stats_timer(name: str, **labels):
+    """
+    Record the duration of a block in a histogram
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats_observe(name, time.perf_counter() - start, **labels)
+
+
+if __name__ == "__main__":
+    pass
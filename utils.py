@@ -1,12 +1,14 @@
 import binascii
 import datetime
-import decimal
 import hashlib
 import json
 import os
 import pickle
 import random
+import sys
+import threading
 import time
+import traceback
 from pathlib import Path
 
 import pymysql
@@ -14,14 +16,26 @@ import yaml
 from loguru import logger
 from pymysql.err import OperationalError
 
-from field_mappings import field_mappings, field_mappings_raw
+from change_event import (
+    ChangeEvent,
+    QueueSerializer,
+    convert_value,
+    event_payload,
+    expand_payload,
+    schema_registry_init,
+)
+from field_mappings import field_mappings, field_mappings_raw, TABLE_PROCESSORS, SKIP_PROCESSOR
+from profiling import traced
+from spill import SpillRef, SPILL_PLACEHOLDER, SpilledDML, describe_spilled, spill_init, spilled_dml
+from stats import stats_inc, stats_observe
 
 
 LOG_SQL_MAX_RETRY = 15
 TARGET_SQL_INSERT_MAX_RETRY = 60
 
 
-PROJECT_DATA_BASE_PATH = Path("/mysql-dataflowsync_data")
+# DFS_DATA_PATH points the units at another data directory (e.g. benchmarks outside the container)
+PROJECT_DATA_BASE_PATH = Path(os.getenv("DFS_DATA_PATH", "/mysql-dataflowsync_data"))
 PROJECT_DATA_BASE_PATH.mkdir(exist_ok=True)
 
 with open(Path(PROJECT_DATA_BASE_PATH, "config.yml"), "r") as config_file:
@@ -30,45 +44,293 @@ with open(Path(PROJECT_DATA_BASE_PATH, "config.yml"), "r") as config_file:
 PROJECT_NAME = config_data["project_name"]
 QUEUE_PATH = Path(PROJECT_DATA_BASE_PATH, "persist_queue")
 LOG_PATH = Path(PROJECT_DATA_BASE_PATH, "logs")
+STATS_PATH = Path(PROJECT_DATA_BASE_PATH, "stats")
 LOG_DB_PASSWORD = os.getenv("MARIADB_ROOT_PASSWORD")
 DML_SERIALIZATION = config_data["dml_serialization"]
+RELATIONSHIP_CACHE_SIZE = config_data.get("relationship_cache_size", 100000)
 
+# Table layouts of the queued ChangeEvents, shared by the CDC and DPU through the queue directory.
+# Columns the target does not use are dropped unless column_projection.enabled is false or they are kept explicitly.
+schema_registry_init(Path(QUEUE_PATH, "schemas.json"), config_data.get("column_projection"))
 
-def log_init():
-
-    LOG_PATH.mkdir(exist_ok=True, parents=True)
-
-    cdc_logger = logger.bind(name="CDC")
-    dpu_logger = logger.bind(name="DPU")
-    error_logger = logger.bind(name="ERROR")
+# Values above spill.threshold_bytes are kept in side files, the queue and cdc_log carry a SpillRef
+SPILL_PATH = Path(PROJECT_DATA_BASE_PATH, "spill")
+spill_init(SPILL_PATH, config_data.get("spill"))
 
-    # logger.remove()
 
-    log_format = "{time:YYYY-MM-DD HH:mm:ss.SSS} | {level} | {name}:{line} | {function} >>> {message}"
 
-    logger.add(  # cdc log
-        sink=Path(LOG_PATH, "cdc.log"),
-        format=log_format,
-        rotation="00:00",
-        compression="zip",
-        filter=lambda record: record["extra"].get("name") == "CDC",
+def _migrate_db_rel_v2(cursor):
+    """
+    Rebuild db_rel clustered on (field_define, old_id): a lookup reads the primary key only, one mapping per
+    source ID, 64-bit IDs. The first mapping of duplicated IDs is kept, like the lookups returned it.
+    The former table is kept as db_rel_v1 and can be dropped once the migration is checked. The rename commits on
+    its own, a migration interrupted after it (db_rel_v1 exists) is not run again.
+    :param cursor: cursor of the migration connection
+    :return:
+    """
+    cursor.execute(
+        """select count(*)
+        from information_schema.tables
+        where table_schema = database()
+          and table_name = 'db_rel_v1';"""
     )
-    logger.add(  # dpu log
-        sink=Path(LOG_PATH, "dpu.log"),
-        format=log_format,
-        rotation="00:00",
-        compression="zip",
-        filter=lambda record: record["extra"].get("name") == "DPU",
+    if cursor.fetchone()[0]:
+        return
+    cursor.execute(
+        """create table if not exists db_rel_v2
+        (
+            field_define varchar(64) not null,
+            old_id       bigint      not null,
+            new_id       bigint      not null,
+            primary key (field_define, old_id)
+        );"""
     )
-    logger.add(  # error log
-        sink=Path(LOG_PATH, "error.log"),
-        format=log_format,
-        rotation="100 MB",
-        compression="zip",
-        filter=lambda record: record["extra"].get("name") == "ERROR",
+    cursor.execute(
+        """insert ignore into db_rel_v2 (field_define, old_id, new_id)
+        select field_define, old_id, new_id
+        from db_rel
+        order by rel_id;"""
     )
+    cursor.execute("rename table db_rel to db_rel_v1, db_rel_v2 to db_rel;")
+
+
+# Log database schema migrations (version, statements), applied in order on connect.
+# Append new versions at the end, an applied version is never run again.
+# A statement is SQL or a function of the cursor for the steps depending on the state of the database.
+LOG_DB_MIGRATIONS = [
+    (
+        1,
+        [
+            # Per-minute throughput rollups, updated in the same transaction as cdc_log/dpu_log
+            """create table if not exists cdc_rollup_minute
+            (
+                minute      datetime                            not null,
+                `table`     varchar(64)                         not null,
+                action      enum ('insert', 'update', 'delete') not null,
+                event_count int unsigned default 0              not null,
+                primary key (minute, `table`, action)
+            );""",
+            """create table if not exists dpu_rollup_minute
+            (
+                minute            datetime                            not null,
+                `table`           varchar(64)                         not null,
+                action            enum ('insert', 'update', 'delete') not null,
+                event_count       int unsigned default 0              not null,
+                applied_count     int unsigned default 0              not null,
+                failed_count      int unsigned default 0              not null,
+                apply_latency_sum double       default 0              not null,
+                primary key (minute, `table`, action)
+            );""",
+        ],
+    ),
+    (
+        2,
+        [
+            # Events the DPU could not apply (dead) and later events of the same row waiting behind them (parked)
+            """create table if not exists dpu_dead_letter
+            (
+                dlq_id      int auto_increment
+                    primary key,
+                cdc_id      int                                                  not null,
+                dt          datetime(3)                                          not null,
+                `table`     varchar(64)                                          not null,
+                action      enum ('insert', 'update', 'delete')                  not null,
+                event_key   varchar(255)                                         not null,
+                status      enum ('dead', 'parked', 'retried', 'discarded')      not null,
+                reason      varchar(32)                                          not null,
+                error       text                                                 null,
+                attempts    int          default 0                               not null,
+                resolved_dt datetime(3)                                          null,
+                payload     longblob                                             not null,
+                index idx_dlq_status (status, dlq_id),
+                index idx_dlq_key (`table`, event_key, status)
+            );""",
+        ],
+    ),
+    (
+        3,
+        [
+            # Source server of the event (name in source_databases), NULL for the single source_database
+            "alter table cdc_log add column if not exists source varchar(64) null after cdc_dt;",
+            "create index if not exists idx_cdc_source on cdc_log (source, cdc_id);",
+        ],
+    ),
+    (
+        4,
+        [
+            # Target of the fan-out DPU (name in target_databases), NULL for the single target_database
+            "alter table dpu_log add column if not exists target varchar(64) null after dt;",
+            "alter table dpu_dead_letter add column if not exists target varchar(64) null after dt;",
+            "create index if not exists idx_dlq_target on dpu_dead_letter (target, status, dlq_id);",
+        ],
+    ),
+    (
+        5,
+        [
+            # Index of the row in its binlog rows event, NULL for rows logged before and for snapshot rows
+            "alter table cdc_log add column if not exists row_index int null after log_pos;",
+            # Unique key of every captured row (cdc_log is partitioned by cdc_id, its unique keys must contain it),
+            # written in the same transaction as the cdc_log row
+            """create table if not exists cdc_row_key
+            (
+                source    varchar(64) default '' not null,
+                log_file  varchar(16)            not null,
+                log_pos   int                    not null,
+                row_index int                    not null,
+                cdc_id    int                    not null,
+                primary key (source, log_file, log_pos, row_index)
+            );""",
+        ],
+    ),
+    (
+        6,
+        [
+            _migrate_db_rel_v2,
+        ],
+    ),
+    (
+        7,
+        [
+            # Set once the row is in the persistence queue, a restart queues the rows logged but not queued only
+            "alter table cdc_row_key add column if not exists queued tinyint default 0 not null;",
+        ],
+    ),
+]
+
+
+LOG_CONFIG = config_data.get("logging") or {}
+LOG_FORMAT = "{time:YYYY-MM-DD HH:mm:ss.SSS} | {level} | {name}:{line} | {function} >>> {message}"
+
+_log_lock = threading.Lock()
+_loggers = None
+
+
+def _text_format(record) -> str:
+    """
+    Text log line, structured events (log_event) are rendered here by the sink thread instead of at the call site
+    :param record:
+    :return: loguru format template
+    """
+    if "event" in record["extra"]:
+        return LOG_FORMAT.replace("{message}", "{extra[event]}") + "\n{exception}"
+    return LOG_FORMAT + "\n{exception}"
+
+
+def _json_format(record) -> str:
+    """
+    JSON line, one object per record
+    :param record:
+    :return: loguru format template
+    """
+    payload = {
+        "time": record["time"].isoformat(timespec="milliseconds"),
+        "level": record["level"].name,
+        "unit": record["extra"].get("name"),
+        "module": record["name"],
+        "function": record["function"],
+        "line": record["line"],
+    }
+    if "event" in record["extra"]:
+        event = record["extra"]["event"]
+        payload["event"] = event.as_dict() if isinstance(event, ChangeEvent) else event
+    else:
+        payload["message"] = record["message"]
+    if record["exception"] is not None:
+        payload["exception"] = "".join(traceback.format_exception(*record["exception"]))
+    record["extra"]["json"] = json.dumps(payload, default=str, ensure_ascii=False)
+    return "{extra[json]}\n"
+
 
-    return cdc_logger, dpu_logger, error_logger
+def log_init():
+    """
+    Initialise the log sinks once per process, later calls return the same loggers.
+    Sinks are enqueued: records are written, rotated and compressed by a background thread,
+    so logging never blocks on file I/O.
+    :return: cdc_logger, dpu_logger, error_logger
+    """
+    global _loggers
+    with _log_lock:
+        if _loggers is not None:
+            return _loggers
+
+        LOG_PATH.mkdir(exist_ok=True, parents=True)
+
+        cdc_logger = logger.bind(name="CDC")
+        dpu_logger = logger.bind(name="DPU")
+        error_logger = logger.bind(name="ERROR")
+
+        log_format = _json_format if LOG_CONFIG.get("json", False) else _text_format
+
+        # The default handler writes synchronously to stderr, it is replaced by an enqueued one
+        logger.remove()
+        if LOG_CONFIG.get("stderr", True):
+            logger.add(sys.stderr, format=log_format, enqueue=True)
+
+        logger.add(  # cdc log
+            sink=Path(LOG_PATH, "cdc.log"),
+            format=log_format,
+            rotation="00:00",
+            compression="zip",
+            enqueue=True,
+            filter=lambda record: record["extra"].get("name") == "CDC",
+        )
+        logger.add(  # dpu log
+            sink=Path(LOG_PATH, "dpu.log"),
+            format=log_format,
+            rotation="00:00",
+            compression="zip",
+            enqueue=True,
+            filter=lambda record: record["extra"].get("name") == "DPU",
+        )
+        logger.add(  # error log
+            sink=Path(LOG_PATH, "error.log"),
+            format=log_format,
+            rotation="100 MB",
+            compression="zip",
+            enqueue=True,
+            filter=lambda record: record["extra"].get("name") == "ERROR",
+        )
+
+        _loggers = cdc_logger, dpu_logger, error_logger
+        return _loggers
+
+
+def log_event(bound_logger, event: dict, level: str = "INFO"):
+    """
+    Log a structured event, e.g. a CDC event or DPU log entry.
+    The event is rendered (repr or JSON) by the sink thread, not by the caller.
+    :param bound_logger: logger returned by log_init
+    :param event:
+    :param level:
+    :return:
+    """
+    bound_logger.bind(event=event).opt(depth=1).log(level, "event")
+
+
+def target_configs() -> list:
+    """
+    Target databases applied by the DPU, the entries of target_databases or the single target_database (without a name)
+    :return: list of target settings
+    """
+    targets = config_data.get("target_databases")
+    if not targets:
+        return [dict(config_data["target_database"], name=None)]
+    names = [target.get("name") for target in targets]
+    if None in names or len(set(names)) != len(names):
+        raise ValueError("target_databases: every target needs a unique name")
+    return targets
+
+
+def processed_tables() -> set:
+    """
+    Source tables applied to any target: the tables of TABLE_PROCESSORS not skipped, all tables of field_mappings_raw
+    if a target is a sink
+    :return:
+    """
+    tables = {table for table, method in TABLE_PROCESSORS.items() if method != SKIP_PROCESSOR}
+    if any(target.get("type", "mysql") != "mysql" for target in target_configs()):
+        tables.update(table for table in field_mappings_raw if "." not in table)
+    return tables
 
 
 def pickle_loads(hex_string):
@@ -100,6 +362,29 @@ def dict_to_hash(_dict):
     return hash_object.hexdigest()
 
 
+def query_primary_key(connection, schema: str, table: str) -> list:
+    """
+    Query the primary key columns of a table
+    :param connection: PyMySQL connection
+    :param schema:
+    :param table:
+    :return: list of (column name, data type), in key order
+    """
+    _sql = """select k.COLUMN_NAME, c.DATA_TYPE
+    from information_schema.KEY_COLUMN_USAGE k
+             join information_schema.COLUMNS c
+                  on c.TABLE_SCHEMA = k.TABLE_SCHEMA
+                      and c.TABLE_NAME = k.TABLE_NAME
+                      and c.COLUMN_NAME = k.COLUMN_NAME
+    where k.TABLE_SCHEMA = %s
+      and k.TABLE_NAME = %s
+      and k.CONSTRAINT_NAME = 'PRIMARY'
+    order by k.ORDINAL_POSITION;"""
+    with connection.cursor() as cursor:
+        cursor.execute(_sql, (schema, table))
+        return list(cursor.fetchall())
+
+
 def generate_random_server_id() -> int:
     """
     Generate a random SERVER ID
@@ -124,21 +409,11 @@ def convert_values(_dict: dict) -> dict:
     """
     for key, value in _dict.items():
 
-        # Time type 1
-        if isinstance(value, datetime.datetime):
-            _dict[key] = value.strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
-
-        # Time type 2
-        elif isinstance(value, datetime.date):
-            _dict[key] = value.strftime("%Y-%m-%d")
-
-        # Exact Fractional Types
-        elif isinstance(value, decimal.Decimal):
-            _dict[key] = float(value)
-
         # If it's a dictionary type then another conversion
-        elif isinstance(value, dict):
+        if isinstance(value, dict):
             convert_values(value)
+        else:
+            _dict[key] = convert_value(value)
     return _dict
 
 
@@ -161,6 +436,7 @@ def find_values_differences(cdc_data: dict):
     return update_values
 
 
+@traced("mapping")
 def mapping_data(table: str, action: str, event_raw_data: dict) -> dict:
     """
     Table name mapping
@@ -199,6 +475,7 @@ def mapping_data(table: str, action: str, event_raw_data: dict) -> dict:
         return event_raw_data
 
 
+@traced("dml.generate_insert")
 def generate_insert_statement(func_name: str, data: dict):
     """
     Generate an INSERT statement for the database
@@ -219,14 +496,18 @@ def generate_insert_statement(func_name: str, data: dict):
     columns = [target_column_map[i] for i in sorted(target_column_map.keys()) if target_column_map[i] != "id"]
     columns_str = ", ".join(columns).replace("last_value", "`last_value`")
 
-    # Constructing a list of values
+    # Constructing a list of values, spilled values are passed as parameters
     values = []
+    refs = []
     for i in target_column_map.keys():
         source_column = source_column_map[i]
         if target_column_map[i] == "id":
             continue
         _value = data[source_column]
-        if isinstance(_value, str):
+        if isinstance(_value, SpillRef):
+            refs.append(_value)
+            values.append(SPILL_PLACEHOLDER)
+        elif isinstance(_value, str):
             # If the value is a string, put it in quotes.
             values.append(f"'{_value}'")
         elif _value is None:
@@ -243,9 +524,50 @@ def generate_insert_statement(func_name: str, data: dict):
         f"INSERT INTO {table_name} ({columns_str}) VALUES ({values_str});"
     )
 
-    return insert_statement
+    return spilled_dml(insert_statement, refs)
+
+
+@traced("dml.generate_overwrite")
+def generate_overwrite_statement(func_name: str, data: dict, where_clause: str):
+    """
+    Generate an UPDATE statement that overwrites every mapped field of a row,
+    used when an INSERT arrives for a row that has already been applied (snapshot overlap).
+
+    :param func_name: method name
+    :param data: Dictionary of row data, the key is the source field name and the value is the field value.
+    :param where_clause: constraint string, e.g. ‘id = 3’
+    :return: generated UPDATE statement string
+    """
+    table_name = func_name.replace("_process_", "")
+
+    source_column_map = field_mappings_raw[table_name]
+    target_column_map = field_mappings[table_name]
+
+    set_clauses = []
+    refs = []
+    for i in sorted(target_column_map.keys()):
+        field = target_column_map[i]
+        if field == "id":
+            continue
+        value = data[source_column_map[i]]
+        if field == "last_value":
+            field = "`last_value`"
+        if isinstance(value, SpillRef):
+            refs.append(value)
+            set_clauses.append(f"{field} = {SPILL_PLACEHOLDER}")
+        elif isinstance(value, str):
+            set_clauses.append(f"{field} = '{value}'")
+        elif value is None:
+            set_clauses.append(f"{field} = NULL")
+        else:
+            set_clauses.append(f"{field} = {value}")
+
+    set_clause = ", ".join(set_clauses)
+
+    return spilled_dml(f"UPDATE {table_name} SET {set_clause} WHERE {where_clause};", refs)
 
 
+@traced("dml.generate_update")
 def generate_update_statement(func_name: str, cdc_data: dict, where_clause: str):
     """
     Generate an UPDATE statement for a database
@@ -261,17 +583,24 @@ def generate_update_statement(func_name: str, cdc_data: dict, where_clause: str)
     if len(update_fields) == 0:
         return None
 
-    # Processing Field Name
+    # Processing Field Name, columns the target does not map (e.g. kept for the audit log only) are left out
     new_data = {}
     for field in update_fields:
         field_raw = field_mappings_raw.get(table_name)
         field_pos = list(filter(lambda x: field_raw[x] == field, field_raw))[0]
-        new_data[field_mappings[table_name][field_pos]] = update_fields[field]
+        if field_pos in field_mappings[table_name]:
+            new_data[field_mappings[table_name][field_pos]] = update_fields[field]
     update_fields = new_data
+    if len(update_fields) == 0:
+        return None
 
     set_clauses = []
+    refs = []
     for field, value in update_fields.items():
-        if isinstance(value, str):
+        if isinstance(value, SpillRef):
+            refs.append(value)
+            set_clauses.append(f"{field} = {SPILL_PLACEHOLDER}")
+        elif isinstance(value, str):
             set_clauses.append(f"{field} = '{value}'")
         else:
             set_clauses.append(f"{field} = {value}")
@@ -281,7 +610,62 @@ def generate_update_statement(func_name: str, cdc_data: dict, where_clause: str)
     # Constructing a Complete UPDATE Statement
     update_statement = f"UPDATE {table_name} SET {set_clause} WHERE {where_clause};"
 
-    return update_statement
+    return spilled_dml(update_statement, refs)
+
+
+_CDC_ROLLUP_SQL = """insert into cdc_rollup_minute (minute, `table`, action, event_count)
+values (%s, %s, %s, %s)
+on duplicate key update event_count = event_count + values(event_count);"""
+
+_DPU_ROLLUP_SQL = """insert into dpu_rollup_minute (minute, `table`, action, event_count)
+values (%s, %s, %s, 1)
+on duplicate key update event_count = event_count + 1;"""
+
+
+def rollup_minute(dt) -> datetime.datetime:
+    """
+    Truncate a datetime to the minute of its rollup row
+    :param dt: datetime, or the string cdc_dt of the events (convert_values format)
+    :return:
+    """
+    if isinstance(dt, str):
+        dt = datetime.datetime.fromisoformat(dt)
+    return dt.replace(second=0, microsecond=0)
+
+
+class RelationshipCache:
+    """
+    DPU relationships found or created in this process, keyed by (field_define, old_id) with the target prefix.
+    Shared by every log database connection of the process, so a relationship replaced through one connection
+    (another worker of the parallel apply, an import) is not read stale through another one.
+    The oldest entry is evicted when the cache is full.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def __contains__(self, key) -> bool:
+        return key in self.entries
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def put(self, key, new_id):
+        with self.lock:
+            if key not in self.entries and len(self.entries) >= self.size:
+                self.entries.pop(next(iter(self.entries)))
+            self.entries[key] = new_id
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+relationship_cache = RelationshipCache(RELATIONSHIP_CACHE_SIZE)
+# Source IDs without a relationship, the insert check of a table processor reads db_rel once per new row
+relationship_missing = RelationshipCache(RELATIONSHIP_CACHE_SIZE)
 
 
 class LogDBConnection:
@@ -311,6 +695,14 @@ class LogDBConnection:
         self.database = f"dfs_{PROJECT_NAME}"
         self.connection = None
         self.initialized = True
+        self.migrated = False
+        # Target of the DPU using this connection (name in target_databases), dpu_log and dead-letter rows
+        # are stored with it and its relationships (db_rel) are kept apart
+        self.target = None
+        # Found and created relationships, shared by the connections of the process
+        self.relationship_cache = relationship_cache
+        # Relationships looked up and not found, dropped when they are created
+        self.relationship_missing = relationship_missing
         self.connect()
 
     def connect(self):
@@ -354,6 +746,10 @@ class LogDBConnection:
         if self.initialized is False:
             self.initialize()
 
+        if self.migrated is False:
+            self.migrate()
+            self.migrated = True
+
     def initialize(self):
         """
         Initialising the database
@@ -422,18 +818,64 @@ class LogDBConnection:
         self.connection.commit()
         print(f"{datetime.datetime.now()} | Log database initialised successfully")
 
-    def cdc_max_log_pos_query(self) -> tuple:
+    def migrate(self):
+        """
+        Apply the pending log database migrations, units starting at the same time wait for each other
+        :return:
+        """
+        lock_name = f"{self.database}_migrate"
+        with self.connection.cursor() as cursor:
+            cursor.execute("select get_lock(%s, 60);", lock_name)
+            try:
+                cursor.execute(
+                    """create table if not exists dfs_schema_version
+                    (
+                        version    int         not null
+                            primary key,
+                        applied_dt datetime(3) not null
+                    );"""
+                )
+                cursor.execute("select coalesce(max(version), 0) from dfs_schema_version;")
+                current_version = cursor.fetchone()[0]
+                for version, statements in LOG_DB_MIGRATIONS:
+                    if version <= current_version:
+                        continue
+                    for statement in statements:
+                        if callable(statement):
+                            statement(cursor)
+                        else:
+                            cursor.execute(statement)
+                    cursor.execute(
+                        "insert into dfs_schema_version (version, applied_dt) values (%s, %s);",
+                        (version, datetime.datetime.now()),
+                    )
+                    self.connection.commit()
+                    print(f"{datetime.datetime.now()} | Log database migrated to schema version {version}")
+            finally:
+                cursor.execute("select release_lock(%s);", lock_name)
+
+    def cdc_max_log_pos_query(self, source: str = None) -> tuple:
         """
         Get the current location of the largest binlog
+        :param source: name of the source server, the latest event of any source by default
         :return:
         """
-        _sql = """select log_file, log_pos
-        from cdc_log
-        order by cdc_id desc
-        limit 1;"""
+        if source is None:
+            _sql = """select log_file, log_pos
+            from cdc_log
+            order by cdc_id desc
+            limit 1;"""
+            params = ()
+        else:
+            _sql = """select log_file, log_pos
+            from cdc_log
+            where source = %s
+            order by cdc_id desc
+            limit 1;"""
+            params = (source,)
         try:
             with self.connection.cursor() as cursor:
-                cursor.execute(_sql)
+                cursor.execute(_sql, params)
                 self.connection.commit()
                 try:
                     return cursor.fetchone()
@@ -443,6 +885,7 @@ class LogDBConnection:
             self.error_logger.error(f"CDC max_log_pos enquiry error: {e}")
             return None, None
 
+    @traced("logdb.cdc_log_insert")
     def cdc_processed_execute_insert(self, event_data: dict, retry=0):
         """
         Insert data into the cdc_log table
@@ -458,33 +901,49 @@ class LogDBConnection:
         log_pos = event_data["log_pos"]
         log_dt = event_data["log_dt"]
         cdc_dt = event_data["cdc_dt"]
+        source = event_data.get("source")
+        row_index = event_data.get("row_index")
         table = event_data["table"]
         action = event_data["action"]
-        data = event_data["data"]
-        _sql = """insert into cdc_log (cdc_dt, log_file, log_pos, log_dt, `table`, action, data)
-        values (%s, %s, %s, %s, %s, %s, %s);"""
+        data = event_payload(event_data)
+        _sql = """insert into cdc_log (cdc_dt, source, log_file, log_pos, row_index, log_dt, `table`, action, data)
+        values (%s, %s, %s, %s, %s, %s, %s, %s, %s);"""
         try:
+            start = time.perf_counter()
             with self.connection.cursor() as cursor:
                 cursor.execute(
                     _sql,
                     (
                         cdc_dt,
+                        source,
                         log_file,
                         log_pos,
+                        row_index,
                         log_dt,
                         table,
                         action,
                         pickle.dumps(data),
                     ),
                 )
+                cdc_id = cursor.lastrowid
+                if row_index is not None:
+                    logged_cdc_id = self._cdc_row_key_insert(cursor, event_data, cdc_id)
+                    if logged_cdc_id != cdc_id:
+                        # The row was logged before (read again after a restart), the first cdc_log row is kept
+                        self.connection.rollback()
+                        stats_inc("dfs_logdb_duplicate_rows_total", **({"source": source} if source else {}))
+                        return logged_cdc_id
+                cursor.execute(_CDC_ROLLUP_SQL, (rollup_minute(cdc_dt), table, action, 1))
                 self.connection.commit()
+                stats_observe("dfs_logdb_write_seconds", time.perf_counter() - start, op="cdc_log")
                 if retry != 0:
                     self.error_logger.warning(f"Reconnect successfully, statement executed successfully")
-                return cursor.lastrowid
+                return cdc_id
         except (pymysql.err.OperationalError, pymysql.err.InterfaceError) as e:
             self.error_logger.error(
                 f"CDC log database insertion error: {e} {(cdc_dt, log_pos, log_dt, table, action, data)}"
             )
+            stats_inc("dfs_logdb_retries_total", op="cdc_log")
             self.error_logger.warning(f"Trying to reconnect, current number of attempts: {retry + 1}")
             try:
                 self.connection.close()
@@ -494,6 +953,169 @@ class LogDBConnection:
             self.connect()
             return self.cdc_processed_execute_insert(event_data, retry=retry + 1)
 
+    @staticmethod
+    def _cdc_row_key_insert(cursor, event_data, cdc_id: int) -> int:
+        """
+        Insert the unique key of a captured row into cdc_row_key
+        :param cursor: cursor of the cdc_log transaction
+        :param event_data:
+        :param cdc_id: cdc_id of the new cdc_log row
+        :return: cdc_id, the cdc_id of the row logged first if the key exists
+        """
+        key = (event_data.get("source") or "", event_data["log_file"], event_data["log_pos"], event_data["row_index"])
+        cursor.execute(
+            "insert ignore into cdc_row_key (source, log_file, log_pos, row_index, cdc_id) values (%s, %s, %s, %s, %s);",
+            (*key, cdc_id),
+        )
+        if cursor.rowcount:
+            return cdc_id
+        cursor.execute(
+            "select cdc_id from cdc_row_key where source = %s and log_file = %s and log_pos = %s and row_index = %s;",
+            key,
+        )
+        return cursor.fetchone()[0]
+
+    def cdc_row_keys_query(self, source: str = None, after_cdc_id: int = 0) -> list:
+        """
+        Keys of the rows of a source logged and queued after a cdc_id, used to rebuild the CDC duplicate filter
+        at startup. A row logged but not queued (a crash between the two) is left out, it is queued when read again.
+        :param source: name of the source server, None for source_database
+        :param after_cdc_id:
+        :return: list of (log_file, log_pos, row_index) in cdc_id order
+        """
+        _sql = """select log_file, log_pos, row_index
+        from cdc_row_key
+        where source = %s
+          and cdc_id > %s
+          and queued = 1
+        order by cdc_id;"""
+        with self.connection.cursor() as cursor:
+            cursor.execute(_sql, (source or "", after_cdc_id or 0))
+            self.connection.commit()
+            return [tuple(row) for row in cursor.fetchall()]
+
+    def cdc_row_key_queued(self, event_data: dict, retry=0):
+        """
+        Mark a logged row as queued
+        :param event_data: event put into the persistence queue
+        :param retry: retry count
+        :return:
+        """
+        if retry >= LOG_SQL_MAX_RETRY:
+            self.error_logger.critical(f"Reconnected  {LOG_SQL_MAX_RETRY} times, row key not marked as queued")
+            return
+        _sql = """update cdc_row_key
+        set queued = 1
+        where source = %s
+          and log_file = %s
+          and log_pos = %s
+          and row_index = %s;"""
+        key = (event_data.get("source") or "", event_data["log_file"], event_data["log_pos"], event_data["row_index"])
+        try:
+            with self.connection.cursor() as cursor:
+                cursor.execute(_sql, key)
+                self.connection.commit()
+        except (pymysql.err.OperationalError, pymysql.err.InterfaceError) as e:
+            self.error_logger.error(f"CDC row key update error: {e} {key}")
+            stats_inc("dfs_logdb_retries_total", op="cdc_row_key")
+            self.error_logger.warning(f"Trying to reconnect, current number of attempts: {retry + 1}")
+            try:
+                self.connection.close()
+            except:
+                pass
+            time.sleep(1)
+            self.connect()
+            self.cdc_row_key_queued(event_data, retry=retry + 1)
+
+    def cdc_row_keys_prune(self, source: str = None, log_file: str = None, log_pos: int = None, retry=0):
+        """
+        Remove the keys of the rows captured up to a binlog position, the CDC resumes after it
+        :param source: name of the source server, None for source_database
+        :param log_file:
+        :param log_pos: rows events ending at or before it
+        :param retry: retry count
+        :return: number of removed keys
+        """
+        if retry >= LOG_SQL_MAX_RETRY:
+            self.error_logger.critical(f"Reconnected  {LOG_SQL_MAX_RETRY} times, row keys not removed")
+            return 0
+        _sql = """delete from cdc_row_key
+        where source = %s
+          and (log_file < %s or (log_file = %s and log_pos <= %s));"""
+        try:
+            with self.connection.cursor() as cursor:
+                removed = cursor.execute(_sql, (source or "", log_file, log_file, log_pos))
+                self.connection.commit()
+                return removed
+        except (pymysql.err.OperationalError, pymysql.err.InterfaceError) as e:
+            self.error_logger.error(f"CDC row key removal error: {e}")
+            stats_inc("dfs_logdb_retries_total", op="cdc_row_key")
+            self.error_logger.warning(f"Trying to reconnect, current number of attempts: {retry + 1}")
+            try:
+                self.connection.close()
+            except:
+                pass
+            time.sleep(1)
+            self.connect()
+            return self.cdc_row_keys_prune(source, log_file, log_pos, retry=retry + 1)
+
+    @traced("logdb.cdc_log_insert_many")
+    def cdc_processed_execute_insert_many(self, events: list, retry=0) -> list:
+        """
+        Insert a batch of events into the cdc_log table within a single transaction
+        :param events: list of event data
+        :param retry: retry count
+        :return: list of cdc_id, in the same order as events
+        """
+        if retry >= LOG_SQL_MAX_RETRY:
+            self.error_logger.critical(f"Reconnected  {LOG_SQL_MAX_RETRY} times, will return cdc_id = -1")
+            return [-1] * len(events)
+
+        _sql = """insert into cdc_log (cdc_dt, source, log_file, log_pos, row_index, log_dt, `table`, action, data)
+        values (%s, %s, %s, %s, %s, %s, %s, %s, %s);"""
+        try:
+            start = time.perf_counter()
+            cdc_ids = []
+            rollups = {}
+            with self.connection.cursor() as cursor:
+                for event_data in events:
+                    cursor.execute(
+                        _sql,
+                        (
+                            event_data["cdc_dt"],
+                            event_data.get("source"),
+                            event_data["log_file"],
+                            event_data["log_pos"],
+                            event_data.get("row_index"),
+                            event_data["log_dt"],
+                            event_data["table"],
+                            event_data["action"],
+                            pickle.dumps(event_payload(event_data)),
+                        ),
+                    )
+                    cdc_ids.append(cursor.lastrowid)
+                    rollup_key = (rollup_minute(event_data["cdc_dt"]), event_data["table"], event_data["action"])
+                    rollups[rollup_key] = rollups.get(rollup_key, 0) + 1
+                for (minute, table, action), count in rollups.items():
+                    cursor.execute(_CDC_ROLLUP_SQL, (minute, table, action, count))
+                self.connection.commit()
+                stats_observe("dfs_logdb_write_seconds", time.perf_counter() - start, op="cdc_log_batch")
+                if retry != 0:
+                    self.error_logger.warning(f"Reconnect successfully, statement executed successfully")
+                return cdc_ids
+        except (pymysql.err.OperationalError, pymysql.err.InterfaceError) as e:
+            self.error_logger.error(f"CDC log database batch insertion error: {e} ({len(events)} events)")
+            stats_inc("dfs_logdb_retries_total", op="cdc_log_batch")
+            self.error_logger.warning(f"Trying to reconnect, current number of attempts: {retry + 1}")
+            try:
+                self.connection.close()
+            except:
+                pass
+            time.sleep(1)
+            self.connect()
+            return self.cdc_processed_execute_insert_many(events, retry=retry + 1)
+
+    @traced("logdb.dpu_log_insert")
     def dpu_processed_log_insert(self, raw, dml, retry=0):
         """
         Insert data into the dpu_log table
@@ -511,8 +1133,8 @@ class LogDBConnection:
         table = raw["table"]
         action = raw["action"]
         dt = datetime.datetime.now()
-        _sql = """insert into dpu_log (cdc_id, dt, `table`, action, dml)
-        values  (%s, %s, %s, %s, %s);"""
+        _sql = """insert into dpu_log (cdc_id, dt, target, `table`, action, dml)
+        values  (%s, %s, %s, %s, %s, %s);"""
         _sql = _sql.replace("None", "null")
 
         # DPU Processing Completed SQL
@@ -520,14 +1142,17 @@ class LogDBConnection:
         set dpu_process_status = 1
         where cdc_id = %s;"""
         try:
+            start = time.perf_counter()
             with self.connection.cursor() as cursor:
                 if DML_SERIALIZATION is False:
-                    cursor.execute(_sql, (cdc_id, dt, table, action, dml))
+                    cursor.execute(_sql, (cdc_id, dt, self.target, table, action, dml))
                 else:
-                    cursor.execute(_sql, (cdc_id, dt, table, action, pickle.dumps(dml)))
+                    cursor.execute(_sql, (cdc_id, dt, self.target, table, action, pickle.dumps(dml)))
                 dpu_id = cursor.lastrowid
                 cursor.execute(_dpu_done_sql, cdc_id)
+                cursor.execute(_DPU_ROLLUP_SQL, (rollup_minute(dt), table, action))
                 self.connection.commit()
+                stats_observe("dfs_logdb_write_seconds", time.perf_counter() - start, op="dpu_log")
                 if retry != 0:
                     self.error_logger.warning(f"Reconnect successfully, statement executed successfully")
                 log_info = {
@@ -537,12 +1162,13 @@ class LogDBConnection:
                     "table": table,
                     "dml": dml,
                 }
-                self.dpu_logger.info(log_info)
+                log_event(self.dpu_logger, log_info)
                 return dpu_id
         except Exception as e:
             self.error_logger.error(
                 f"[cdc_id: {cdc_id}] DPU log database insertion error: {e} {(cdc_id, dt, table, action, dml)}"
             )
+            stats_inc("dfs_logdb_retries_total", op="dpu_log")
             self.error_logger.warning(f"Trying to reconnect, current number of attempts: {retry + 1}")
             try:
                 self.connection.close()
@@ -552,87 +1178,294 @@ class LogDBConnection:
             self.connect()
             return self.dpu_processed_log_insert(raw, dml, retry=retry + 1)
 
-    def dpu_after_dml_execute_update(self, dpu_id):
+    @traced("logdb.dpu_status_update")
+    def dpu_after_dml_execute_update(self, dpu_id, executed=True):
         """
-        Update dml execution status
+        Update dml execution status and the applied/failed counts of the per-minute rollup
         :param dpu_id:
+        :param executed: False if the DML failed on the target database, the status is left unexecuted
         :return:
         """
         _sql = """update dpu_log
         set dml_execute_status = 1
         where dpu_id = %s;"""
+        # Apply latency is the time from DPU logging to the execution on the target database
+        _rollup_sql = """insert into dpu_rollup_minute (minute, `table`, action, applied_count, failed_count, apply_latency_sum)
+        select date_format(dt, '%%Y-%%m-%%d %%H:%%i:00'), `table`, action, %s, %s,
+               if(%s, timestampdiff(microsecond, dt, %s) / 1000000, 0)
+        from dpu_log
+        where dpu_id = %s
+        on duplicate key update applied_count     = applied_count + values(applied_count),
+                                failed_count      = failed_count + values(failed_count),
+                                apply_latency_sum = apply_latency_sum + values(apply_latency_sum);"""
         try:
+            start = time.perf_counter()
             with self.connection.cursor() as cursor:
-                cursor.execute(_sql, dpu_id)
+                if executed:
+                    cursor.execute(_sql, dpu_id)
+                cursor.execute(
+                    _rollup_sql,
+                    (int(executed), int(not executed), executed, datetime.datetime.now(), dpu_id),
+                )
                 self.connection.commit()
-                self.dpu_logger.info({"dpu_id": dpu_id, "execute": True})
+                stats_observe("dfs_logdb_write_seconds", time.perf_counter() - start, op="dpu_status")
+                log_event(self.dpu_logger, {"dpu_id": dpu_id, "execute": executed})
                 return True
         except Exception as e:
             self.error_logger.error(f"[dpu_id: {dpu_id}] DPU log database update error: {e}")
             return False
 
-    def dpu_relationship_query(self, field_define, old_id):
+    def rollup_query(self, unit, table=None, action=None, start=None, end=None, after=None, limit=500) -> list:
+        """
+        Query the per-minute rollup of a unit, keyset paginated on (minute, table, action)
+        :param unit: cdc or dpu
+        :param table:
+        :param action:
+        :param start: first minute (inclusive)
+        :param end: last minute (exclusive)
+        :param after: (minute, table, action) of the last row of the previous page
+        :param limit:
+        :return: list of dictionaries
+        """
+        rollup_table = {"cdc": "cdc_rollup_minute", "dpu": "dpu_rollup_minute"}[unit]
+        conditions, args = [], []
+        for condition, value in (
+                ("`table` = %s", table),
+                ("action = %s", action),
+                ("minute >= %s", start),
+                ("minute < %s", end),
+        ):
+            if value is not None:
+                conditions.append(condition)
+                args.append(value)
+        if after is not None:
+            conditions.append("(minute, `table`, action) > (%s, %s, %s)")
+            args.extend(after)
+        where_clause = f"where {' and '.join(conditions)}" if conditions else ""
+        _sql = f"""select * from {rollup_table} {where_clause}
+        order by minute, `table`, action
+        limit %s;"""
+        with self.connection.cursor(pymysql.cursors.DictCursor) as cursor:
+            cursor.execute(_sql, (*args, limit))
+            self.connection.commit()
+            return list(cursor.fetchall())
+
+    def log_page_query(self, unit, table=None, after_id=None, before_id=None, limit=100) -> list:
+        """
+        Query cdc_log/dpu_log rows, keyset paginated on cdc_id/dpu_id.
+        Pages after after_id are in ascending order, pages before before_id (or the latest page) in descending order.
+        :param unit: cdc or dpu
+        :param table:
+        :param after_id:
+        :param before_id:
+        :param limit:
+        :return: list of dictionaries
+        """
+        log_table, id_column, blob_column = {
+            "cdc": ("cdc_log", "cdc_id", "data"),
+            "dpu": ("dpu_log", "dpu_id", "dml"),
+        }[unit]
+        conditions, args = [], []
+        if table is not None:
+            conditions.append("`table` = %s")
+            args.append(table)
+        if after_id is not None:
+            conditions.append(f"{id_column} > %s")
+            args.append(after_id)
+            order = "asc"
+        else:
+            if before_id is not None:
+                conditions.append(f"{id_column} < %s")
+                args.append(before_id)
+            order = "desc"
+        where_clause = f"where {' and '.join(conditions)}" if conditions else ""
+        _sql = f"""select * from {log_table} {where_clause}
+        order by {id_column} {order}
+        limit %s;"""
+        with self.connection.cursor(pymysql.cursors.DictCursor) as cursor:
+            cursor.execute(_sql, (*args, limit))
+            self.connection.commit()
+            rows = list(cursor.fetchall())
+
+        for row in rows:
+            blob = row[blob_column]
+            if unit == "cdc":
+                blob = describe_spilled(expand_payload(pickle.loads(blob)))
+            elif DML_SERIALIZATION is True:
+                blob = pickle.loads(blob)
+            row[blob_column] = blob.decode() if isinstance(blob, bytes) else blob
+        return rows
+
+    @traced("logdb.relationship_query")
+    def dpu_relationship_query(self, field_define, old_id, source=None):
         """
         Query DPU Relationship
         :param field_define:
         :param old_id:
+        :param source: name of the source of the event in source_databases
         :return:
         """
+        field_define = self.relationship_field(field_define, source)
+        new_id = self.relationship_cache.get((field_define, old_id))
+        if new_id is not None:
+            stats_inc("dfs_relationship_cache_total", result="hit")
+            return new_id
+        stats_inc("dfs_relationship_cache_total", result="miss")
+
         _sql = """select new_id
         from db_rel
         where field_define = %s
           and old_id = %s;"""
         try:
+            start = time.perf_counter()
             with self.connection.cursor() as cursor:
                 cursor.execute(_sql, (field_define, old_id))
                 self.connection.commit()
-                try:
-                    return cursor.fetchone()[0]
-                except TypeError:
+                stats_observe("dfs_logdb_read_seconds", time.perf_counter() - start, op="db_rel")
+                result = cursor.fetchone()
+                if result is None:
                     return old_id
+                self._cache_relationship(field_define, old_id, result[0])
+                return result[0]
         except (pymysql.err.OperationalError, pymysql.err.InterfaceError) as e:
             self.error_logger.error(
                 f"DPU log database update error: {e} field: {field_define} old_id: {old_id}"
             )
             return old_id
 
-    def dpu_relationship_create(self, field_define, old_id, new_id, retry=0):
+    def relationship_field(self, field_define, source=None) -> str:
+        """
+        field_define of a relationship in db_rel, prefixed by the target so every target keeps its own IDs.
+        IDs of the named sources (source_databases) are kept apart by the source name: "target:source/field_define"
+        :param field_define:
+        :param source: name of the source in source_databases, None for the single source_database
+        :return:
+        """
+        if source is not None:
+            field_define = f"{source}/{field_define}"
+        if self.target is None:
+            return field_define
+        return f"{self.target}:{field_define}"
+
+    def _cache_relationship(self, field_define, old_id, new_id):
+        """
+        Cache a DPU Relationship, the oldest entry is evicted when the cache is full
+        :param field_define:
+        :param old_id:
+        :param new_id:
+        :return:
+        """
+        self.relationship_cache.put((field_define, old_id), new_id)
+        self.relationship_missing.invalidate((field_define, old_id))
+
+    @traced("logdb.relationship_query_many")
+    def dpu_relationship_query_many(self, field_define, old_ids, source=None) -> dict:
+        """
+        Query DPU Relationships for a batch of IDs
+        :param field_define:
+        :param old_ids:
+        :param source: name of the source in source_databases
+        :return: dictionary of old_id -> new_id, IDs without a relationship are not included
+        """
+        field_define = self.relationship_field(field_define, source)
+        old_ids = list(old_ids)
+        result = {}
+        if not old_ids:
+            return result
+        with self.connection.cursor() as cursor:
+            for i in range(0, len(old_ids), 1000):
+                batch = old_ids[i:i + 1000]
+                _sql = f"""select old_id, new_id
+                from db_rel
+                where field_define = %s
+                  and old_id in ({", ".join(["%s"] * len(batch))});"""
+                cursor.execute(_sql, (field_define, *batch))
+                result.update(cursor.fetchall())
+            self.connection.commit()
+        return result
+
+    @traced("logdb.relationship_exists")
+    def dpu_relationship_exists(self, field_define, old_id, source=None) -> bool:
+        """
+        Check whether a DPU Relationship has already been created, i.e. the source row has been applied
+        :param field_define:
+        :param old_id:
+        :param source: name of the source of the event in source_databases
+        :return:
+        """
+        field_define = self.relationship_field(field_define, source)
+        if (field_define, old_id) in self.relationship_cache:
+            return True
+        if (field_define, old_id) in self.relationship_missing:
+            return False
+
+        _sql = """select 1
+        from db_rel
+        where field_define = %s
+          and old_id = %s
+        limit 1;"""
+        try:
+            with self.connection.cursor() as cursor:
+                cursor.execute(_sql, (field_define, old_id))
+                self.connection.commit()
+                if cursor.fetchone() is None:
+                    self.relationship_missing.put((field_define, old_id), True)
+                    return False
+                return True
+        except (pymysql.err.OperationalError, pymysql.err.InterfaceError) as e:
+            self.error_logger.error(
+                f"DPU log database query error: {e} field: {field_define} old_id: {old_id}"
+            )
+            return False
+
+    @traced("logdb.relationship_create")
+    def dpu_relationship_create(self, field_define, old_id, new_id, source=None, identical=False, retry=0):
         """
         Creating DPU Relationships
         :param field_define:
         :param old_id:
         :param new_id:
+        :param source: name of the source of the event in source_databases
+        :param identical: record identical IDs as well, e.g. for the rows copied by the snapshot
         :param retry: retry count
-        :return:
+        :return: 1 if the relationship was created, 2 if it replaced another target ID, 0 if it existed,
+            None for identical IDs, which are not recorded (a missing relationship maps an ID to itself)
         """
-        if old_id == new_id:
+        # Identical IDs replacing an existing relationship are recorded, the stale target ID would be read otherwise
+        if old_id == new_id and not identical and not self.dpu_relationship_exists(field_define, old_id, source):
             return None
+        rel_field = self.relationship_field(field_define, source)
         if retry >= LOG_SQL_MAX_RETRY:
-            self.error_logger.critical(f"Reconnected  {LOG_SQL_MAX_RETRY} times, will not return rel_id")
+            self.error_logger.critical(f"Reconnected  {LOG_SQL_MAX_RETRY} times, relationship not created")
             return None
-        _sql = (
-            """insert into db_rel (field_define, old_id, new_id) values (%s, %s, %s);"""
-        )
+        # A source ID has one mapping, creating it again replaces the target ID
+        _sql = """insert into db_rel (field_define, old_id, new_id)
+        values (%s, %s, %s)
+        on duplicate key update new_id = values(new_id);"""
         try:
+            start = time.perf_counter()
             with self.connection.cursor() as cursor:
-                cursor.execute(_sql, (field_define, old_id, new_id))
+                rowcount = cursor.execute(_sql, (rel_field, old_id, new_id))
                 self.connection.commit()
-                rel_id = cursor.lastrowid
-                self.dpu_logger.info(
+                stats_observe("dfs_logdb_write_seconds", time.perf_counter() - start, op="db_rel")
+                self._cache_relationship(rel_field, old_id, new_id)
+                log_event(
+                    self.dpu_logger,
                     {
-                        "rel_id": rel_id,
-                        "field": field_define,
+                        "field": rel_field,
                         "old_id": old_id,
                         "new_id": new_id,
-                    }
+                        "replaced": rowcount == 2,
+                    },
                 )
                 if retry != 0:
                     self.error_logger.warning(f"Reconnect successfully, statement executed successfully")
-                return rel_id
+                return rowcount
         except (pymysql.err.OperationalError, pymysql.err.InterfaceError) as e:
             self.error_logger.error(
                 f"DPU relational database insertion error: {e} field: {field_define} old_id: {old_id} new_id: {new_id}"
             )
+            stats_inc("dfs_logdb_retries_total", op="db_rel")
             self.error_logger.warning(f"Trying to reconnect, current number of attempts: {retry + 1}")
             try:
                 self.connection.close()
@@ -641,9 +1474,280 @@ class LogDBConnection:
             time.sleep(1)
             self.connect()
             return self.dpu_relationship_create(
-                field_define, old_id, new_id, retry=retry + 1
+                field_define, old_id, new_id, source=source, identical=identical, retry=retry + 1
             )
 
+    def dpu_relationship_create_many(self, relationships: list, retry=0) -> int:
+        """
+        Create or replace DPU Relationships in one multi-row statement, used to seed db_rel (--mode rel import).
+        The statement is idempotent, a batch interrupted by a lost connection is written again.
+        :param relationships: (field_define, old_id, new_id) tuples
+        :param retry: retry count
+        :return: affected rows, 1 per created and 2 per replaced relationship
+        """
+        rows = [(self.relationship_field(field_define), old_id, new_id) for field_define, old_id, new_id in relationships]
+        if not rows:
+            return 0
+        if retry >= LOG_SQL_MAX_RETRY:
+            self.error_logger.critical(f"Reconnected  {LOG_SQL_MAX_RETRY} times, relationships not created")
+            raise pymysql.err.OperationalError("Log database unavailable")
+        _sql = """insert into db_rel (field_define, old_id, new_id)
+        values (%s, %s, %s)
+        on duplicate key update new_id = values(new_id);"""
+        try:
+            start = time.perf_counter()
+            with self.connection.cursor() as cursor:
+                rowcount = cursor.executemany(_sql, rows)
+                self.connection.commit()
+            stats_observe("dfs_logdb_write_seconds", time.perf_counter() - start, op="db_rel")
+            if retry != 0:
+                self.error_logger.warning(f"Reconnect successfully, statement executed successfully")
+        except (pymysql.err.OperationalError, pymysql.err.InterfaceError) as e:
+            self.error_logger.error(f"DPU relationship import error: {e} relationships: {len(rows)}")
+            stats_inc("dfs_logdb_retries_total", op="db_rel")
+            self.error_logger.warning(f"Trying to reconnect, current number of attempts: {retry + 1}")
+            try:
+                self.connection.close()
+            except:
+                pass
+            time.sleep(1)
+            self.connect()
+            return self.dpu_relationship_create_many(relationships, retry=retry + 1)
+        # Replaced relationships are read again on their next use
+        for rel_field, old_id, _ in rows:
+            self.relationship_cache.invalidate((rel_field, old_id))
+            self.relationship_missing.invalidate((rel_field, old_id))
+        return rowcount
+
+    def dpu_relationship_export(self, field_define=None, after: tuple = None, limit: int = 10000) -> list:
+        """
+        DPU Relationships of the target of this connection in primary key order, one page after another.
+        Without a target, the relationships of target_database: those without a "<target>:" prefix
+        :param field_define: only relationships of this field
+        :param after: (field_define, old_id) of the last relationship of the previous page
+        :param limit:
+        :return: list of (field_define, old_id, new_id), field_define without the target prefix
+        """
+        conditions, params = [], []
+        if field_define is not None:
+            conditions.append("field_define = %s")
+            params.append(self.relationship_field(field_define))
+        elif self.target is not None:
+            prefix = self.relationship_field("").replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            conditions.append("field_define like %s")
+            params.append(f"{prefix}%")
+        else:
+            conditions.append("locate(':', field_define) = 0")
+        if after is not None:
+            rel_field = self.relationship_field(after[0])
+            conditions.append("(field_define > %s or (field_define = %s and old_id > %s))")
+            params.extend((rel_field, rel_field, after[1]))
+        where = f"where {' and '.join(conditions)}" if conditions else ""
+        _sql = f"""select field_define, old_id, new_id
+        from db_rel
+        {where}
+        order by field_define, old_id
+        limit %s;"""
+        with self.connection.cursor() as cursor:
+            cursor.execute(_sql, (*params, limit))
+            rows = cursor.fetchall()
+            self.connection.commit()
+        prefix_length = len(self.relationship_field(""))
+        return [(rel_field[prefix_length:], old_id, new_id) for rel_field, old_id, new_id in rows]
+
+    def dpu_dead_letter_insert(self, raw, event_key, status, reason, error, retry=0):
+        """
+        Store an event in the dead-letter queue
+        :param raw: event
+        :param event_key: key of the row, later events of the same key are parked behind it
+        :param status: dead or parked
+        :param reason: no_processor, permanent_error, processor_error or key_parked
+        :param error:
+        :param retry: retry count
+        :return: dlq_id
+        """
+        if retry >= LOG_SQL_MAX_RETRY:
+            self.error_logger.critical(f"Reconnected  {LOG_SQL_MAX_RETRY} times, will return dlq_id = -1")
+            return -1
+        _sql = """insert into dpu_dead_letter (cdc_id, dt, target, `table`, action, event_key, status, reason, error, payload)
+        values (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s);"""
+        try:
+            with self.connection.cursor() as cursor:
+                cursor.execute(
+                    _sql,
+                    (
+                        raw["cdc_id"],
+                        datetime.datetime.now(),
+                        self.target,
+                        raw["table"],
+                        raw["action"],
+                        event_key,
+                        status,
+                        reason,
+                        error,
+                        QueueSerializer.dumps(raw),
+                    ),
+                )
+                self.connection.commit()
+                return cursor.lastrowid
+        except (pymysql.err.OperationalError, pymysql.err.InterfaceError) as e:
+            self.error_logger.error(f"DPU dead-letter insertion error: {e} cdc_id: {raw['cdc_id']}")
+            stats_inc("dfs_logdb_retries_total", op="dead_letter")
+            self.error_logger.warning(f"Trying to reconnect, current number of attempts: {retry + 1}")
+            try:
+                self.connection.close()
+            except:
+                pass
+            time.sleep(1)
+            self.connect()
+            return self.dpu_dead_letter_insert(raw, event_key, status, reason, error, retry=retry + 1)
+
+    def dpu_dead_letter_open_keys(self, retry=0) -> set:
+        """
+        Keys of the rows with unresolved (dead or parked) events of the target
+        :param retry: retry count
+        :return: set of (table, event_key)
+        """
+        if retry >= LOG_SQL_MAX_RETRY:
+            self.error_logger.critical(f"Reconnected  {LOG_SQL_MAX_RETRY} times, dead-letter keys not loaded")
+            raise pymysql.err.OperationalError("Log database unavailable")
+        _sql = """select distinct `table`, event_key
+        from dpu_dead_letter
+        where status in ('dead', 'parked')
+          and target <=> %s;"""
+        try:
+            with self.connection.cursor() as cursor:
+                cursor.execute(_sql, (self.target,))
+                self.connection.commit()
+                return {(table, event_key) for table, event_key in cursor.fetchall()}
+        except (pymysql.err.OperationalError, pymysql.err.InterfaceError) as e:
+            self.error_logger.error(f"DPU dead-letter keys query error: {e}")
+            stats_inc("dfs_logdb_retries_total", op="dead_letter_keys")
+            self.error_logger.warning(f"Trying to reconnect, current number of attempts: {retry + 1}")
+            try:
+                self.connection.close()
+            except:
+                pass
+            time.sleep(1)
+            self.connect()
+            return self.dpu_dead_letter_open_keys(retry=retry + 1)
+
+    def dpu_dead_letter_query(self, table=None, status=None, after_id=None, limit=100, retry=0) -> list:
+        """
+        Query dead-letter entries of the target in dlq_id order, the payload is returned as the queued event
+        :param table:
+        :param status: tuple of statuses, unresolved (dead, parked) by default
+        :param after_id: last dlq_id of the previous page
+        :param limit:
+        :param retry: retry count
+        :return: list of dictionaries
+        """
+        if retry >= LOG_SQL_MAX_RETRY:
+            self.error_logger.critical(f"Reconnected  {LOG_SQL_MAX_RETRY} times, dead-letter entries not loaded")
+            raise pymysql.err.OperationalError("Log database unavailable")
+        status = status or ("dead", "parked")
+        conditions = [f"status in ({', '.join(['%s'] * len(status))})", "target <=> %s"]
+        args = [*status, self.target]
+        if table is not None:
+            conditions.append("`table` = %s")
+            args.append(table)
+        if after_id is not None:
+            conditions.append("dlq_id > %s")
+            args.append(after_id)
+        _sql = f"""select * from dpu_dead_letter
+        where {' and '.join(conditions)}
+        order by dlq_id
+        limit %s;"""
+        try:
+            with self.connection.cursor(pymysql.cursors.DictCursor) as cursor:
+                cursor.execute(_sql, (*args, limit))
+                self.connection.commit()
+                rows = list(cursor.fetchall())
+        except (pymysql.err.OperationalError, pymysql.err.InterfaceError) as e:
+            self.error_logger.error(f"DPU dead-letter query error: {e}")
+            stats_inc("dfs_logdb_retries_total", op="dead_letter_query")
+            self.error_logger.warning(f"Trying to reconnect, current number of attempts: {retry + 1}")
+            try:
+                self.connection.close()
+            except:
+                pass
+            time.sleep(1)
+            self.connect()
+            return self.dpu_dead_letter_query(table, status, after_id, limit, retry=retry + 1)
+        for row in rows:
+            row["payload"] = QueueSerializer.loads(row["payload"])
+        return rows
+
+    def dpu_dead_letter_update(self, dlq_id, status, error=None, retry=0):
+        """
+        Record the outcome of a retry or a discard
+        :param dlq_id:
+        :param status: retried or discarded resolve the entry, dead or parked keep it (failed retry)
+        :param error: error of the failed retry
+        :param retry: retry count
+        :return:
+        """
+        if retry >= LOG_SQL_MAX_RETRY:
+            self.error_logger.critical(f"Reconnected  {LOG_SQL_MAX_RETRY} times, dlq_id: {dlq_id} not updated")
+            raise pymysql.err.OperationalError("Log database unavailable")
+        resolved_dt = datetime.datetime.now() if status in ("retried", "discarded") else None
+        _sql = """update dpu_dead_letter
+        set status = %s, resolved_dt = %s, attempts = attempts + %s, error = coalesce(%s, error)
+        where dlq_id = %s;"""
+        try:
+            with self.connection.cursor() as cursor:
+                cursor.execute(_sql, (status, resolved_dt, int(status != "discarded"), error, dlq_id))
+                self.connection.commit()
+        except (pymysql.err.OperationalError, pymysql.err.InterfaceError) as e:
+            self.error_logger.error(f"DPU dead-letter update error: {e} dlq_id: {dlq_id}")
+            stats_inc("dfs_logdb_retries_total", op="dead_letter_update")
+            self.error_logger.warning(f"Trying to reconnect, current number of attempts: {retry + 1}")
+            try:
+                self.connection.close()
+            except:
+                pass
+            time.sleep(1)
+            self.connect()
+            self.dpu_dead_letter_update(dlq_id, status, error, retry=retry + 1)
+
+
+class PermanentApplyError(Exception):
+    """
+    The target rejected a DML statement because of the event itself (constraint, data or syntax error),
+    retrying the statement cannot succeed
+    """
+
+    def __init__(self, error, sql):
+        super().__init__(f"{error} {sql}")
+        self.error = error
+        self.sql = sql
+
+
+# OperationalError codes caused by the statement itself (unknown column, wrong value, check constraint),
+# other operational errors (connection loss, deadlock, lock wait timeout, privileges) are retried
+PERMANENT_OPERATIONAL_ERRORS = {1054, 1292, 3819, 4025}
+
+
+def is_permanent_error(error) -> bool:
+    """
+    Classify a target database error as permanent or transient
+    :param error: pymysql error
+    :return:
+    """
+    if isinstance(
+        error,
+        (
+            pymysql.err.IntegrityError,
+            pymysql.err.ProgrammingError,
+            pymysql.err.DataError,
+            pymysql.err.NotSupportedError,
+        ),
+    ):
+        return True
+    if isinstance(error, pymysql.err.OperationalError) and error.args:
+        return error.args[0] in PERMANENT_OPERATIONAL_ERRORS
+    return False
+
 
 class TargetDBConnection:
     """
@@ -662,6 +1766,7 @@ class TargetDBConnection:
         # 日志
         _, _, self.error_logger = log_init()
 
+    @traced("target.execute")
     def insert_and_update(self, sql, retry=0):
         """
         Execute the insert statement
@@ -676,23 +1781,29 @@ class TargetDBConnection:
                 f"Re-connected  {TARGET_SQL_INSERT_MAX_RETRY} times, failed to execute DML statement on target database, will return None {sql}"
             )
             return None
+        dml = sql
         sql = sql.replace("None", "null")
+        statement = sql.split(" ", 1)[0].upper()
         try:
+            start = time.perf_counter()
             with self.connection.cursor() as cursor:
-                cursor.execute(sql)
+                # Spilled values are read from their side files and passed as parameters
+                cursor.execute(sql, dml.params() if isinstance(dml, SpilledDML) else None)
                 self.connection.commit()
+                stats_observe("dfs_target_apply_seconds", time.perf_counter() - start, statement=statement)
                 if retry != 0:
                     self.error_logger.warning(f"Reconnect successfully, statement executed successfully")
                 if sql.startswith("UPDATE") or sql.startswith("DELETE"):
                     return cursor.rowcount
                 else:
                     return cursor.lastrowid
-        except (
-                pymysql.err.OperationalError,
-                pymysql.err.InterfaceError,
-                pymysql.err.IntegrityError,
-        ) as e:
+        except pymysql.err.MySQLError as e:
             self.error_logger.error(f"Target database insert/update/delete errors: {e} {sql}")
+            if is_permanent_error(e):
+                stats_inc("dfs_target_errors_total", statement=statement, kind="permanent")
+                self.connection.rollback()
+                raise PermanentApplyError(e, sql) from e
+            stats_inc("dfs_target_retries_total", statement=statement)
             self.error_logger.warning(f"Trying to reconnect, current number of attempts: {retry + 1}")
             try:
                 self.connection.close()
@@ -700,7 +1811,7 @@ class TargetDBConnection:
                 pass
             time.sleep(5)
             self.__init__(self.host, self.port, self.user, self.passwd, self.schemas)
-            return self.insert_and_update(sql, retry=retry + 1)
+            return self.insert_and_update(dml, retry=retry + 1)
 
 
 if __name__ == "__main__":